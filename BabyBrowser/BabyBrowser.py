@@ -1,8 +1,17 @@
 import os
+import json
+import hashlib
+import sqlite3
 import unittest
 import subprocess
+import time
+import threading
 import vtkITK
 from __main__ import vtk, qt, ctk, slicer
+from BabyBrowserLib import CLIJob, PythonJob, JobBatch, JobPool, PipelineCache, Pipeline, VolumeCache, Prefetcher
+from BabyBrowserLib import Nrrd, CohortStore, HistogramMatching, HistogramMatcher, CohortStatistics
+from BabyBrowserLib import Pyramid, Discovery, CohortIndex, WorkQueue, Profiler, Benchmark, Transforms, Mosaic
+from BabyBrowserLib import Quality, WindowLevel, BiasCorrection
 
 #
 # BabyBrowser
@@ -42,6 +51,8 @@ class BabyBrowser:
 class BabyBrowserWidget:
   def __init__(self, parent = None):
     self.logic = BabyBrowserLogic()
+    # the pipeline shown in the Processing area
+    self.pipeline = None
     if not parent:
       self.parent = slicer.qMRMLWidget()
       self.parent.setLayout(qt.QVBoxLayout())
@@ -101,12 +112,112 @@ class BabyBrowserWidget:
     self.dataSlider.enabled = False
     dataFormLayout.addRow("Data path: ", self.pathEdit)
     dataFormLayout.addRow("Data pattern: ", self.patternEdit)
+    self.memoryBudgetSpinBox = qt.QSpinBox()
+    self.memoryBudgetSpinBox.setRange(64, 1024*1024)
+    self.memoryBudgetSpinBox.setSuffix(" MB")
+    self.memoryBudgetSpinBox.setValue(self.logic.memoryBudgetMB)
+    self.memoryBudgetSpinBox.toolTip = "Memory used to keep recently viewed volumes decoded."
+    dataFormLayout.addRow("Memory budget: ", self.memoryBudgetSpinBox)
+    self.pyramidCheckBox = qt.QCheckBox()
+    self.pyramidCheckBox.toolTip = "Build downsampled copies of each volume to show while scrubbing."
+    dataFormLayout.addRow("Preview pyramid: ", self.pyramidCheckBox)
+    self.registeredCheckBox = qt.QCheckBox()
+    self.registeredCheckBox.toolTip = "Show the babies in the space of the template (the first one loaded) through their registration transforms."
+    dataFormLayout.addRow("Show registered: ", self.registeredCheckBox)
+    self.sharedWindowCheckBox = qt.QCheckBox()
+    self.sharedWindowCheckBox.toolTip = "Use one window/level for all the babies so their contrast can be compared."
+    dataFormLayout.addRow("Shared window: ", self.sharedWindowCheckBox)
+    self.rescanCheckBox = qt.QCheckBox()
+    self.rescanCheckBox.toolTip = "Look for new and changed files instead of loading a directory seen before from its index."
+    dataFormLayout.addRow("Rescan directory: ", self.rescanCheckBox)
     dataFormLayout.addRow(self.loadButton)
     dataFormLayout.addRow("Data Select", self.dataSlider)
 
     self.loadButton.connect('clicked()', self.onLoad)
+    self.registeredCheckBox.connect('toggled(bool)', self.onShowRegistered)
+    self.sharedWindowCheckBox.connect('toggled(bool)', self.onSharedWindow)
     self.dataSlider.connect('valueChanged(double)', self.onDataSlider)
 
+    #
+    # Mosaic Area
+    #
+    mosaicCollapsibleButton = ctk.ctkCollapsibleButton()
+    mosaicCollapsibleButton.text = "Mosaic"
+    mosaicCollapsibleButton.collapsed = True
+    self.layout.addWidget(mosaicCollapsibleButton)
+    mosaicFormLayout = qt.QFormLayout(mosaicCollapsibleButton)
+
+    # one slice of every loaded baby in a grid, instead of the baby volume
+    self.mosaicCheckBox = qt.QCheckBox()
+    self.mosaicCheckBox.toolTip = "Show the same slice of all the babies side by side."
+    self.orientationComboBox = qt.QComboBox()
+    self.orientationComboBox.addItems(["axial", "coronal", "sagittal"])
+    self.mosaicSlider = ctk.ctkSliderWidget()
+    self.mosaicSlider.setDecimals(1)
+    self.mosaicSlider.enabled = False
+    mosaicFormLayout.addRow("Show mosaic: ", self.mosaicCheckBox)
+    mosaicFormLayout.addRow("Orientation: ", self.orientationComboBox)
+    mosaicFormLayout.addRow("Slice: ", self.mosaicSlider)
+    self.mosaicStatusLabel = qt.QLabel()
+    mosaicFormLayout.addRow("Status: ", self.mosaicStatusLabel)
+
+    self.mosaicCheckBox.connect('toggled(bool)', self.onMosaicToggled)
+    self.orientationComboBox.connect('currentIndexChanged(int)', self.onMosaicOrientation)
+    self.mosaicSlider.connect('valueChanged(double)', self.onMosaicSlider)
+
+    #
+    # Processing Area
+    #
+    processingCollapsibleButton = ctk.ctkCollapsibleButton()
+    processingCollapsibleButton.text = "Processing"
+    processingCollapsibleButton.collapsed = True
+    self.layout.addWidget(processingCollapsibleButton)
+    processingFormLayout = qt.QFormLayout(processingCollapsibleButton)
+
+    # the pipeline runs in the background; the table is refreshed by
+    # a timer and double clicking a row shows that baby's latest output
+    self.runPipelineButton = qt.QPushButton("Run Pipeline")
+    self.runPipelineButton.toolTip = "Bias correct, register and histogram match the loaded babies."
+    self.cancelPipelineButton = qt.QPushButton("Cancel")
+    self.cancelPipelineButton.toolTip = "Stop the running jobs; completed stages are kept."
+    self.cancelPipelineButton.enabled = False
+    self.retryPipelineButton = qt.QPushButton("Retry Failed")
+    self.retryPipelineButton.toolTip = "Run the failed and cancelled babies again from where they stopped."
+    self.retryPipelineButton.enabled = False
+    buttonsLayout = qt.QHBoxLayout()
+    buttonsLayout.addWidget(self.runPipelineButton)
+    buttonsLayout.addWidget(self.cancelPipelineButton)
+    buttonsLayout.addWidget(self.retryPipelineButton)
+    processingFormLayout.addRow(buttonsLayout)
+    self.qualityButton = qt.QPushButton("Check Registrations")
+    self.qualityButton.toolTip = "Score each registered baby against the template and browse the worst first."
+    processingFormLayout.addRow(self.qualityButton)
+    self.resampleCheckBox = qt.QCheckBox()
+    self.resampleCheckBox.checked = self.logic.resampleRegistered
+    self.resampleCheckBox.toolTip = "Also write each registered baby resampled into the template (otherwise only its transform)."
+    processingFormLayout.addRow("Resample registered: ", self.resampleCheckBox)
+    self.inProcessBiasCheckBox = qt.QCheckBox()
+    self.inProcessBiasCheckBox.checked = self.logic.inProcessBiasCorrection
+    self.inProcessBiasCheckBox.toolTip = "Correct bias fields in Slicer's process on shrunk copies of the volumes instead of with the N4ITKBiasFieldCorrection module."
+    processingFormLayout.addRow("In process bias correction: ", self.inProcessBiasCheckBox)
+    self.progressLabel = qt.QLabel()
+    processingFormLayout.addRow("Progress: ", self.progressLabel)
+    self.statusTable = qt.QTableWidget()
+    self.statusTable.setColumnCount(4)
+    self.statusTable.setHorizontalHeaderLabels(["Baby", "Stage", "Status", "Time"])
+    self.statusTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.statusTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    processingFormLayout.addRow(self.statusTable)
+    self.progressTimer = qt.QTimer()
+    self.progressTimer.setInterval(500)
+
+    self.runPipelineButton.connect('clicked()', self.onRunPipeline)
+    self.cancelPipelineButton.connect('clicked()', self.onCancelPipeline)
+    self.retryPipelineButton.connect('clicked()', self.onRetryPipeline)
+    self.qualityButton.connect('clicked()', self.onCheckQuality)
+    self.statusTable.connect('cellDoubleClicked(int,int)', self.onStatusDoubleClicked)
+    self.progressTimer.connect('timeout()', self.onProgressTimer)
+
 
     #
     # Parameters Area
@@ -168,18 +279,151 @@ class BabyBrowserWidget:
     self.layout.addStretch(1)
 
   def cleanup(self):
-    pass
+    self.progressTimer.stop()
 
   def onLoad(self):
-    """Load data with the current path and pattern.  Pattern should include %d.
-    We load from 1 until the file does not exist"""
+    """Load data with the current path and pattern.  Pattern should include %d
+    (files are ordered by its value) or glob wildcards (ordered by name)"""
+    self.logic.setMemoryBudgetMB(self.memoryBudgetSpinBox.value)
+    self.logic.pyramidLevels = 3 if self.pyramidCheckBox.checked else 0
+    self.logic.browseTemplate = None
+    self.logic.sharedWindowLevel = self.sharedWindowCheckBox.checked
+    self.logic.rescanIndex = self.rescanCheckBox.checked
     self.logic.loadBabies(self.pathEdit.currentPath, self.patternEdit.text)
-    self.dataSlider.enabled = len(self.logic.images) !=0
-    self.dataSlider.maximum = len(self.logic.images) - 1
+    self.onShowRegistered(self.registeredCheckBox.checked)
+    self.dataSlider.enabled = len(self.logic.filePaths) !=0
+    self.dataSlider.maximum = len(self.logic.filePaths) - 1
 
   def onDataSlider(self,value):
     self.logic.showBaby(int(value))
 
+  def onMosaicToggled(self,checked):
+    self.mosaicSlider.enabled = checked and len(self.logic.filePaths) != 0
+    if not self.mosaicSlider.enabled:
+      if self.logic.filePaths:
+        self.logic.selectVolume(self.logic.babyVolume())
+      return
+    self.onMosaicOrientation()
+    self.logic.selectVolume(slicer.util.getNode('baby-mosaic'))
+    slicer.app.applicationLogic().FitSliceToAll()
+
+  def onMosaicOrientation(self):
+    """Range the slider over the template baby and show the middle slice"""
+    if not self.mosaicSlider.enabled:
+      return
+    low, high = self.logic.mosaicRange(self.orientationComboBox.currentText)
+    self.mosaicSlider.blockSignals(True)
+    self.mosaicSlider.minimum = low
+    self.mosaicSlider.maximum = high
+    self.mosaicSlider.value = (low + high) / 2.
+    self.mosaicSlider.blockSignals(False)
+    self.onMosaicSlider(self.mosaicSlider.value)
+
+  def onMosaicSlider(self,value):
+    if self.mosaicSlider.enabled:
+      self.logic.showMosaic(value, self.orientationComboBox.currentText)
+      errors = self.logic.mosaicErrors
+      # a baby that could not be read is a blank tile, like one the slice misses
+      self.mosaicStatusLabel.text = '%d unreadable (blank): %s' % (
+        len(errors), ', '.join(os.path.basename(filePath) for filePath in sorted(errors))) if errors else ''
+      self.mosaicStatusLabel.toolTip = '\n'.join('%s: %s' % item for item in sorted(errors.items()))
+
+  def onSharedWindow(self,checked):
+    self.logic.sharedWindowLevel = checked
+    if checked:
+      self.logic.sampleIntensities()
+    if self.logic.filePaths:
+      self.logic.showBaby(int(self.dataSlider.value))
+
+  def onShowRegistered(self,checked):
+    template = self.logic.template if checked and self.logic.filePaths else None
+    self.logic.setBrowseTemplate(template)
+    if self.logic.filePaths:
+      self.logic.showBaby(int(self.dataSlider.value))
+
+  def onRunPipeline(self):
+    """Start the pipeline on the loaded babies without blocking,
+    so finished babies can be browsed while the rest run"""
+    if self.logic.activePipeline or not self.logic.filePaths:
+      return
+    self.logic.resampleRegistered = self.resampleCheckBox.checked
+    self.logic.inProcessBiasCorrection = self.inProcessBiasCheckBox.checked
+    self.pipeline = self.logic.startPipeline()
+    self.onPipelineStarted()
+
+  def onCancelPipeline(self):
+    if self.logic.activePipeline:
+      self.logic.activePipeline.cancel()
+
+  def onRetryPipeline(self):
+    if self.logic.activePipeline or not self.pipeline:
+      return
+    self.logic.activePipeline = self.pipeline
+    self.pipeline.retry()
+    self.onPipelineStarted()
+
+  def onCheckQuality(self):
+    """Score the registrations and move the slider to the worst one"""
+    if not self.logic.filePaths:
+      return
+    scores = self.logic.qualityCheckAll()
+    if not scores:
+      self.progressLabel.text = 'No registered babies to check'
+      return
+    worst = self.logic.filePaths[0]
+    self.progressLabel.text = '%d checked, worst %s (score %.2f)' % (
+      len(scores), os.path.basename(worst), scores[worst]['score'])
+    self.dataSlider.value = 0
+    self.logic.showBaby(0)
+
+  def onPipelineStarted(self):
+    self.runPipelineButton.enabled = False
+    self.retryPipelineButton.enabled = False
+    self.cancelPipelineButton.enabled = True
+    self.onProgressTimer()
+    self.progressTimer.start()
+
+  def onProgressTimer(self):
+    """Refresh the status table, and tidy up once the pipeline is idle"""
+    pipeline = self.pipeline
+    if not pipeline:
+      self.progressTimer.stop()
+      return
+    rows, done, total, eta = pipeline.progress()
+    self.statusTable.setRowCount(len(rows))
+    for row, (subject, stage, status, seconds) in enumerate(rows):
+      cells = (os.path.basename(subject), stage, status,
+               '%.0fs' % seconds if seconds is not None else '')
+      for column, text in enumerate(cells):
+        item = qt.QTableWidgetItem(text)
+        if column == 0:
+          item.setToolTip(subject)
+        self.statusTable.setItem(row, column, item)
+    progress = '%d of %d stages done' % (done, total)
+    if pipeline.isRunning():
+      if eta is not None:
+        progress += ', about %s left' % time.strftime('%H:%M:%S', time.gmtime(eta))
+    else:
+      self.progressTimer.stop()
+      self.logic.finishPipeline(pipeline)
+      self.runPipelineButton.enabled = True
+      self.cancelPipelineButton.enabled = False
+      self.retryPipelineButton.enabled = bool([row for row in rows
+                                                 if row[2] in (CLIJob.FAILED, CLIJob.CANCELLED)])
+    self.progressLabel.text = progress
+
+  def onStatusDoubleClicked(self,row,column):
+    """Show the latest output of the baby in row (or the baby itself)"""
+    pipeline = self.pipeline
+    if not pipeline:
+      return
+    subject = pipeline.progress()[0][row][0]
+    outputPath = pipeline.state[subject]['output']
+    if outputPath == subject and subject in self.logic.filePaths:
+      self.dataSlider.value = self.logic.filePaths.index(subject)
+    elif os.path.exists(outputPath):
+      self.logic.showPath(outputPath)
+
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
@@ -251,6 +495,50 @@ class BabyBrowserWidget:
 # BabyBrowserLogic
 #
 
+def imageBytes(image):
+  """Memory used by the voxels of a vtkImageData"""
+  return image.GetActualMemorySize() * 1024
+
+def imageFromArray(array):
+  """A vtkImageData (unit spacing, zero origin) whose scalars are the
+  memory of array, shaped (k,j,i), without copying it.  The image keeps
+  a reference to the array so it stays valid as long as the image."""
+  from vtk.util import numpy_support
+  flat = array.reshape(-1)
+  scalars = numpy_support.numpy_to_vtk(flat, deep=0)
+  scalars._numpy_reference = flat
+  image = vtk.vtkImageData()
+  image.SetDimensions(array.shape[2], array.shape[1], array.shape[0])
+  if hasattr(image, 'SetScalarType'):
+    image.SetScalarType(scalars.GetDataType())
+    image.SetNumberOfScalarComponents(1)
+  image.GetPointData().SetScalars(scalars)
+  return image
+
+def arrayFromImage(image):
+  """The scalars of image as a (k,j,i) numpy array sharing its memory"""
+  from vtk.util import numpy_support
+  dimensions = image.GetDimensions()
+  array = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars())
+  return array.reshape(dimensions[2], dimensions[1], dimensions[0])
+
+def arrayFromMatrix(matrix):
+  return [[matrix.GetElement(row, column) for column in range(4)] for row in range(4)]
+
+def sourcePath(module):
+  """The .py file of a module (not its compiled form)"""
+  return os.path.splitext(module.__file__)[0] + '.py'
+
+def sourcePaths(*modules):
+  return [sourcePath(module) for module in modules]
+
+def matrixFromArray(array):
+  matrix = vtk.vtkMatrix4x4()
+  for row in range(4):
+    for column in range(4):
+      matrix.SetElement(row, column, array[row][column])
+  return matrix
+
 class BabyBrowserLogic:
   """This class should implement all the actual
   computation done by your module.  The interface
@@ -259,31 +547,210 @@ class BabyBrowserLogic:
   requiring an instance of the Widget
   """
   def __init__(self):
-    self.images = None
-    self.rasToIJK = None
+    # False when run without a GUI (see BabyBrowserLib/Batch.py)
+    self.display = True
+    # timings of reads, display and jobs (see setProfileLog)
+    self.profiler = Profiler.Profiler()
+    self.filePaths = []
+    self.rasToIJKs = {}
+    self.reader = self.archetypeReader()[0]
+    # readers are not shared between the main and prefetch threads
+    self.threadReaders = threading.local()
+    # raw NRRDs are memory mapped rather than read and copied
+    self.useMemoryMapping = True
+    self.headers = Nrrd.HeaderTable()
+    # headers of the files matching the pattern, read in parallel
+    self.discovery = None
+    self.discoveryWorkers = 16
+    # persistent index in the data directory, so a cohort seen before
+    # is loaded from one query; rescanIndex also lists the directory
+    # and stats each file to pick up new and changed ones.  Selection
+    # and order of the slider come from it.
+    self.useIndex = True
+    self.rescanIndex = False
+    self.cohortIndex = None
+    self.selectStages = ()
+    self.selectAttributes = None
+    self.orderBy = 'number'
+    # window and level come from a (low, high) range sampled once per
+    # baby and kept in the index; sharedWindowLevel uses one range for
+    # the whole cohort so contrast stays comparable while scrubbing
+    self.autoWindowLevel = True
+    self.sharedWindowLevel = False
+    self.intensityRanges = {}
+    self.cohortRange = None
+    # set when browsing a packed cohort file (see loadCohort)
+    self.cohortStore = None
+    self.cohortIndices = {}
+    # decoded volumes, least recently used ones dropped over budget
+    self.memoryBudgetMB = 2048
+    self.volumeCache = VolumeCache(self.loadImage, imageBytes,
+                                   self.memoryBudgetMB * 1024 * 1024)
+    # volumes near the slider are decoded in the background, and
+    # showBaby waits for them on a timer rather than blocking
+    self.prefetcher = Prefetcher(self.volumeCache)
+    self.pendingIndex = None
+    self.pendingRequestTime = None
+    self.pendingTimer = qt.QTimer()
+    self.pendingTimer.setInterval(20)
+    self.pendingTimer.connect('timeout()', self.onPendingTimer)
+    # number of downsampled levels to build for previews (0 for none),
+    # and the one shown while the slider moves
+    self.pyramidLevels = 0
+    self.previewLevel = 2
+    self.pyramidMemoryMB = 512
+    # levels are built in the background after loading (see
+    # startPyramids); babies whose levels are still being written
+    # are previewed at full resolution
+    self.pyramidPool = None
+    self.pyramidsBuilding = set()
+    # threads cutting slices for showMosaic, and the size of its grid
+    self.mosaicWorkers = 8
+    self.mosaicMaxPixels = 2048 * 2048
+    # babies whose slice could not be cut for the last mosaic, and why
+    self.mosaicErrors = {}
+    self.refineIndex = None
+    self.refineRequestTime = None
+    self.refineTimer = qt.QTimer()
+    self.refineTimer.setSingleShot(True)
+    self.refineTimer.setInterval(250)
+    self.refineTimer.connect('timeout()', self.onRefineTimer)
+    # directory holding the CLI executables (default is under SLICER_HOME)
+    self.cliModulesDirectory = None
+    # upper bound on concurrent jobs (default is sized to this node)
+    self.maxWorkers = None
+    # rough peak memory of each tool, used to size the job pool
+    self.biasCorrectMemoryMB = 1024
+    self.registerMemoryMB = 2048
+    self.histogramMatchMemoryMB = 512
+    self.qualityMemoryMB = 512
+    # match histograms with numpy instead of the CLI where possible
+    self.inProcessHistogramMatching = True
+    self.histogramMatchers = {}
+    self.histogramMatchersLock = threading.Lock()
+    # estimate and remove bias fields with BiasCorrection instead of
+    # the N4ITKBiasFieldCorrection CLI, several babies per job
+    self.inProcessBiasCorrection = False
+    self.biasCorrectBatchSize = 4
+    self.biasCorrectors = threading.local()
+    # templates loaded once for scoring registrations (see qualityJob)
+    self.qualityReferences = {}
+    self.qualityReferencesLock = threading.Lock()
+    # registration writes the moving volume resampled into the template
+    # as well as the transform; without it only the transform is kept,
+    # and babies are browsed through it (see setBrowseTemplate)
+    self.resampleRegistered = True
+    # the baby the cohort is registered to (and scored against) when no
+    # template is given: the first one loaded, kept while the slider
+    # order changes (see orderByQuality and selectBabies)
+    self.template = None
+    self.browseTemplate = None
+    self.toTemplate = {}
+    self.jobs = []
+    # the pipeline started from the GUI (see startPipeline)
+    self.activePipeline = None
+    # skip jobs whose outputs are up to date (see runJobs)
+    self.useCache = True
+    self.pipelineCaches = {}
 
   def loadBabies(self,directoryPath,pattern,maxIndex=None):
-    self.images = []
-    filePaths = []
-    index = 1
-    import os.path
-    while True:
-      filePath = os.path.join(directoryPath, pattern % index)
-      if not os.path.exists(filePath):
-        break
-      filePaths.append(filePath)
-      index += 1
-      if maxIndex and index > maxIndex:
-        break
+    """Find the babies matching pattern and read their headers.
+    Voxels are only decoded when showBaby needs them (see imageFor)."""
+    self.clear()
+    with self.profiler.timer('discover', directoryPath) as event:
+      volumes = None
+      if self.useIndex:
+        try:
+          volumes = self.indexedVolumes(directoryPath, pattern, maxIndex)
+        except sqlite3.OperationalError as e:
+          # e.g. a read-only or shared data directory: scan it instead
+          print('Not using the cohort index of %s: %s' % (directoryPath, e))
+          if self.cohortIndex:
+            self.cohortIndex.close()
+          self.cohortIndex = None
+      self.discovery = Discovery.CohortDiscovery(directoryPath, pattern, maxIndex,
+                                                 self.discoveryWorkers, volumes)
+      event['volumes'] = len(self.discovery.volumes)
+    if self.discovery.errors() or self.discovery.missingIndices() or self.discovery.mismatches():
+      print(self.discovery.report())
+    infos = self.discovery.readable()
+    filePaths = [info.filePath for info in infos]
 
     if len(filePaths) == 0:
       return
 
-    middleBabyPath = filePaths[len(filePaths)/2]
-    babyVolume = self.babyVolume(middleBabyPath)
+    if self.display:
+      self.babyVolume(filePaths[len(filePaths)/2])
+
+    for info in infos:
+      filePath = info.filePath
+      if info.intensities:
+        self.intensityRanges[filePath] = (info.intensities['low'], info.intensities['high'])
+      if Nrrd.isNrrd(filePath):
+        # the geometry of NRRDs is already known from discovery
+        self.rasToIJKs[filePath] = matrixFromArray(info.rasToIJK())
+        if self.useMemoryMapping and info.mappable:
+          if info.header:
+            self.headers[filePath] = info.header
+          else:
+            self.headers.expect(filePath)
+        continue
+      self.reader.SetArchetype(filePath)
+      self.reader.UpdateInformation()
+      self.rasToIJKs[filePath] = vtk.vtkMatrix4x4()
+      self.rasToIJKs[filePath].DeepCopy(self.reader.GetRasToIjkMatrix())
+    self.filePaths = filePaths
+    if self.template not in filePaths:
+      self.template = filePaths[0]
+    self.prefetcher.setKeys(filePaths)
+    self.loadTransforms()
+    if self.pyramidLevels:
+      self.startPyramids()
+
+  def indexFor(self,directoryPath):
+    """The cohort index kept in directoryPath"""
+    databasePath = os.path.join(directoryPath, '.BabyBrowserIndex.sqlite')
+    if not self.cohortIndex or self.cohortIndex.databasePath != databasePath:
+      if self.cohortIndex:
+        self.cohortIndex.close()
+        self.cohortIndex = None
+      self.cohortIndex = CohortIndex(databasePath)
+    return self.cohortIndex
 
-    #transtor = slicer.vtkMRMLTransformStorageNode()
-    reader = reader = vtkITK.vtkITKArchetypeImageSeriesScalarReader()
+  def indexedVolumes(self,directoryPath,pattern,maxIndex=None):
+    """VolumeInfos of the indexed babies matching pattern, selectStages
+    and selectAttributes, in orderBy order.  The index is brought up
+    to date first unless rescanIndex is False and it already has
+    volumes matching pattern."""
+    index = self.indexFor(directoryPath)
+    if self.rescanIndex or not index.query(directoryPath, pattern, includeErrors=True):
+      index.update(directoryPath, pattern, maxIndex, self.discoveryWorkers,
+                   sampleIntensities=self.autoWindowLevel)
+    rows = index.query(directoryPath, pattern, stages=self.selectStages,
+                       attributes=self.selectAttributes, orderBy=self.orderBy,
+                       includeErrors=True)
+    if maxIndex:
+      if rows and rows[0]['number'] is not None:
+        rows = [row for row in rows if row['number'] <= maxIndex]
+      else:
+        rows = rows[:maxIndex]
+    return [index.info(row) for row in rows]
+
+  def selectBabies(self,stages=(),attributes=None,orderBy='number'):
+    """Browse only the indexed babies with outputs for all of stages
+    and matching attributes (see CohortIndex.query), e.g.
+    selectBabies(('register',), {'age' : (6, 12)}, 'id').
+    Returns the selected file paths."""
+    self.selectStages = tuple(stages)
+    self.selectAttributes = attributes
+    self.orderBy = orderBy
+    if self.discovery:
+      self.loadBabies(self.discovery.directoryPath, self.discovery.pattern)
+    return self.filePaths
+
+  def archetypeReader(self):
+    """Reader and geometry stripper used to decode one volume"""
+    reader = vtkITK.vtkITKArchetypeImageSeriesScalarReader()
     reader.SetSingleFile(1)
     reader.SetUseOrientationFromFile(1)
     #reader.SetDesiredCoordinateOrientationToAxial()
@@ -293,37 +760,478 @@ class BabyBrowserLogic:
     changeInfo.SetInputConnection( reader.GetOutputPort() )
     changeInfo.SetOutputSpacing( 1, 1, 1 )
     changeInfo.SetOutputOrigin( 0, 0, 0 )
-    self.images = {}
+    return reader, changeInfo
+
+  def mappableHeader(self,filePath):
+    """The header of filePath if its voxels can be memory mapped,
+    else None (the archetype reader is used instead)"""
+    if not self.useMemoryMapping or not Nrrd.isNrrd(filePath):
+      return None
+    try:
+      header = Nrrd.readHeader(filePath)
+    except (Nrrd.NrrdError, IOError, ValueError, KeyError):
+      return None
+    return header if header.isMappable() else None
+
+  def loadImage(self,filePath):
+    """Decode the voxels of filePath (geometry is in rasToIJKs).
+    The time taken and bytes decoded go to the profiler as read events
+    (for memory mapped volumes that is the mapping; pages are read when
+    first displayed) and the copy out of the reader as a copy event."""
+    with self.profiler.timer('read', filePath) as event:
+      if filePath in self.cohortIndices:
+        event['source'] = 'cohort'
+        image = imageFromArray(self.cohortStore.readVolume(self.cohortIndices[filePath]))
+      elif filePath in self.headers:
+        event['source'] = 'mapped'
+        image = imageFromArray(Nrrd.readArray(self.headers[filePath]))
+      else:
+        event['source'] = 'reader'
+        if not hasattr(self.threadReaders, 'reader'):
+          self.threadReaders.reader, self.threadReaders.changeInfo = self.archetypeReader()
+        self.threadReaders.reader.SetArchetype(filePath)
+        self.threadReaders.changeInfo.Update()
+        image = vtk.vtkImageData()
+        with self.profiler.timer('copy', filePath) as copyEvent:
+          image.DeepCopy(self.threadReaders.changeInfo.GetOutput())
+          copyEvent['bytes'] = imageBytes(image)
+      event['bytes'] = imageBytes(image)
+    return image
+
+  def exportCohort(self,filePath,chunkShape=(32,32,32)):
+    """Pack the loaded babies (which must all have the same dimensions
+    and scalar type, e.g. after registration) into one chunked and
+    compressed file that loadCohort can reopen quickly."""
+    volumes = (arrayFromImage(self.imageFor(babyPath)) for babyPath in self.filePaths)
+    rasToIJKs = [arrayFromMatrix(self.rasToIJKs[babyPath]) for babyPath in self.filePaths]
+    metadata = [{'filePath' : babyPath} for babyPath in self.filePaths]
+    CohortStore.writeCohort(filePath, volumes, rasToIJKs, metadata, chunkShape)
+
+  def loadCohort(self,filePath):
+    """Browse the babies packed into filePath by exportCohort.
+    Volumes are decompressed when showBaby needs them."""
+    self.clear()
+    # the babies no longer come from a directory, so selectBabies
+    # must not reload the last one
+    self.discovery = None
+    store = CohortStore.CohortStore(filePath)
+    filePaths = []
+    for index in range(len(store)):
+      babyPath = store.metadata[index].get('filePath', '%s:%d' % (filePath, index))
+      filePaths.append(babyPath)
+      self.cohortIndices[babyPath] = index
+      self.rasToIJKs[babyPath] = matrixFromArray(store.rasToIJKs[index])
+    self.cohortStore = store
+    if filePaths and self.display:
+      self.babyVolume(filePaths[len(filePaths)/2])
+    self.filePaths = filePaths
+    if filePaths and self.template not in filePaths:
+      self.template = filePaths[0]
+    self.prefetcher.setKeys(filePaths)
+
+  def clear(self):
+    """Forget the loaded babies"""
+    if self.pyramidPool:
+      # levels of the babies being forgotten are not needed any more
+      self.pyramidPool.cancel()
+    # nothing requested of the old cohort is shown
+    self.pendingIndex = None
+    self.pendingTimer.stop()
+    self.refineIndex = None
+    self.refineTimer.stop()
+    self.filePaths = []
     self.rasToIJKs = {}
-    #self.toTemplate = {}
-    for filePath in filePaths:
-      print("Loading %s" % filePath)
-      reader.SetArchetype(filePath)
-      changeInfo.Update()
-      self.rasToIJKs[filePath] = vtk.vtkMatrix4x4()
-      self.rasToIJKs[filePath].DeepCopy(reader.GetRasToIjkMatrix())
-      self.images[filePath] = vtk.vtkImageData()
-      self.images[filePath].DeepCopy(changeInfo.GetOutput())
-      #t = template
-      #transDir = self.babydir + '/xformsTo' + t[t.find('/')+1:t.find('.')]
-      #id = file[file.rfind('/')+1:file.find('.')]
-      #transtor.SetFileName(transDir + '/' + id + '.mat')
-      #transtor.ReadData(self.transform)
-      #self.toTemplate[file] = vtk.vtkMatrix4x4()
-      #self.toTemplate[file].DeepCopy(self.transform.GetMatrixTransformToParent())
-
-  def showBaby(self,index):
+    self.headers = Nrrd.HeaderTable()
+    if self.cohortStore:
+      self.cohortStore.close()
+    self.cohortStore = None
+    self.cohortIndices = {}
+    self.volumeCache.clear()
+    self.prefetcher.setKeys([])
+    self.toTemplate = {}
+    self.intensityRanges = {}
+    self.cohortRange = None
+
+  def volumeShape(self,filePath):
+    """The (k,j,i) shape of a loaded baby"""
+    if filePath in self.cohortIndices:
+      return self.cohortStore.shape
+    if filePath in self.headers:
+      return self.headers[filePath].shape
+    dimensions = self.imageFor(filePath).GetDimensions()
+    return (dimensions[2], dimensions[1], dimensions[0])
+
+  def slabReader(self,filePath):
+    """A function readSlab(start,stop) giving slices start to stop of
+    a loaded baby, reading as little as its storage allows"""
+    if filePath in self.cohortIndices:
+      store, index = self.cohortStore, self.cohortIndices[filePath]
+      return lambda start, stop: store.readRegion(index, (slice(start,stop), slice(None), slice(None)))
+    if filePath in self.headers or self.isReadableInProcess(filePath):
+      # gzip volumes are decompressed once, as the slabs are read in order
+      return Nrrd.slabReader(self.headers.get(filePath) or Nrrd.readHeader(filePath))
+    return lambda start, stop: arrayFromImage(self.imageFor(filePath))[start:stop]
+
+  def computeStatistics(self,percentiles=(5,50,95),valueRange=None,memoryBudgetMB=None):
+    """Voxelwise mean, variance and percentiles of the loaded babies,
+    which must share one grid (e.g. the outputs of registerAll).
+    The babies are streamed a slab at a time, never all held in memory.
+    The results are shown as volume nodes named baby-mean,
+    baby-variance and baby-p<percentile>, which are returned by name."""
+    if not self.filePaths:
+      return {}
+    shape = self.volumeShape(self.template)
+    mismatched = [filePath for filePath in self.filePaths if self.volumeShape(filePath) != shape]
+    if mismatched:
+      raise ValueError('Babies not on the grid %s of %s: %s' % (shape, self.template, mismatched))
+    statistics = CohortStatistics([self.slabReader(filePath) for filePath in self.filePaths],
+                                  shape, percentiles=percentiles, valueRange=valueRange,
+                                  memoryBudgetMB=memoryBudgetMB or self.memoryBudgetMB)
+    rasToIJK = self.rasToIJKs[self.template]
+    volumeNodes = {}
+    for name, array in statistics.compute().items():
+      volumeNodes[name] = self.publishVolume('baby-%s' % name, array, rasToIJK)
+    return volumeNodes
+
+  def mosaicSlice(self,filePath,orientation,offset):
+    """The slice of a loaded baby nearest offset (mm along the normal
+    of orientation), turned to read like that view, or None if offset
+    is outside it.  It is cut from the decoded volume if cached, else
+    only the slice is read where the storage allows."""
+    rasToIJK = arrayFromMatrix(self.rasToIJKs[filePath])
+    axis, index = Mosaic.sliceIndex(rasToIJK, self.volumeShape(filePath), orientation, offset)
+    if index is None:
+      return None
+    image = self.volumeCache.peek(filePath)
+    if image:
+      sliceArray = Mosaic.takeSlice(arrayFromImage(image), axis, index)
+    elif filePath in self.cohortIndices:
+      sliceArray = self.cohortStore.readSlice(self.cohortIndices[filePath], axis, index)
+    elif filePath in self.headers:
+      sliceArray = Mosaic.takeSlice(Nrrd.readArray(self.headers[filePath]), axis, index)
+    else:
+      sliceArray = Mosaic.takeSlice(arrayFromImage(self.imageFor(filePath)), axis, index)
+    return Mosaic.orientSlice(sliceArray, rasToIJK, axis, orientation)
+
+  def mosaicRange(self,orientation='axial'):
+    """(low, high) offsets covered by the template baby"""
+    filePath = self.template
+    return Mosaic.offsetRange(arrayFromMatrix(self.rasToIJKs[filePath]),
+                              self.volumeShape(filePath), orientation)
+
+  def showMosaic(self,offset=None,orientation='axial',indices=None,columns=None):
+    """Show the same slice of many babies (those at indices, default
+    all) side by side, as the one slice volume baby-mosaic.  offset is
+    in mm along the normal of orientation (default the middle of the
+    first baby).  Slices are cut in parallel and the grid is subsampled
+    to at most mosaicMaxPixels, so it keeps up with a slider even for
+    large cohorts.  Returns the grid array."""
+    if not self.filePaths:
+      return None
+    if offset is None:
+      offset = sum(self.mosaicRange(orientation)) / 2.
+    if indices is None:
+      indices = range(len(self.filePaths))
+    filePaths = [self.filePaths[index] for index in indices]
+    errors = {}
+    with self.profiler.timer('mosaic', orientation, babies=len(filePaths)):
+      slices = Discovery.parallelMap(lambda filePath: self.mosaicSlice(filePath, orientation, offset),
+                                     filePaths, self.mosaicWorkers, errors)
+      grid, step = Mosaic.tile(slices, columns, self.mosaicMaxPixels)
+    self.mosaicErrors = dict((filePaths[position], '%s: %s' % (e.__class__.__name__, e))
+                             for position, e in errors.items())
+    for filePath, error in sorted(self.mosaicErrors.items()):
+      print('Mosaic cannot show %s: %s' % (filePath, error))
+    if self.display:
+      volumeNode = self.publishVolume('baby-mosaic', grid.reshape((1,) + grid.shape),
+                                      matrixFromArray(Mosaic.gridRASToIJK(step)))
+      if self.autoWindowLevel and self.sharedIntensityRange():
+        self.setWindowLevel(volumeNode, self.sharedIntensityRange())
+    return grid
+
+  def imageFor(self,filePath):
+    """The decoded image for filePath, from the volume cache"""
+    return self.volumeCache.get(filePath)
+
+  def setProfileLog(self,logPath):
+    """Also append every profiler event to logPath as a line of JSON"""
+    self.profiler.logPath = logPath
+
+  def profileSummary(self):
+    """Table of the profiled reads, display latencies and jobs"""
+    return self.profiler.summary()
+
+  def setMemoryBudgetMB(self,memoryBudgetMB):
+    """Limit on the memory used by decoded volumes"""
+    self.memoryBudgetMB = memoryBudgetMB
+    self.volumeCache.setBudgetBytes(memoryBudgetMB * 1024 * 1024)
+
+  def showBaby(self,index,wait=False,preview=None,requestTime=None):
     """display the image for the given index.
+    If it is not decoded yet it is shown as soon as the prefetcher
+    has read it, unless wait is True, in which case it is read now.
+    When pyramids have been built, a coarse level is shown at once
+    (unless preview is False) and full resolution follows when the
+    slider has been still for refineTimer's interval.
+    The time from requestTime (default now) until the preview and
+    the full resolution are shown go to the profiler as preview and
+    show events.
     """
-    if not self.images:
+    if not self.filePaths:
       return
-    filePath = self.images.keys()[index]
-    image = self.images[filePath]
+    if requestTime is None:
+      requestTime = time.time()
+    filePath = self.filePaths[index]
+    self.prefetcher.hint(index)
+    if preview is None:
+      preview = not wait
+    previewPath = self.previewPath(filePath) if preview else None
+    if previewPath:
+      self.showTransform(filePath)
+      self.showImage(previewPath, self.imageFor(previewPath))
+      self.applyWindowLevel(filePath)
+      self.profiler.record('preview', filePath, time.time() - requestTime)
+      self.refineIndex = index
+      self.refineRequestTime = requestTime
+      self.refineTimer.start()
+      return
+    image = self.volumeCache.peek(filePath)
+    if not image:
+      if not wait:
+        self.pendingIndex = index
+        self.pendingRequestTime = requestTime
+        self.pendingTimer.start()
+        return
+      image = self.imageFor(filePath)
+    self.pendingIndex = None
+    self.pendingTimer.stop()
+    self.showTransform(filePath)
+    self.showImage(filePath, image)
+    self.applyWindowLevel(filePath, image)
+    self.profiler.record('show', filePath, time.time() - requestTime)
+
+  def showImage(self,filePath,image):
     rasToIJK = self.rasToIJKs[filePath]
-    #toTemplate = self.toTemplate[self.samples[sampleage][which]]
     self.babyVolume().SetRASToIJKMatrix(rasToIJK)
     self.babyVolume().SetAndObserveImageData(image)
-    #self.transform.GetMatrixTransformToParent().DeepCopy(toTemplate)
+
+  def applyWindowLevel(self,filePath,image=None):
+    """Window the baby volume to the range of filePath (sampled from
+    image if it is not known yet), or to the cohort's range"""
+    if not self.autoWindowLevel:
+      return
+    intensityRange = self.intensityRange(filePath, image)
+    if self.sharedWindowLevel:
+      intensityRange = self.sharedIntensityRange() or intensityRange
+    if not intensityRange:
+      return
+    self.setWindowLevel(self.babyVolume(), intensityRange)
+
+  def setWindowLevel(self,volumeNode,intensityRange):
+    window, level = WindowLevel.windowLevel(*intensityRange)
+    displayNode = volumeNode.GetDisplayNode()
+    modifying = displayNode.StartModify()
+    displayNode.SetAutoWindowLevel(False)
+    displayNode.SetWindow(window)
+    displayNode.SetLevel(level)
+    displayNode.EndModify(modifying)
+
+  def intensityRange(self,filePath,image=None):
+    """(low, high) display range of a baby, sampled from image (its
+    decoded voxels) the first time if the index did not have it"""
+    if filePath not in self.intensityRanges and image is not None:
+      intensities = WindowLevel.sampleIntensities(arrayFromImage(image))
+      if intensities:
+        self.setIntensities(filePath, intensities)
+    return self.intensityRanges.get(filePath)
+
+  def setIntensities(self,filePath,intensities):
+    self.intensityRanges[filePath] = (intensities['low'], intensities['high'])
+    self.cohortRange = None
+    if self.cohortIndex:
+      self.cohortIndex.setIntensities(filePath, intensities)
+
+  def sharedIntensityRange(self):
+    """One display range for the loaded babies (see WindowLevel.sharedRange)"""
+    if self.cohortRange is None:
+      self.cohortRange = WindowLevel.sharedRange(self.intensityRanges[filePath]
+                                                 for filePath in self.filePaths
+                                                 if filePath in self.intensityRanges)
+    return self.cohortRange
+
+  def sampleIntensities(self):
+    """Sample, in parallel, the range of the loaded babies that have
+    none yet (e.g. not NRRDs, or loaded without the index)"""
+    missing = [filePath for filePath in self.filePaths if filePath not in self.intensityRanges]
+    def sample(filePath):
+      if filePath in self.cohortIndices:
+        array = self.cohortStore.readVolume(self.cohortIndices[filePath])
+      elif filePath in self.headers:
+        array = Nrrd.readArray(self.headers[filePath])
+      else:
+        array = arrayFromImage(self.imageFor(filePath))
+      return WindowLevel.sampleIntensities(array)
+    for filePath, intensities in zip(missing, Discovery.parallelMap(sample, missing, self.discoveryWorkers)):
+      if intensities:
+        self.setIntensities(filePath, intensities)
+
+  def showTransform(self,filePath):
+    """Drive the 'Baby to Template' transform with the registration of
+    filePath (identity when not browsing registered or it has none).
+    The slice views resample through it as they are drawn, so only
+    the displayed slices are ever resampled."""
+    transform = slicer.util.getNode('Baby to Template')
+    if not transform:
+      return
+    toTemplate = self.toTemplate.get(filePath)
+    if toTemplate:
+      transform.GetMatrixTransformToParent().DeepCopy(toTemplate)
+    else:
+      transform.GetMatrixTransformToParent().Identity()
+
+  def transformPath(self,filePath,template):
+    """Where registering filePath to template writes the transform"""
+    templateRoot = os.path.splitext(os.path.basename(template))[0]
+    return self.derivedPath(filePath,'to_%s' % templateRoot,'.tfm')
+
+  def setBrowseTemplate(self,template):
+    """Show the babies in the space of template (a file path) through
+    the transforms registerAll or the pipeline wrote, instead of
+    needing resampled copies; None shows them as acquired"""
+    self.browseTemplate = template
+    self.loadTransforms()
+
+  def loadTransforms(self):
+    """Read the transform of each loaded baby to browseTemplate"""
+    self.toTemplate = {}
+    if not self.browseTemplate:
+      return
+    missing = []
+    for filePath in self.filePaths:
+      try:
+        transformPath = self.transformPath(filePath, self.browseTemplate)
+        self.toTemplate[filePath] = matrixFromArray(Transforms.readTransform(transformPath))
+      except (IOError, OSError, ValueError, Transforms.TransformError):
+        missing.append(filePath)
+    if missing:
+      print('%d babies have no transform to %s, showing them untransformed' %
+            (len(missing), self.browseTemplate))
+
+  def onRefineTimer(self):
+    """Scrubbing has stopped, so replace the preview with full resolution"""
+    if self.refineIndex is not None and self.refineIndex < len(self.filePaths):
+      self.showBaby(self.refineIndex, preview=False, requestTime=self.refineRequestTime)
+    self.refineIndex = None
+
+  def previewPath(self,filePath):
+    """The pyramid level of filePath used while scrubbing, if it exists"""
+    if not self.pyramidLevels or not self.previewLevel or filePath in self.pyramidsBuilding:
+      return None
+    previewPath = Pyramid.levelPath(filePath, min(self.previewLevel, self.pyramidLevels))
+    if previewPath not in self.headers:
+      header = self.mappableHeader(previewPath) if os.path.exists(previewPath) else None
+      if not header:
+        return None
+      self.headers[previewPath] = header
+      self.rasToIJKs[previewPath] = matrixFromArray(header.rasToIJK())
+    return previewPath
+
+  def pyramidJob(self,filePath,threads=None):
+    """Job writing the pyramid levels of a loaded baby"""
+    levels = self.pyramidLevels
+    def build():
+      header = self.headers.get(filePath)
+      if header:
+        array = Nrrd.readArray(header)
+      else:
+        array = arrayFromImage(self.loadImage(filePath))
+      Pyramid.buildPyramid(filePath, array, arrayFromMatrix(self.rasToIJKs[filePath]), levels)
+    args = [sourcePath(Pyramid), "--levels %d" % levels, filePath]
+    return PythonJob('pyramid %s' % os.path.basename(filePath), build, args, threads,
+                     inputs=[filePath], outputs=Pyramid.levelPaths(filePath, levels),
+                     sources=sourcePaths(Nrrd))
+
+  def buildPyramids(self):
+    """Write any missing or out of date pyramid levels of the loaded babies"""
+    pool = self.jobPool(self.pyramidMemoryMB)
+    jobs = [self.pyramidJob(filePath, pool.threadsPerJob)
+            for filePath in self.filePaths if filePath not in self.cohortIndices]
+    return self.runJobs(pool, jobs)
+
+  def startPyramids(self):
+    """As buildPyramids, but return as soon as the jobs are queued.
+    Until a baby's levels are written previewPath gives None for it,
+    so it is shown at full resolution; finishPyramids waits for them."""
+    pool = self.pyramidPool = self.jobPool(self.pyramidMemoryMB)
+    def jobFinished(job):
+      self.recordJob(job)
+      if job.status == CLIJob.SUCCEEDED:
+        self.pipelineCache(job.outputs[0]).save()
+      self.pyramidsBuilding.discard(job.inputs[0])
+    for filePath in self.filePaths:
+      if filePath in self.cohortIndices:
+        continue
+      job = self.pyramidJob(filePath, pool.threadsPerJob)
+      job.onFinished.append(jobFinished)
+      if self.isUpToDate(job):
+        pool.skip(job)
+      else:
+        # a level being rewritten is not read until it is complete
+        self.pyramidsBuilding.add(filePath)
+        pool.submit(job)
+    return pool
+
+  def finishPyramids(self):
+    """Wait for the levels queued by startPyramids"""
+    pool = self.pyramidPool
+    if not pool:
+      return []
+    pool.wait()
+    self.pyramidPool = None
+    return pool.jobs
+
+  def onPendingTimer(self):
+    """Show the baby requested by showBaby once it has been decoded"""
+    if self.pendingIndex is None:
+      self.pendingTimer.stop()
+      return
+    filePath = self.filePaths[self.pendingIndex]
+    # asked before looking in the cache, so a read finishing in between
+    # is not taken for one that failed
+    loading = self.prefetcher.isLoading(filePath)
+    if filePath in self.volumeCache:
+      self.showBaby(self.pendingIndex, preview=False, requestTime=self.pendingRequestTime)
+    elif not loading:
+      # the read failed, so give up rather than poll forever
+      self.pendingIndex = None
+      self.pendingTimer.stop()
+
+  def createVolumeNode(self,name):
+    """An empty scalar volume node with a grey display node"""
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName(name)
+    slicer.mrmlScene.AddNode(volumeNode)
+    displayNode = slicer.vtkMRMLScalarVolumeDisplayNode()
+    slicer.mrmlScene.AddNode(displayNode)
+    displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeGrey')
+    volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
+    return volumeNode
+
+  def publishVolume(self,name,array,rasToIJK):
+    """Show a (k,j,i) array in the volume node called name"""
+    volumeNode = slicer.util.getNode(name)
+    if not volumeNode:
+      volumeNode = self.createVolumeNode(name)
+    volumeNode.SetRASToIJKMatrix(rasToIJK)
+    volumeNode.SetAndObserveImageData(imageFromArray(array))
+    return volumeNode
+
+  def selectVolume(self,volumeNode):
+    """Show volumeNode in the slice views"""
+    mrmlLogic = slicer.app.applicationLogic()
+    selNode = mrmlLogic.GetSelectionNode()
+    selNode.SetReferenceActiveVolumeID(volumeNode.GetID())
+    mrmlLogic.PropagateVolumeSelection()
 
   def babyVolume(self,filePath=None,name='baby'):
     """Make a volume node as the target for the babys"""
@@ -331,18 +1239,20 @@ class BabyBrowserLogic:
     babyVolume = slicer.util.getNode(name)
     # create the volume for displaying the baby
     if not babyVolume:
-      volumeLogic = slicer.modules.volumes.logic()
-      babyVolume = volumeLogic.AddArchetypeScalarVolume (filePath, "baby", 0, None)
-      displayNode = babyVolume.GetDisplayNode()
+      if filePath and os.path.exists(filePath):
+        volumeLogic = slicer.modules.volumes.logic()
+        babyVolume = volumeLogic.AddArchetypeScalarVolume (filePath, name, 0, None)
+        displayNode = babyVolume.GetDisplayNode()
+      else:
+        # no file to start from (e.g. a packed cohort)
+        babyVolume = self.createVolumeNode(name)
+        displayNode = babyVolume.GetDisplayNode()
+      # showBaby sets window and level from each baby's sampled range,
+      # rather than rescanning every volume swapped in
       displayNode.SetAutoWindowLevel(False)
-      displayNode.SetWindow(470)
-      displayNode.SetLevel(250)
 
       # automatically select the volume to display
-      mrmlLogic = slicer.app.applicationLogic()
-      selNode = mrmlLogic.GetSelectionNode()
-      selNode.SetReferenceActiveVolumeID(babyVolume.GetID())
-      mrmlLogic.PropagateVolumeSelection()
+      self.selectVolume(babyVolume)
 
       # Create transform node
       transform = slicer.vtkMRMLLinearTransformNode()
@@ -351,9 +1261,73 @@ class BabyBrowserLogic:
       babyVolume.SetAndObserveTransformNodeID(transform.GetID())
     return babyVolume
 
-  def biasCorrect(self,filePathIn,filePathOut):
+  def cliPath(self,moduleName):
+    """Path to the executable of a Slicer CLI module"""
+    cliModulesDirectory = self.cliModulesDirectory
+    if not cliModulesDirectory:
+      cliModulesDirectory = os.path.join(os.environ['SLICER_HOME'],"lib/Slicer-4.2/cli-modules")
+    return os.path.join(cliModulesDirectory,moduleName)
+
+  def jobPool(self,memoryPerJobMB):
+    """A pool sized to this node for jobs needing about memoryPerJobMB each.
+    Jobs should be created with threads=pool.threadsPerJob so that each
+    gets its share of the cores rather than every job using them all."""
+    return JobPool(maxWorkers=self.maxWorkers, memoryPerJobMB=memoryPerJobMB)
+
+  def pipelineCache(self,outputPath):
+    """The manifest of the directory outputPath is written to"""
+    outputDir = os.path.dirname(os.path.abspath(outputPath))
+    manifestPath = os.path.join(outputDir,'.BabyBrowserManifest.json')
+    if manifestPath not in self.pipelineCaches:
+      self.pipelineCaches[manifestPath] = PipelineCache(manifestPath)
+    return self.pipelineCaches[manifestPath]
+
+  def isUpToDate(self,job):
+    if getattr(job, 'parts', None):
+      return all(self.isUpToDate(part) for part in job.parts)
+    return self.useCache and job.outputs and self.pipelineCache(job.outputs[0]).isUpToDate(job)
+
+  def recordJob(self,job):
+    """Note the outputs of a job in the manifest if it succeeded, and
+    in the cohort index against the baby it was run for"""
+    if getattr(job, 'parts', None):
+      # a batch is recorded as the jobs it ran, one per baby
+      for part in job.parts:
+        self.recordJob(part)
+      return
+    if job.status != CLIJob.SKIPPED and job.wallTime() is not None:
+      self.profiler.record('job', job.name, job.wallTime(), stage=getattr(job, 'stage', None),
+                           status=job.status, cpuTime=job.cpuTime, peakRSSMB=job.peakRSSMB)
+    if job.status == CLIJob.SUCCEEDED and job.outputs:
+      self.pipelineCache(job.outputs[0]).record(job)
+    subject = getattr(job, 'subject', None)
+    if job.status in (CLIJob.SUCCEEDED, CLIJob.SKIPPED) and job.outputs \
+        and subject and self.cohortIndex:
+      self.cohortIndex.recordOutput(subject, job.stage, job.outputs[0])
+
+  def runJobs(self,pool,jobs):
+    """Run the jobs (returned by the *Job methods) in parallel, print a
+    summary and return the finished jobs.  Jobs whose outputs are up to
+    date with their tool, arguments and inputs are skipped unless
+    useCache is False."""
+    for job in jobs:
+      job.onFinished.append(self.recordJob)
+      if self.isUpToDate(job):
+        pool.skip(job)
+      else:
+        pool.submit(job)
+    pool.wait()
+    for cache in self.pipelineCaches.values():
+      cache.save()
+    print(pool.summary())
+    self.jobs = pool.jobs
+    return pool.jobs
+
+  def biasCorrectJob(self,filePathIn,filePathOut,threads=None):
+    if self.inProcessBiasCorrection and self.isReadableInProcess(filePathIn):
+      return self.biasCorrectPythonJob(filePathIn,filePathOut,threads)
     args = [
-      os.environ['SLICER_HOME']+"/lib/Slicer-4.2/cli-modules/N4ITKBiasFieldCorrection",
+      self.cliPath("N4ITKBiasFieldCorrection"),
       "--inputimage " + filePathIn,
       "--outputimage " + filePathOut,
       "--meshresolution 1,1,1",
@@ -366,29 +1340,53 @@ class BabyBrowserLogic:
       "--wienerfilternoise 0",
       "--nhistogrambins 0",
       ]
-    self.process = subprocess.call(args)
+    return CLIJob('biasCorrect %s' % os.path.basename(filePathIn), args, threads,
+                  inputs=[filePathIn], outputs=[filePathOut])
 
-  def biasCorrectAll(self):
-    """Run the bias corrector on all loaded baby volumes"""
-    for filePath in self.images.keys():
-      print(filePath)
-      fileName = os.path.basename(filePath)
-      fileRoot = os.path.splitext(fileName)[0]
-      origDir = os.path.dirname(filePath)
-      dataDir = os.path.dirname(origDir)
-      correctedDir = os.path.join(dataDir,'corrected')
-      if not os.path.exists(correctedDir):
-        os.mkdir(correctedDir)
-      correctedPath = os.path.join(correctedDir,fileRoot+'.nrrd')
-      print ('running: biasCorrect(%s,%s)' % (filePath,correctedPath))
-      self.biasCorrect(filePath,correctedPath)
+  def biasCorrect(self,filePathIn,filePathOut):
+    return self.biasCorrectJob(filePathIn,filePathOut).run()
 
-  def register(self,filePathFixed,filePathMoving,filePathTransformed,filePathTransform):
+  def biasCorrector(self,threads=None):
+    """This thread's corrector, with the parameters the CLI is run
+    with.  It is kept, so a worker running a batch of babies (see
+    JobBatch) sets SimpleITK up once."""
+    corrector = getattr(self.biasCorrectors, 'corrector', None)
+    if not corrector or corrector.threads != threads:
+      corrector = BiasCorrection.BiasCorrector(shrinkFactor=4, iterations=(500,400,300),
+                                               convergenceThreshold=0.0001, threads=threads)
+      self.biasCorrectors.corrector = corrector
+    return corrector
+
+  def biasCorrectPythonJob(self,filePathIn,filePathOut,threads=None):
+    """Bias correction computed in this process on a shrunk copy of
+    the volume, applied to it a slab at a time"""
+    def correct():
+      self.biasCorrector(threads).correctFile(filePathIn, filePathOut)
+    useSimpleITK = BiasCorrection.sitk is not None
     args = [
-      os.path.join(os.environ['SLICER_HOME'],"lib/Slicer-4.2/cli-modules/BRAINSFitEZ"),
+      sourcePath(BiasCorrection),
+      "--method " + ("N4" if useSimpleITK else "polynomial"),
+      "--iterations 500,400,300",
+      "--convergencethreshold 0.0001",
+      "--shrinkfactor 4",
+      filePathIn,
+      filePathOut,
+      ]
+    return PythonJob('biasCorrect %s' % os.path.basename(filePathIn), correct, args, threads,
+                     inputs=[filePathIn], outputs=[filePathOut],
+                     sources=sourcePaths(Nrrd, Quality))
+
+  def registerJob(self,filePathFixed,filePathMoving,filePathTransformed,filePathTransform,threads=None):
+    """Registration of the moving volume to the fixed one.  Without
+    filePathTransformed only the transform is written."""
+    args = [
+      self.cliPath("BRAINSFitEZ"),
       "--fixedVolume " + filePathFixed,
       "--movingVolume " + filePathMoving,
-      "--outputVolume " + filePathTransformed,
+      ]
+    if filePathTransformed:
+      args.append("--outputVolume " + filePathTransformed)
+    args += [
       "--linearTransform " + filePathTransform,
       "--useRigid",
       "--useAffine",
@@ -419,89 +1417,422 @@ class BabyBrowserLogic:
       "--relaxationFactor 0.5",
       "--maximumStepLength 0.2",
       "--failureExitCode -1",
-      "--numberOfThreads -1",
-      "--forceMINumberOfThreads -1",
+      "--numberOfThreads %d" % (threads or -1),
+      "--forceMINumberOfThreads %d" % (threads or -1),
       "--debugLevel 0",
       "--costFunctionConvergenceFactor 1e+09",
       "--projectedGradientTolerance 0",
       "--costMetric MMI",
       ]
-    self.process = subprocess.call(args)
+    outputs = [filePathTransformed,filePathTransform] if filePathTransformed else [filePathTransform]
+    return CLIJob('register %s' % os.path.basename(filePathMoving), args, threads,
+                  inputs=[filePathFixed,filePathMoving], outputs=outputs)
 
-  def histogramMatch(self,filePathIn,filePathReference,filePathOut):
+  def register(self,filePathFixed,filePathMoving,filePathTransformed,filePathTransform):
+    return self.registerJob(filePathFixed,filePathMoving,filePathTransformed,filePathTransform).run()
+
+  def histogramMatchJob(self,filePathIn,filePathReference,filePathOut,threads=None):
+    if self.inProcessHistogramMatching and self.isReadableInProcess(filePathIn) \
+        and self.isReadableInProcess(filePathReference):
+      return self.histogramMatchPythonJob(filePathIn,filePathReference,filePathOut,threads)
+    args = [
+      self.cliPath("HistogramMatching"),
+      "--numberOfHistogramLevels 128",
+      "--numberOfMatchPoints 10",
+      filePathIn,
+      filePathReference,
+      filePathOut,
+      ]
+    return CLIJob('histogramMatch %s' % os.path.basename(filePathIn), args, threads,
+                  inputs=[filePathIn,filePathReference], outputs=[filePathOut])
+
+  def isReadableInProcess(self,filePath):
+    """True if filePath is a volume the numpy based engines can read"""
+    if not Nrrd.isNrrd(filePath) or not os.path.exists(filePath):
+      return False
+    try:
+      return Nrrd.readHeader(filePath).isReadable()
+    except (Nrrd.NrrdError, IOError, ValueError, KeyError):
+      return False
+
+  def histogramMatcher(self,filePathReference):
+    """Matcher for the reference, computing its quantiles only once"""
+    with self.histogramMatchersLock:
+      if filePathReference not in self.histogramMatchers:
+        reference = Nrrd.readVolume(filePathReference)[0]
+        self.histogramMatchers[filePathReference] = HistogramMatcher(reference,
+                                                                     numberOfHistogramLevels=128,
+                                                                     numberOfMatchPoints=10)
+      return self.histogramMatchers[filePathReference]
+
+  def histogramMatchPythonJob(self,filePathIn,filePathReference,filePathOut,threads=None):
+    """Same result as the HistogramMatching CLI, computed with numpy
+    without starting a process or rereading the reference"""
+    def match():
+      array, header = Nrrd.readVolume(filePathIn)
+      matcher = self.histogramMatcher(filePathReference)
+      Nrrd.writeNrrd(filePathOut, matcher.slabs(array), array.shape, array.dtype,
+                     Nrrd.geometryFields(header))
     args = [
-      os.path.join(os.environ['SLICER_HOME'],"lib/Slicer-4.2/cli-modules/HistogramMatching"),
+      sourcePath(HistogramMatching),
       "--numberOfHistogramLevels 128",
       "--numberOfMatchPoints 10",
       filePathIn,
       filePathReference,
       filePathOut,
       ]
-    self.process = subprocess.call(args)
+    return PythonJob('histogramMatch %s' % os.path.basename(filePathIn), match, args, threads,
+                     inputs=[filePathIn,filePathReference], outputs=[filePathOut],
+                     sources=sourcePaths(Nrrd))
+
+  def histogramMatch(self,filePathIn,filePathReference,filePathOut):
+    return self.histogramMatchJob(filePathIn,filePathReference,filePathOut).run()
+
+  def derivedPath(self,filePath,subdirectory,extension='.nrrd'):
+    """Path for a derived file of filePath in a sibling directory
+    of the one holding filePath"""
+    fileRoot = os.path.splitext(os.path.basename(filePath))[0]
+    dataDir = os.path.dirname(os.path.dirname(filePath))
+    return os.path.join(dataDir,subdirectory,fileRoot+extension)
+
+  def volumeArray(self,filePath):
+    """The (k,j,i) voxels of any volume file, memory mapped if possible"""
+    if self.isReadableInProcess(filePath):
+      return Nrrd.readArray(Nrrd.readHeader(filePath))
+    return arrayFromImage(self.loadImage(filePath))
+
+  def qualityReference(self,template):
+    """Scorer for the template, loading it only once"""
+    with self.qualityReferencesLock:
+      if template not in self.qualityReferences:
+        self.qualityReferences[template] = Quality.Reference(self.volumeArray(template))
+      return self.qualityReferences[template]
+
+  def qualityJob(self,filePathIn,template,filePathOut,threads=None):
+    """Score how well filePathIn (resampled onto the template grid by
+    registration) matches template, writing the scores as JSON"""
+    def check():
+      scores = self.qualityReference(template).score(self.volumeArray(filePathIn))
+      scores.update({'volume' : filePathIn, 'template' : template})
+      with open(filePathOut, 'w') as fp:
+        json.dump(scores, fp, indent=1, sort_keys=True)
+    args = [sourcePath(Quality), filePathIn, template, filePathOut]
+    return PythonJob('qualityCheck %s' % os.path.basename(filePathIn), check, args, threads,
+                     inputs=[filePathIn,template], outputs=[filePathOut],
+                     sources=sourcePaths(Nrrd))
+
+  def qualityPath(self,filePath,template):
+    templateRoot = os.path.splitext(os.path.basename(template))[0]
+    return self.derivedPath(filePath,'qc_%s' % templateRoot,'.json')
+
+  def qualityCheckAll(self,template=None):
+    """Score the registration of every loaded baby to template (see
+    registerAll) and order the babies worst first.  Babies without a
+    resampled registered volume are not scored."""
+    if not template:
+      template = self.template
+    templateRoot = os.path.splitext(os.path.basename(template))[0]
+    pool = self.jobPool(self.qualityMemoryMB)
+    jobs = []
+    for filePath in self.filePaths:
+      registeredPath = self.derivedPath(filePath,'to_%s' % templateRoot)
+      if not os.path.exists(registeredPath):
+        print('no registered volume for %s' % filePath)
+        continue
+      scorePath = self.outputPath(filePath,'qc_%s' % templateRoot,'.json')
+      jobs.append(self.qualityJob(registeredPath,template,scorePath,pool.threadsPerJob))
+      jobs[-1].subject, jobs[-1].stage = filePath, 'qualityCheck'
+    self.runJobs(pool,jobs)
+    return self.orderByQuality(template)
+
+  def qualityScores(self,template=None):
+    """{filePath: scores} of the loaded babies that have been checked
+    against template"""
+    if not template:
+      template = self.template
+    scores = {}
+    for filePath in self.filePaths:
+      try:
+        with open(self.qualityPath(filePath, template)) as fp:
+          scores[filePath] = json.load(fp)
+      except (IOError, OSError, ValueError):
+        pass
+    return scores
+
+  def orderByQuality(self,template=None,metric='score'):
+    """Put the checked babies first, lowest metric (worst) first, so the
+    slider starts at the likely failures.  The scores are also kept as
+    qc_<metric> attributes in the cohort index for selectBabies.
+    Returns the scores."""
+    if not self.filePaths:
+      return {}
+    scores = self.qualityScores(template)
+    if self.cohortIndex:
+      for filePath, score in scores.items():
+        self.cohortIndex.setAttributes(filePath, dict(('qc_' + name, value)
+                                                      for name, value in score.items()
+                                                      if isinstance(value, float)))
+    self.filePaths.sort(key=lambda filePath: (filePath not in scores,
+                                              scores.get(filePath, {}).get(metric, 0)))
+    self.prefetcher.setKeys(self.filePaths)
+    return scores
+
+  def outputPath(self,filePath,subdirectory,extension='.nrrd'):
+    """derivedPath, creating its directory if needed"""
+    outputPath = self.derivedPath(filePath,subdirectory,extension)
+    outputDir = os.path.dirname(outputPath)
+    if not os.path.exists(outputDir):
+      os.mkdir(outputDir)
+    return outputPath
 
   def biasCorrectAll(self):
     """Run the bias corrector on all loaded baby volumes"""
-    for filePath in self.images.keys():
-      print(filePath)
-      fileName = os.path.basename(filePath)
-      fileRoot = os.path.splitext(fileName)[0]
-      origDir = os.path.dirname(filePath)
-      dataDir = os.path.dirname(origDir)
-      correctedDir = os.path.join(dataDir,'corrected')
-      if not os.path.exists(correctedDir):
-        os.mkdir(correctedDir)
-      correctedPath = os.path.join(correctedDir,fileRoot+'.nrrd')
-      print ('running: biasCorrect(%s,%s)' % (filePath,correctedPath))
-      self.biasCorrect(filePath,correctedPath)
+    pool = self.jobPool(self.biasCorrectMemoryMB)
+    jobs = []
+    for filePath in self.filePaths:
+      correctedPath = self.outputPath(filePath,'corrected')
+      print ('queueing: biasCorrect(%s,%s)' % (filePath,correctedPath))
+      jobs.append(self.biasCorrectJob(filePath,correctedPath,pool.threadsPerJob))
+      jobs[-1].subject, jobs[-1].stage = filePath, 'biasCorrect'
+    # babies corrected in process are batched, except those up to date,
+    # in batches no larger than needed to keep every worker busy
+    batched = [job for job in jobs if isinstance(job, PythonJob) and not self.isUpToDate(job)]
+    jobs = [job for job in jobs if job not in batched]
+    size = max(1, min(self.biasCorrectBatchSize, -(-len(batched) // pool.workers)))
+    for first in range(0, len(batched), size):
+      jobs.append(JobBatch('biasCorrect %d babies' % len(batched[first:first + size]),
+                           batched[first:first + size], pool.threadsPerJob))
+    self.runJobs(pool,jobs)
     print('finished')
+    return jobs
 
   def registerAll(self,template=None):
     """Run the registration on all loaded baby volumes.
-    Use template (filePath) if given, else use arbitrary one.
-slicer.modules.BabyBrowserWidget.onReload(); l = slicer.modules.BabyBrowserWidget.logic; slicer.modules.BabyBrowserWidget.onLoad() ; l.registerAll()
+    Use template (filePath) if given, else the logic's template.
+    To run without the GUI, see BabyBrowserLib/Batch.py.
     """
     if not template:
-      template = self.images.keys()[0]
+      template = self.template
     templateRoot = os.path.splitext(os.path.basename(template))[0]
-    for filePath in self.images.keys():
-      print(filePath)
-      fileName = os.path.basename(filePath)
-      fileRoot = os.path.splitext(fileName)[0]
-      origDir = os.path.dirname(filePath)
-      dataDir = os.path.dirname(origDir)
-      transformedDir = os.path.join(dataDir,'to_%s' % templateRoot)
-      if not os.path.exists(transformedDir):
-        os.mkdir(transformedDir)
-      transformedPath = os.path.join(transformedDir,fileRoot+'.nrrd')
-      transformPath = os.path.join(transformedDir,fileRoot+'.tfm')
-      print ('running: registration(%s,%s,%s,%s)' % 
+    pool = self.jobPool(self.registerMemoryMB)
+    jobs = []
+    for filePath in self.filePaths:
+      transformedPath = None
+      if self.resampleRegistered:
+        transformedPath = self.outputPath(filePath,'to_%s' % templateRoot)
+      transformPath = self.outputPath(filePath,'to_%s' % templateRoot,'.tfm')
+      print ('queueing: registration(%s,%s,%s,%s)' %
                   (template,filePath,transformedPath,transformPath))
-      self.register(template,filePath,transformedPath,transformPath)
+      jobs.append(self.registerJob(template,filePath,transformedPath,transformPath,pool.threadsPerJob))
+      jobs[-1].subject, jobs[-1].stage = filePath, 'register'
+    self.runJobs(pool,jobs)
     print('finished')
+    return jobs
 
   def histogramMatchAll(self,reference=None):
     """Run a histogram match on all images.
-    Use reference (filePath) if given, else use arbitrary one.
-  
-slicer.modules.BabyBrowserWidget.onReload(); l = slicer.modules.BabyBrowserWidget.logic; slicer.modules.BabyBrowserWidget.onLoad(); l.histogramMatchAll('/Users/pieper/data/babybrains/to_mprage-19/mprage-19.nrrd')
+    Use reference (filePath) if given, else the logic's template.
+    To run without the GUI, see BabyBrowserLib/Batch.py.
     """
     if not reference:
-      reference = self.images.keys()[0]
+      reference = self.template
     referenceRoot = os.path.splitext(os.path.basename(reference))[0]
-    for filePath in self.images.keys():
-      print(filePath)
-      fileName = os.path.basename(filePath)
-      fileRoot = os.path.splitext(fileName)[0]
-      origDir = os.path.dirname(filePath)
-      dataDir = os.path.dirname(origDir)
-      matchedDir = os.path.join(dataDir,'to_%s-Matched' % referenceRoot)
-      if not os.path.exists(matchedDir):
-        os.mkdir(matchedDir)
-      matchedPath = os.path.join(matchedDir,fileRoot+'.nrrd')
-      print ('running: histogramMatch(%s,%s,%s)' % 
+    pool = self.jobPool(self.histogramMatchMemoryMB)
+    jobs = []
+    for filePath in self.filePaths:
+      matchedPath = self.outputPath(filePath,'to_%s-Matched' % referenceRoot)
+      print ('queueing: histogramMatch(%s,%s,%s)' %
                   (filePath,reference,matchedPath))
-      self.histogramMatch(filePath,reference,matchedPath)
+      jobs.append(self.histogramMatchJob(filePath,reference,matchedPath,pool.threadsPerJob))
+      jobs[-1].subject, jobs[-1].stage = filePath, 'histogramMatch'
+    self.runJobs(pool,jobs)
     print('finished')
+    return jobs
+
+  def defaultStages(self):
+    """The stages of runPipeline: when registration writes only the
+    transform its output cannot feed histogram matching, so it is last"""
+    if self.resampleRegistered:
+      return ('biasCorrect','register','histogramMatch')
+    return ('biasCorrect','histogramMatch','register')
+
+  def pipelineStages(self,stages,template,reference):
+    """(name, makeJob) pairs for the named stages, writing to the same
+    directories as biasCorrectAll, registerAll and histogramMatchAll"""
+    templateRoot = os.path.splitext(os.path.basename(template))[0]
+    referenceRoot = os.path.splitext(os.path.basename(reference))[0]
+    def biasCorrect(filePath,threads):
+      return self.biasCorrectJob(filePath, self.outputPath(filePath,'corrected'), threads)
+    def register(filePath,threads):
+      transformedPath = None
+      if self.resampleRegistered:
+        transformedPath = self.outputPath(filePath,'to_%s' % templateRoot)
+      return self.registerJob(template, filePath, transformedPath,
+                              self.outputPath(filePath,'to_%s' % templateRoot,'.tfm'), threads)
+    def histogramMatch(filePath,threads):
+      return self.histogramMatchJob(filePath, reference,
+                                    self.outputPath(filePath,'to_%s-Matched' % referenceRoot), threads)
+    def qualityCheck(filePath,threads):
+      return self.qualityJob(filePath, template,
+                             self.outputPath(filePath,'qc_%s' % templateRoot,'.json'), threads)
+    makers = {
+      'biasCorrect' : biasCorrect,
+      'register' : register,
+      'histogramMatch' : histogramMatch,
+      'qualityCheck' : qualityCheck,
+      }
+    # stages whose output is not a volume the next stage could take
+    final = ['qualityCheck'] if self.resampleRegistered else ['qualityCheck', 'register']
+    for stage in stages[:-1]:
+      if stage in final:
+        raise ValueError('%s must be the last stage' % stage)
+    return [(stage, makers[stage]) for stage in stages]
+
+  def runPipeline(self,template=None,reference=None,stages=None):
+    """Run the stages on each loaded baby, each baby moving on to its
+    next stage as soon as it is done with the previous one.
+    Progress is kept next to the data, so rerunning after a crash
+    picks up where it stopped.  Returns the Pipeline, whose outputs()
+    are the final volumes and failures() the babies that failed.
+    """
+    pipeline = self.startPipeline(template,reference,stages)
+    if pipeline:
+      pipeline.pool.wait()
+      self.finishPipeline(pipeline)
+    return pipeline
+
+  def startPipeline(self,template=None,reference=None,stages=None):
+    """As runPipeline, but return as soon as the jobs are queued so the
+    GUI stays responsive; poll the returned Pipeline's progress() and
+    call finishPipeline once its isRunning() is False."""
+    if not self.filePaths:
+      return None
+    if not template:
+      template = self.template
+    if not reference:
+      reference = template
+    if not stages:
+      stages = self.defaultStages()
+    memoryMB = {
+      'biasCorrect' : self.biasCorrectMemoryMB,
+      'register' : self.registerMemoryMB,
+      'histogramMatch' : self.histogramMatchMemoryMB,
+      'qualityCheck' : self.qualityMemoryMB,
+      }
+    pool = self.jobPool(max([memoryMB[stage] for stage in stages]))
+    statePath = self.pipelineStatePath()
+    key = repr((list(stages), template, reference))
+    def jobFinished(job):
+      self.recordJob(job)
+      print('%s %s' % (job.status, job.name))
+    batchSizes = {'biasCorrect' : self.biasCorrectBatchSize} if self.inProcessBiasCorrection else {}
+    pipeline = Pipeline(pool, self.pipelineStages(stages,template,reference),
+                        statePath=statePath, key=key,
+                        isUpToDate=self.isUpToDate, onJobFinished=jobFinished,
+                        batchSizes=batchSizes)
+    self.activePipeline = pipeline
+    pipeline.start(self.filePaths)
+    return pipeline
+
+  def pipelineStatePath(self):
+    """Where startPipeline keeps its progress: in the directory of the
+    loaded babies, one file per pattern (or packed cohort), so cohorts
+    sharing a directory or its parent do not resume each other"""
+    if self.cohortStore:
+      directoryPath, pattern = os.path.split(os.path.abspath(self.cohortStore.filePath))
+    elif self.discovery:
+      directoryPath, pattern = self.discovery.directoryPath, self.discovery.pattern
+    else:
+      directoryPath, pattern = os.path.dirname(self.filePaths[0]), ''
+    name = '.BabyBrowserPipeline-%s.json' % hashlib.sha1(pattern.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(directoryPath, name)
+
+  def finishPipeline(self,pipeline):
+    """Save the manifests and report the jobs of a finished pipeline"""
+    for cache in self.pipelineCaches.values():
+      cache.save()
+    print(pipeline.pool.summary())
+    self.jobs = pipeline.pool.jobs
+    if self.activePipeline is pipeline:
+      self.activePipeline = None
+
+  def showPath(self,filePath):
+    """Display a volume that is not one of the loaded babies, such as
+    a pipeline output of one of them"""
+    # the pipeline may have rewritten it since it was last shown
+    self.volumeCache.discard(filePath)
+    header = self.mappableHeader(filePath)
+    if header:
+      self.headers[filePath] = header
+      self.rasToIJKs[filePath] = matrixFromArray(header.rasToIJK())
+    else:
+      self.headers.pop(filePath, None)
+      self.reader.SetArchetype(filePath)
+      self.reader.UpdateInformation()
+      self.rasToIJKs[filePath] = vtk.vtkMatrix4x4()
+      self.rasToIJKs[filePath].DeepCopy(self.reader.GetRasToIjkMatrix())
+    self.showImage(filePath, self.imageFor(filePath))
+
+  def distributePipeline(self,queueDirectory,template=None,reference=None,
+                         stages=None,wait=True,pollSeconds=5):
+    """Queue the stages of each loaded baby in queueDirectory (on
+    storage shared with the worker nodes, see BabyBrowserLib/WorkQueue.py)
+    instead of running them here.  Babies whose outputs are all up to
+    date are not queued.  With wait, block until the workers are done,
+    then record their outputs as runPipeline does; returns the WorkQueue."""
+    if not template:
+      template = self.template
+    if not reference:
+      reference = template
+    if not stages:
+      stages = self.defaultStages()
+    if 'qualityCheck' in stages:
+      raise ValueError('qualityCheck runs in process; use qualityCheckAll once the workers are done')
+    workQueue = WorkQueue.WorkQueue(queueDirectory)
+    # workers run command lines, so stages cannot be computed in process
+    inProcessHistogramMatching = self.inProcessHistogramMatching
+    inProcessBiasCorrection = self.inProcessBiasCorrection
+    self.inProcessHistogramMatching = False
+    self.inProcessBiasCorrection = False
+    try:
+      stageMakers = self.pipelineStages(stages,template,reference)
+      for number, filePath in enumerate(self.filePaths):
+        inputPath = filePath
+        jobs = []
+        for stage, makeJob in stageMakers:
+          job = makeJob(inputPath, None)
+          job.stage = stage
+          jobs.append(job)
+          inputPath = job.outputs[0]
+        if all(self.isUpToDate(job) for job in jobs):
+          continue
+        taskId = '%05d-%s' % (number, os.path.basename(filePath).split('.')[0])
+        workQueue.put(taskId, {'subject' : filePath,
+                               'jobs' : [WorkQueue.jobSpec(job) for job in jobs]})
+    finally:
+      self.inProcessHistogramMatching = inProcessHistogramMatching
+      self.inProcessBiasCorrection = inProcessBiasCorrection
+    def progress(counts):
+      print('%(pending)d pending, %(running)d running, %(done)d done, %(failed)d failed' % counts)
+    if wait:
+      workQueue.wait(pollSeconds, onPoll=progress)
+      self.collectDistributed(workQueue)
+    return workQueue
+
+  def collectDistributed(self,workQueue):
+    """Record the jobs finished by workers in the manifests and index"""
+    for task in workQueue.results('done') + workQueue.results('failed'):
+      for spec, result in zip(task['jobs'], task.get('result', {}).get('jobs', [])):
+        job = WorkQueue.jobFromSpec(spec)
+        job.status = result['status']
+        job.subject = task['subject']
+        self.recordJob(job)
+        if result.get('wallTime') is not None:
+          self.profiler.record('job', job.name, result['wallTime'], stage=job.stage,
+                               status=job.status, cpuTime=result.get('cpuTime'),
+                               peakRSSMB=result.get('peakRSSMB'), worker=task.get('worker'))
+    for cache in self.pipelineCaches.values():
+      cache.save()
 
 class BabyBrowserTest(unittest.TestCase):
   """
@@ -535,6 +1866,40 @@ class BabyBrowserTest(unittest.TestCase):
     """
     self.setUp()
     self.test_BabyBrowser1()
+    self.setUp()
+    self.test_JobPool()
+    self.setUp()
+    self.test_NrrdMapping()
+    self.setUp()
+    self.test_CohortIndex()
+    self.setUp()
+    self.test_VolumeCache()
+    self.setUp()
+    self.test_Prefetcher()
+    self.setUp()
+    self.test_CohortStore()
+    self.setUp()
+    self.test_CohortStatistics()
+    self.setUp()
+    self.test_Pyramid()
+    self.setUp()
+    self.test_Discovery()
+    self.setUp()
+    self.test_Batch()
+    self.setUp()
+    self.test_Profiler()
+    self.setUp()
+    self.test_PipelineControl()
+    self.setUp()
+    self.test_PipelineCache()
+    self.setUp()
+    self.test_HistogramMatching()
+    self.setUp()
+    self.test_BiasCorrection()
+    self.setUp()
+    self.test_WorkQueue()
+    self.setUp()
+    self.test_Mosaic()
 
   def test_BabyBrowser1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -550,24 +1915,866 @@ class BabyBrowserTest(unittest.TestCase):
 
     self.delayDisplay("Starting the test")
     #
-    # first, get some data
+    # first, make some data (synthetic, so the test runs offline)
     #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        print('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        print('Loading %s...\n' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading\n')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    import shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserCohort')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    dataPath = os.path.join(directoryPath, 'raw')
+    filePaths = Benchmark.writeCohort(dataPath, 4, shape=(20,24,28))
+    cliPath = Benchmark.writeStandIns(os.path.join(directoryPath, 'cli'))
+    self.delayDisplay('Finished making the data\n')
+
+    logic = BabyBrowserLogic()
+    logic.loadBabies(dataPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, filePaths)
+    for index in range(len(filePaths)):
+      logic.showBaby(index, wait=True)
+      volumeNode = slicer.util.getNode('baby')
+      self.assertTrue(volumeNode.GetImageData())
+      self.assertEqual(volumeNode.GetImageData().GetDimensions(), (28,24,20))
+
+    # the display range of each baby was sampled when it was indexed
+    self.assertEqual(sorted(logic.intensityRanges.keys()), sorted(filePaths))
+    displayNode = slicer.util.getNode('baby').GetDisplayNode()
+    window, level = WindowLevel.windowLevel(*logic.intensityRanges[filePaths[-1]])
+    self.assertAlmostEqual(displayNode.GetWindow(), window, 3)
+    logic.sharedWindowLevel = True
+    logic.showBaby(0, wait=True)
+    window, level = WindowLevel.windowLevel(*logic.sharedIntensityRange())
+    self.assertAlmostEqual(displayNode.GetLevel(), level, 3)
+    logic.sharedWindowLevel = False
+
+    # the whole pipeline, with stand-ins for the CLI modules
+    logic.cliModulesDirectory = cliPath
+    pipeline = logic.runPipeline()
+    self.assertEqual(pipeline.failures(), {})
+    # its progress is kept with the babies, apart from other patterns'
+    self.assertTrue(os.path.exists(logic.pipelineStatePath()))
+    self.assertEqual(os.path.dirname(logic.pipelineStatePath()), dataPath)
+    self.assertEqual(len(pipeline.outputs()), len(filePaths))
+    for output in pipeline.outputs().values():
+      self.assertTrue(os.path.exists(output))
+
+    # browse through the transforms instead of resampled copies
+    logic.resampleRegistered = False
+    job = logic.registerJob(filePaths[0], filePaths[1], None, logic.transformPath(filePaths[1], filePaths[0]))
+    self.assertEqual(job.outputs, [logic.transformPath(filePaths[1], filePaths[0])])
+    self.assertFalse([arg for arg in job.args if arg.startswith('--outputVolume')])
+    logic.setBrowseTemplate(filePaths[0])
+    self.assertEqual(sorted(logic.toTemplate.keys()), sorted(filePaths))
+    logic.showBaby(1, wait=True)
+    toTemplate = slicer.util.getNode('Baby to Template').GetMatrixTransformToParent()
+    self.assertEqual([toTemplate.GetElement(row, row) for row in range(4)], [1,1,1,1])
+
+    # score the registrations: the template matches itself best, so it is last
+    scores = logic.qualityCheckAll()
+    self.assertEqual(sorted(scores.keys()), sorted(filePaths))
+    self.assertAlmostEqual(scores[filePaths[0]]['ncc'], 1)
+    self.assertEqual(logic.filePaths[-1], filePaths[0])
+    self.assertTrue(scores[logic.filePaths[0]]['score'] < scores[filePaths[0]]['score'])
+    # reordering the slider keeps the template, so checking again finds the same scores
+    self.assertEqual(logic.template, filePaths[0])
+    self.assertEqual(sorted(logic.qualityCheckAll().keys()), sorted(filePaths))
+    self.assertEqual(logic.filePaths[-1], filePaths[0])
+    self.delayDisplay('Test passed!')
+
+  def test_JobPool(self):
+    """Run a few trivial commands through the job pool and check
+    that exit codes and failures are reported per job"""
+    self.delayDisplay("Starting the job pool test")
+    pool = JobPool(maxWorkers=2)
+    ok = pool.submit(CLIJob('ok', ['true'], pool.threadsPerJob))
+    bad = pool.submit(CLIJob('bad', ['false'], pool.threadsPerJob))
+    missing = pool.submit(CLIJob('missing', ['/no/such/cli'], pool.threadsPerJob))
+    pool.wait()
+    self.assertEqual(ok.status, CLIJob.SUCCEEDED)
+    self.assertEqual(bad.returnCode, 1)
+    self.assertEqual(missing.returnCode, None)
+    self.assertEqual(len(pool.failures()), 2)
+    self.assertTrue(ok.wallTime() >= 0)
+    # idle workers exit rather than wait for jobs that will not come
+    deadline = time.time() + 10
+    while pool.threads and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(pool.threads, [])
+    again = pool.submit(CLIJob('again', ['true'], pool.threadsPerJob))
+    pool.wait()
+    self.assertEqual(again.status, CLIJob.SUCCEEDED)
+    # cancelling stops the running process and the queued job
+    pool = JobPool(maxWorkers=1)
+    slow = pool.submit(CLIJob('slow', ['sleep', '30'], pool.threadsPerJob))
+    queued = pool.submit(CLIJob('queued', ['true'], pool.threadsPerJob))
+    while slow.process is None:
+      time.sleep(0.01)
+    pool.cancel()
+    pool.wait()
+    self.assertEqual(slow.status, CLIJob.CANCELLED)
+    self.assertEqual(queued.status, CLIJob.CANCELLED)
+    self.assertTrue(slow.wallTime() < 30)
+    self.assertEqual(len(pool.failures()), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_NrrdMapping(self):
+    """Write a small raw NRRD and check that the memory mapped
+    image and geometry match what the archetype reader gives"""
+    self.delayDisplay("Starting the memory mapping test")
+    import numpy
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserMapping')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    filePath = os.path.join(directoryPath, 'baby-1.nrrd')
+    array = numpy.arange(4*5*6, dtype='int16').reshape(6,5,4)
+    fp = open(filePath, 'wb')
+    fp.write(b'NRRD0004\ntype: short\ndimension: 3\nspace: left-posterior-superior\n')
+    fp.write(b'sizes: 4 5 6\nspace directions: (0.9,0,0) (0,0,1.1) (0,-1.2,0)\n')
+    fp.write(b'kinds: domain domain domain\nendian: little\nencoding: raw\n')
+    fp.write(b'space origin: (10,-20,30)\n\n')
+    fp.write(array.tostring())
+    fp.close()
+
+    logic = BabyBrowserLogic()
+    logic.loadBabies(directoryPath, 'baby-%d.nrrd')
+    self.assertTrue(filePath in logic.headers)
+    mapped = logic.imageFor(filePath)
+    rasToIJK = logic.rasToIJKs[filePath]
+
+    logic.useMemoryMapping = False
+    logic.loadBabies(directoryPath, 'baby-%d.nrrd')
+    self.assertFalse(filePath in logic.headers)
+    read = logic.imageFor(filePath)
+    self.assertEqual(mapped.GetDimensions(), read.GetDimensions())
+    from vtk.util import numpy_support
+    mappedArray = numpy_support.vtk_to_numpy(mapped.GetPointData().GetScalars())
+    readArray = numpy_support.vtk_to_numpy(read.GetPointData().GetScalars())
+    self.assertTrue((mappedArray == readArray).all())
+    for row in range(4):
+      for column in range(4):
+        self.assertAlmostEqual(rasToIJK.GetElement(row,column),
+                               logic.rasToIJKs[filePath].GetElement(row,column), 4)
+    self.delayDisplay('Test passed!')
+
+  def test_CohortIndex(self):
+    """A directory seen before loads from its index, rescanning finds
+    new files, and a deleted file takes what was known of it along"""
+    self.delayDisplay("Starting the cohort index test")
+    import shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserIndex')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    filePaths = Benchmark.writeCohort(directoryPath, 3, shape=(8,9,10))
+
+    logic = BabyBrowserLogic()
+    logic.display = False
+    logic.loadBabies(directoryPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, filePaths)
+    newPath = Benchmark.writeCohort(directoryPath, 4, shape=(8,9,10))[-1]
+    logic.loadBabies(directoryPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, filePaths)
+    logic.rescanIndex = True
+    logic.loadBabies(directoryPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, filePaths + [newPath])
+
+    logic.cohortIndex.recordOutput(newPath, 'biasCorrect', newPath)
+    logic.cohortIndex.setAttributes(newPath, {'age' : 3})
+    os.remove(newPath)
+    logic.loadBabies(directoryPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, filePaths)
+    self.assertEqual(logic.cohortIndex.outputs(newPath), {})
+    self.assertEqual(logic.cohortIndex.attributes(newPath), {})
+    # a pattern nothing indexed matches yet is indexed without rescanIndex
+    logic.rescanIndex = False
+    otherPaths = Benchmark.writeCohort(directoryPath, 2, shape=(8,9,10), pattern='other-%d.nrrd')
+    logic.loadBabies(directoryPath, 'other-%d.nrrd')
+    self.assertEqual(logic.filePaths, otherPaths)
+
+    # compressed volumes are not decoded to index them; their range
+    # is sampled when they are first shown
+    gzipPath = os.path.join(directoryPath, 'gzip')
+    gzipPaths = Benchmark.writeCohort(gzipPath, 2, shape=(8,9,10), encoding='gzip')
+    logic.loadBabies(gzipPath, 'mprage-%d.nrrd')
+    self.assertEqual(logic.filePaths, gzipPaths)
+    self.assertEqual(logic.intensityRanges, {})
+    self.assertEqual(logic.cohortIndex.volume(gzipPaths[0])['low'], None)
+    logic.showBaby(0, wait=True)
+    self.assertEqual(logic.intensityRanges.keys(), [gzipPaths[0]])
+    self.assertNotEqual(logic.cohortIndex.volume(gzipPaths[0])['low'], None)
+    self.delayDisplay('Test passed!')
+
+  def test_VolumeCache(self):
+    """The least recently used volumes are dropped to stay within the
+    byte budget, but the one just used is always kept"""
+    self.delayDisplay("Starting the volume cache test")
+    loads = []
+    def load(key):
+      loads.append(key)
+      return key * 10
+    cache = VolumeCache(load, len, 25)
+    for key in 'abc':
+      cache.get(key)
+    self.assertEqual(loads, ['a', 'b', 'c'])
+    self.assertFalse('a' in cache)
+    self.assertEqual(cache.totalBytes, 20)
+    # using b makes c the one to go
+    cache.get('b')
+    cache.get('d')
+    self.assertTrue('b' in cache)
+    self.assertFalse('c' in cache)
+    self.assertEqual(loads, ['a', 'b', 'c', 'd'])
+    # peek neither loads nor counts as a use
+    self.assertEqual(cache.peek('c'), None)
+    self.assertEqual(cache.peek('b'), 'b' * 10)
+    cache.get('e')
+    self.assertFalse('b' in cache)
+    self.assertTrue('d' in cache)
+    cache.setBudgetBytes(5)
+    self.assertEqual(len(cache), 1)
+    self.assertTrue('e' in cache)
+    self.assertEqual(cache.totalBytes, 10)
+    cache.discard('e')
+    self.assertEqual((len(cache), cache.totalBytes), (0, 0))
+    self.delayDisplay('Test passed!')
+
+  def test_Prefetcher(self):
+    """Reads go ahead of the slider in the direction it moves, further
+    the faster it moves, and reads it has moved away from are dropped"""
+    self.delayDisplay("Starting the prefetcher test")
+    keys = ['baby-%d' % index for index in range(20)]
+    loads = []
+    gate = threading.Event()
+    def load(key):
+      loads.append(key)
+      gate.wait()
+      return key
+    prefetcher = Prefetcher(VolumeCache(load, len, 1000))
+    prefetcher.setKeys(keys)
+    self.assertEqual(prefetcher.predict(0), [1])
+    prefetcher.velocity = -3.
+    self.assertEqual(prefetcher.predict(10), [9, 11])
+    self.assertEqual(prefetcher.predict(0), [1])
+    prefetcher.velocity = 0.
+
+    def waitFor(condition):
+      deadline = time.time() + 10
+      while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+      self.assertTrue(condition())
+    prefetcher.hint(0, now=0.)
+    waitFor(lambda: loads == ['baby-0'])
+    self.assertTrue(prefetcher.isLoading('baby-1'))
+    # a jump of 10 in 0.1s reads four ahead, and baby-1 is not wanted now
+    prefetcher.hint(10, now=0.1)
+    self.assertEqual(prefetcher.pending, ['baby-%d' % index for index in (10, 11, 12, 13, 14, 9)])
+    self.assertFalse(prefetcher.isLoading('baby-1'))
+    self.assertTrue(prefetcher.isLoading('baby-0'))
+    gate.set()
+    waitFor(lambda: not prefetcher.isLoading('baby-9') and 'baby-9' in prefetcher.cache)
+    self.assertEqual(loads, ['baby-%d' % index for index in (0, 10, 11, 12, 13, 14, 9)])
+    self.delayDisplay('Test passed!')
+
+  def test_CohortStore(self):
+    """Volumes packed into a cohort file read back exactly, whole or
+    by region and slice, with their geometry and metadata"""
+    self.delayDisplay("Starting the cohort store test")
+    import numpy
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserStore')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    storePath = os.path.join(directoryPath, 'cohort.bbc')
+    # chunks that do not divide the shape
+    shape = (9, 10, 11)
+    volumes = [numpy.random.RandomState(seed).randint(-500, 3000, shape).astype('int16')
+               for seed in range(3)]
+    rasToIJKs = [numpy.diag([-1., -1., 1. + seed, 1.]) for seed in range(3)]
+    metadata = [{'filePath' : 'baby-%d.nrrd' % seed} for seed in range(3)]
+    CohortStore.writeCohort(storePath, iter(volumes), rasToIJKs, metadata, chunkShape=(4,4,4))
+    store = CohortStore.CohortStore(storePath)
+    self.assertEqual((len(store), store.shape, store.dtype), (3, shape, numpy.dtype('int16')))
+    self.assertEqual(store.metadata, metadata)
+    for subject, volume in enumerate(volumes):
+      self.assertTrue((store.readVolume(subject) == volume).all())
+      self.assertTrue((store.rasToIJKs[subject] == rasToIJKs[subject]).all())
+    self.assertTrue((store.readRegion(1, (slice(3,9), slice(0,1), slice(5,11)))
+                     == volumes[1][3:9,0:1,5:11]).all())
+    for axis in range(3):
+      self.assertTrue((store.readSlice(2, axis, 4) == volumes[2].take(4, axis)).all())
+    store.close()
+    self.assertRaises(CohortStore.CohortStoreError, CohortStore.writeCohort,
+                      storePath, [volumes[0], volumes[1][:-1]], rasToIJKs[:2])
+
+    # the logic packs the loaded babies and browses them from the file
+    dataPath = os.path.join(directoryPath, 'raw')
+    filePaths = Benchmark.writeCohort(dataPath, 2, shape=(8,9,10))
+    logic = BabyBrowserLogic()
+    logic.display = False
+    logic.loadBabies(dataPath, 'mprage-%d.nrrd')
+    logic.exportCohort(storePath, chunkShape=(4,4,4))
+    logic.loadCohort(storePath)
+    self.assertEqual(logic.filePaths, filePaths)
+    self.assertEqual(logic.selectBabies(), filePaths)
+    self.assertTrue(filePaths[0] in logic.cohortIndices)
+    for filePath in filePaths:
+      packed = arrayFromImage(logic.imageFor(filePath))
+      self.assertTrue((packed == Nrrd.readArray(Nrrd.readHeader(filePath))).all())
+    self.delayDisplay('Test passed!')
+
+  def test_CohortStatistics(self):
+    """Mean and variance match numpy, and percentiles are within a
+    histogram bin of it, however many slabs the volumes are read in"""
+    self.delayDisplay("Starting the cohort statistics test")
+    import numpy
+    shape = (5, 6, 7)
+    random = numpy.random.RandomState(0)
+    volumes = [random.uniform(0, 1000, shape).astype('float32') for subject in range(7)]
+    stack = numpy.array(volumes, dtype='float64')
+    def reader(volume):
+      return lambda start, stop: volume[start:stop]
+    # a tiny budget reads one slice at a time
+    for memoryBudgetMB in (512, 0.001):
+      statistics = CohortStatistics([reader(volume) for volume in volumes], shape,
+                                    percentiles=(50,), bins=100, valueRange=(0., 1000.),
+                                    memoryBudgetMB=memoryBudgetMB)
+      results = statistics.compute()
+      self.assertEqual(sorted(results.keys()), ['mean', 'p50', 'variance'])
+      self.assertTrue(numpy.allclose(results['mean'], stack.mean(axis=0), rtol=1e-5))
+      self.assertTrue(numpy.allclose(results['variance'], stack.var(axis=0, ddof=1), rtol=1e-4))
+      error = abs(results['p50'] - numpy.median(stack, axis=0))
+      self.assertTrue(error.max() <= 1000. / 100)
+    self.assertEqual(statistics.slabSize, 1)
+    # gzip volumes are streamed a slab at a time rather than decoded per slab
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserStatistics')
+    filePath = Benchmark.writeCohort(directoryPath, 1, shape=shape, encoding='gzip')[0]
+    header = Nrrd.readHeader(filePath)
+    volume = Nrrd.readArray(header)
+    readSlab = Nrrd.slabReader(header)
+    slabs = [readSlab(start, start + 2) for start in range(0, shape[0], 2)]
+    self.assertTrue((numpy.concatenate(slabs) == volume).all())
+    self.assertTrue((readSlab(1, 3) == volume[1:3]).all())
+    self.delayDisplay('Test passed!')
+
+  def test_Pyramid(self):
+    """A level-1 voxel is the mean of a 2x2x2 block of the volume and
+    sits at its centre; previews are shown once the levels are written"""
+    self.delayDisplay("Starting the pyramid test")
+    import numpy
+    import shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserPyramid')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    os.mkdir(directoryPath)
+    filePath = os.path.join(directoryPath, 'baby-1.nrrd')
+    # odd sizes repeat their last slice
+    array = numpy.arange(5*6*7, dtype='float32').reshape(5,6,7)
+    ijkToRAS = numpy.array([[-0.9, 0, 0, 10], [0, -1.1, 0, -20], [0, 0, 1.2, 30], [0, 0, 0, 1]])
+    Pyramid.buildPyramid(filePath, array, numpy.linalg.inv(ijkToRAS), 2)
+    header = Nrrd.readHeader(Pyramid.levelPath(filePath, 1))
+    level1 = Nrrd.readArray(header)
+    self.assertEqual(level1.shape, (3, 3, 4))
+    self.assertAlmostEqual(level1[0,0,0], array[0:2,0:2,0:2].mean(), 4)
+    self.assertAlmostEqual(level1[2,2,3], array[4,4:6,6].mean(), 4)
+    levelIJKToRAS = numpy.linalg.inv(header.rasToIJK())
+    self.assertTrue(numpy.allclose(levelIJKToRAS[:3,3], numpy.dot(ijkToRAS, [0.5,0.5,0.5,1])[:3]))
+    self.assertTrue(numpy.allclose(numpy.diag(levelIJKToRAS)[:3], [-1.8, -2.2, 2.4]))
+    level2 = Nrrd.readArray(Nrrd.readHeader(Pyramid.levelPath(filePath, 2)))
+    self.assertEqual(level2.shape, (2, 2, 2))
+
+    # the logic builds them in the background after loading
+    dataPath = os.path.join(directoryPath, 'raw')
+    filePaths = Benchmark.writeCohort(dataPath, 2, shape=(8,10,12))
+    logic = BabyBrowserLogic()
+    logic.display = False
+    logic.pyramidLevels = 2
+    logic.loadBabies(dataPath, 'mprage-%d.nrrd')
+    logic.finishPyramids()
+    previewPath = logic.previewPath(filePaths[0])
+    self.assertEqual(previewPath, Pyramid.levelPath(filePaths[0], 2))
+    self.assertEqual(logic.volumeShape(previewPath), (2, 3, 3))
+    # a level being written is not previewed
+    logic.pyramidsBuilding.add(filePaths[1])
+    self.assertEqual(logic.previewPath(filePaths[1]), None)
+    self.delayDisplay('Test passed!')
+
+  def test_Discovery(self):
+    """Discovery reports gaps in the numbering, files it cannot read
+    and volumes whose geometry differs from the rest"""
+    self.delayDisplay("Starting the discovery test")
+    import numpy
+    import shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserDiscovery')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    filePaths = Benchmark.writeCohort(directoryPath, 5, shape=(8,9,10))
+    os.remove(filePaths[2])
+    # a thicker slice spacing, and a truncated header
+    Nrrd.writeArray(filePaths[3], numpy.zeros((8,9,10), dtype='int16'),
+                    Pyramid.geometryFields(numpy.diag([-1., -1., 2., 1.])))
+    brokenPath = os.path.join(directoryPath, 'mprage-12.nrrd')
+    fp = open(brokenPath, 'w')
+    fp.write('NRRD0004\ntype: short\n')
+    fp.close()
+
+    discovery = Discovery.CohortDiscovery(directoryPath, 'mprage-%d.nrrd', workers=4)
+    self.assertEqual([info.index for info in discovery.volumes], [1, 2, 4, 5, 12])
+    self.assertEqual(discovery.missingIndices(), [3, 6, 7, 8, 9, 10, 11])
+    self.assertEqual([info.filePath for info in discovery.errors()], [brokenPath])
+    self.assertEqual([info.filePath for info in discovery.readable()],
+                     [filePaths[0], filePaths[1], filePaths[3], filePaths[4]])
+    self.assertEqual(discovery.mismatches(),
+                     [(filePaths[3], 'spacing', (1., 1., 2.), (1., 1., 1.))])
+    report = discovery.report()
+    self.assertTrue('missing indices: 3, 6' in report)
+    self.assertTrue('unreadable %s' % brokenPath in report)
+
+    limited = Discovery.CohortDiscovery(directoryPath, 'mprage-%d.nrrd', maxIndex=4)
+    self.assertEqual([info.index for info in limited.volumes], [1, 2, 4])
+    self.assertEqual(limited.errors(), [])
+    # globs are in natural name order
+    globbed = Discovery.CohortDiscovery(directoryPath, 'mprage-*.nrrd')
+    self.assertEqual([os.path.basename(info.filePath) for info in globbed.volumes],
+                     ['mprage-1.nrrd', 'mprage-2.nrrd', 'mprage-4.nrrd', 'mprage-5.nrrd',
+                      'mprage-12.nrrd'])
+    self.assertEqual(globbed.missingIndices(), [])
+    self.delayDisplay('Test passed!')
+
+  def test_Batch(self):
+    """A batch run processes every readable baby, and its report and
+    exit code count the babies that failed or could not be read"""
+    self.delayDisplay("Starting the batch test")
+    import shutil
+    from BabyBrowserLib import Batch
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserBatch')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    dataPath = os.path.join(directoryPath, 'raw')
+    filePaths = Benchmark.writeCohort(dataPath, 3, shape=(8,9,10))
+    brokenPath = os.path.join(dataPath, 'mprage-5.nrrd')
+    fp = open(brokenPath, 'w')
+    fp.write('NRRD0004\n')
+    fp.close()
+    cliPath = Benchmark.writeStandIns(os.path.join(directoryPath, 'cli'))
+    reportPath = os.path.join(directoryPath, 'report.json')
+
+    argv = ['--directory', dataPath, '--stages', 'biasCorrect,register',
+            '--cli-modules', cliPath, '--report', reportPath]
+    report = Batch.run(BabyBrowserLogic(), Batch.parser().parse_args(argv), argv)
+    self.assertEqual(report['babies'], filePaths)
+    self.assertEqual(report['template'], filePaths[0])
+    self.assertEqual(report['missingIndices'], [4])
+    self.assertEqual(list(report['unreadable'].keys()), [brokenPath])
+    self.assertEqual(report['failures'], {})
+    self.assertEqual(sorted(report['outputs'].keys()), filePaths)
+    self.assertTrue(report['jobs'])
+    self.assertEqual(set(job['status'] for job in report['jobs']), set([CLIJob.SUCCEEDED]))
+    self.assertEqual(Batch.exitCode(report), 1)
+    Batch.writeReport(report, reportPath)
+    with open(reportPath) as fp:
+      self.assertEqual(json.load(fp)['babies'], filePaths)
+
+    # a tool that fails takes every baby with it
+    toolPath = os.path.join(cliPath, 'N4ITKBiasFieldCorrection')
+    fp = open(toolPath, 'w')
+    fp.write('#!/bin/sh\nexit 1\n')
+    fp.close()
+    argv = ['--directory', dataPath, '--stages', 'biasCorrect', '--no-cache',
+            '--cli-modules', cliPath, '--report', reportPath]
+    report = Batch.run(BabyBrowserLogic(), Batch.parser().parse_args(argv), argv)
+    self.assertEqual(report['failures'], dict((filePath, 'biasCorrect') for filePath in filePaths))
+    self.assertEqual(report['outputs'], {})
+    self.assertEqual(Batch.exitCode(report), 4)
+    self.delayDisplay('Test passed!')
+
+  def test_Profiler(self):
+    """Statistics per category: interpolated percentiles of the times,
+    totals of bytes and cpu time and the largest peak memory"""
+    self.delayDisplay("Starting the profiler test")
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserProfiler')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    logPath = os.path.join(directoryPath, 'profile.jsonl')
+    if os.path.exists(logPath):
+      os.remove(logPath)
+    profiler = Profiler.Profiler(logPath)
+    for seconds in (1., 2., 3., 4., 10.):
+      profiler.record('read', 'baby', seconds, bytes=1000)
+    profiler.record('job', 'a', 2., cpuTime=3., peakRSSMB=100.)
+    profiler.record('job', 'b', 4., cpuTime=5., peakRSSMB=300.)
+    with profiler.timer('show', 'baby') as event:
+      event['index'] = 3
+    statistics = profiler.statistics()
+    self.assertEqual(sorted(statistics.keys()), ['job', 'read', 'show'])
+    read = statistics['read']
+    self.assertEqual((read['count'], read['seconds'], read['mean']), (5, 20., 4.))
+    self.assertEqual((read['p50'], read['max'], read['bytes']), (3., 10., 5000))
+    self.assertAlmostEqual(read['p90'], 7.6)
+    self.assertAlmostEqual(read['p99'], 9.76)
+    job = statistics['job']
+    self.assertEqual((job['cpuTime'], job['peakRSSMB'], job['p50']), (8., 300., 3.))
+    self.assertFalse('bytes' in job)
+    self.assertEqual(profiler.select('show')[0]['index'], 3)
+    self.assertEqual(Profiler.percentile([], 50), None)
+    self.assertTrue(profiler.summary().splitlines()[2].startswith('read'))
+    # every event went to the log too
+    with open(logPath) as fp:
+      self.assertEqual([json.loads(line)['category'] for line in fp],
+                       ['read'] * 5 + ['job', 'job', 'show'])
+    profiler.enabled = False
+    profiler.record('read', 'baby', 1.)
+    profiler.clear()
+    self.assertEqual(profiler.statistics(), {})
+    self.delayDisplay('Test passed!')
+
+  def test_PipelineControl(self):
+    """The pipeline as the GUI drives it: progress while it runs,
+    cancel stops every baby where it is, and retry finishes them"""
+    self.delayDisplay("Starting the pipeline control test")
+    import shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserControl')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    dataPath = os.path.join(directoryPath, 'raw')
+    filePaths = Benchmark.writeCohort(dataPath, 3, shape=(8,9,10))
+    cliPath = Benchmark.writeStandIns(os.path.join(directoryPath, 'cli'), seconds=2.)
+    logic = BabyBrowserLogic()
+    logic.display = False
+    logic.cliModulesDirectory = cliPath
+    logic.maxWorkers = 1
+    logic.loadBabies(dataPath, 'mprage-%d.nrrd')
+
+    stages = ('biasCorrect', 'register')
+    pipeline = logic.startPipeline(stages=stages)
+    self.assertTrue(logic.activePipeline is pipeline)
+    deadline = time.time() + 30
+    while CLIJob.RUNNING not in [row[2] for row in pipeline.progress()[0]]:
+      self.assertTrue(time.time() < deadline)
+      time.sleep(0.05)
+    rows, done, total, eta = pipeline.progress()
+    self.assertEqual(sorted(row[0] for row in rows), filePaths)
+    self.assertEqual((done, total, eta), (0, 6, None))
+    self.assertEqual([row[1] for row in rows], ['biasCorrect'] * 3)
+
+    pipeline.cancel()
+    pipeline.pool.wait()
+    self.assertFalse(pipeline.isRunning())
+    logic.finishPipeline(pipeline)
+    self.assertEqual(logic.activePipeline, None)
+    rows, done, total, eta = pipeline.progress()
+    self.assertEqual([(row[1], row[2]) for row in rows], [('biasCorrect', CLIJob.CANCELLED)] * 3)
+    self.assertEqual(done, 0)
+    self.assertEqual(pipeline.failures(), {})
+
+    # as the Retry Failed button does
+    Benchmark.writeStandIns(cliPath)
+    logic.activePipeline = pipeline
+    self.assertEqual(sorted(pipeline.retry()), filePaths)
+    pipeline.pool.wait()
+    logic.finishPipeline(pipeline)
+    rows, done, total, eta = pipeline.progress()
+    self.assertEqual((done, total), (6, 6))
+    self.assertEqual(eta, 0.)
+    self.assertEqual([row[2] for row in rows], ['done'] * 3)
+    self.assertEqual(sorted(pipeline.outputs().keys()), filePaths)
+    self.delayDisplay('Test passed!')
+
+  def test_PipelineCache(self):
+    """A job reruns only when its tool, sources, inputs or arguments change"""
+    self.delayDisplay("Starting the pipeline cache test")
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserCache')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    toolPath = os.path.join(directoryPath, 'copy')
+    fp = open(toolPath, 'w')
+    fp.write('#!/bin/sh\ncp "$1" "$2"\n')
+    fp.close()
+    os.chmod(toolPath, 0755)
+    inputPath = os.path.join(directoryPath, 'in.txt')
+    outputPath = os.path.join(directoryPath, 'out.txt')
+    manifestPath = os.path.join(directoryPath, 'manifest.json')
+    for filePath in (inputPath, outputPath, manifestPath):
+      if os.path.exists(filePath):
+        os.remove(filePath)
+
+    def run(contents):
+      if contents:
+        fp = open(inputPath, 'w')
+        fp.write(contents)
+        fp.close()
+      cache = PipelineCache(manifestPath)
+      job = CLIJob('copy', [toolPath, inputPath, outputPath],
+                   inputs=[inputPath], outputs=[outputPath])
+      if cache.isUpToDate(job):
+        return CLIJob.SKIPPED
+      job.run()
+      cache.record(job)
+      cache.save()
+      return job.status
+
+    self.assertEqual(run('first'), CLIJob.SUCCEEDED)
+    self.assertEqual(run(None), CLIJob.SKIPPED)
+    self.assertEqual(run('second'), CLIJob.SUCCEEDED)
+    os.remove(outputPath)
+    self.assertEqual(run(None), CLIJob.SUCCEEDED)
+    self.assertEqual(open(outputPath).read(), 'second')
+
+    # an in process job also reruns when a module it uses changes
+    helperPath = os.path.join(directoryPath, 'helper.py')
+    def python(helper):
+      fp = open(helperPath, 'w')
+      fp.write(helper)
+      fp.close()
+      cache = PipelineCache(manifestPath)
+      job = PythonJob('copy', lambda: None, [toolPath, inputPath, outputPath],
+                      inputs=[inputPath], outputs=[outputPath], sources=[helperPath])
+      if cache.isUpToDate(job):
+        return CLIJob.SKIPPED
+      job.run()
+      cache.record(job)
+      cache.save()
+      return job.status
+    self.assertEqual(python('scale = 1\n'), CLIJob.SUCCEEDED)
+    self.assertEqual(python('scale = 1\n'), CLIJob.SKIPPED)
+    self.assertEqual(python('scale = 2.5\n'), CLIJob.SUCCEEDED)
+    self.delayDisplay('Test passed!')
+
+  def test_HistogramMatching(self):
+    """Match a synthetic volume to a reference in process and, when the
+    HistogramMatching CLI is available, compare against its output"""
+    self.delayDisplay("Starting the histogram matching test")
+    import numpy
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserMatching')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    numpy.random.seed(0)
+    inputPath = os.path.join(directoryPath, 'input.nrrd')
+    referencePath = os.path.join(directoryPath, 'reference.nrrd')
+    Nrrd.writeArray(inputPath, (numpy.random.gamma(3, 50, (30,40,50)) + 20).astype('int16'))
+    Nrrd.writeArray(referencePath, numpy.random.gamma(2, 100, (30,40,50)).astype('int16'))
+
+    logic = BabyBrowserLogic()
+    matchedPath = os.path.join(directoryPath, 'matched.nrrd')
+    job = logic.histogramMatchJob(inputPath, referencePath, matchedPath)
+    self.assertTrue(isinstance(job, PythonJob))
+    job.run()
+    self.assertEqual(job.status, CLIJob.SUCCEEDED)
+    matched = Nrrd.readVolume(matchedPath)[0]
+    reference = Nrrd.readVolume(referencePath)[0]
+    for percentile in (10, 50, 90):
+      self.assertTrue(abs(numpy.percentile(matched, percentile) -
+                          numpy.percentile(reference, percentile)) < 5)
+
+    if os.path.exists(logic.cliPath('HistogramMatching')):
+      cliPath = os.path.join(directoryPath, 'matchedByCLI.nrrd')
+      logic.inProcessHistogramMatching = False
+      job = logic.histogramMatch(inputPath, referencePath, cliPath)
+      self.assertEqual(job.status, CLIJob.SUCCEEDED)
+      loadedCLI = slicer.util.loadVolume(cliPath, returnNode=True)[1]
+      byCLI = slicer.util.array(loadedCLI.GetName())
+      self.assertTrue(abs(byCLI.astype('float64') - matched).max() <= 1)
+    self.delayDisplay('Test passed!')
+
+  def test_BiasCorrection(self):
+    """Remove a known smooth field from synthetic heads in process,
+    in a batch and through a batching pipeline, and when the
+    N4ITKBiasFieldCorrection CLI is available, compare against its output"""
+    self.delayDisplay("Starting the bias correction test")
+    import numpy
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserBias')
+    if not os.path.exists(directoryPath):
+      os.mkdir(directoryPath)
+    numpy.random.seed(0)
+    k, j, i = numpy.indices((48,56,64)).astype('float64')
+    radius = numpy.sqrt(((k-24)/20.)**2 + ((j-28)/24.)**2 + ((i-32)/28.)**2)
+    head = numpy.where(radius < 0.6, 400, numpy.where(radius < 0.8, 250, 600))
+    head = numpy.where(radius < 1, head, 5) + numpy.random.normal(0, 10, radius.shape)
+    field = numpy.exp(0.3 * (i / 64. - 0.5) - 0.15 * (j / 56.) + 0.2 * (k / 48. - 0.5) ** 2)
+    inputPaths = []
+    for index, scale in enumerate((1., 0.8)):
+      inputPaths.append(os.path.join(directoryPath, 'input%d.nrrd' % index))
+      Nrrd.writeArray(inputPaths[-1], numpy.maximum(head * field * scale, 1).astype('int16'))
+    inner = radius < 0.55
+    def variation(array):
+      return array[inner].std() / array[inner].mean()
+
+    logic = BabyBrowserLogic()
+    logic.inProcessBiasCorrection = True
+    correctedPath = os.path.join(directoryPath, 'corrected.nrrd')
+    job = logic.biasCorrectJob(inputPaths[0], correctedPath)
+    self.assertTrue(isinstance(job, PythonJob))
+    job.run()
+    self.assertEqual(job.status, CLIJob.SUCCEEDED)
+    corrected = Nrrd.readVolume(correctedPath)[0]
+    self.assertEqual(corrected.shape, head.shape)
+    self.assertTrue(variation(corrected) < 0.85 * variation(Nrrd.readVolume(inputPaths[0])[0]))
+
+    # a single tissue, whose edge blocks must not be taken for another one
+    uniformPath = os.path.join(directoryPath, 'uniform.nrrd')
+    uniform = numpy.where(radius < 1, 500, 5) + numpy.random.normal(0, 10, radius.shape)
+    Nrrd.writeArray(uniformPath, numpy.maximum(uniform * field, 1).astype('int16'))
+    job = logic.biasCorrect(uniformPath, os.path.join(directoryPath, 'uniformCorrected.nrrd'))
+    self.assertEqual(job.status, CLIJob.SUCCEEDED)
+    inside = radius < 0.9
+    before = Nrrd.readVolume(uniformPath)[0][inside]
+    after = Nrrd.readVolume(job.outputs[0])[0][inside]
+    self.assertTrue(after.std() / after.mean() < 0.6 * before.std() / before.mean())
+
+    # a batch corrects each baby as a job of its own would
+    batchPaths = [os.path.join(directoryPath, 'batch%d.nrrd' % index) for index in range(2)]
+    jobs = [logic.biasCorrectJob(inputPath, batchPath)
+            for inputPath, batchPath in zip(inputPaths, batchPaths)]
+    batch = JobBatch('biasCorrect batch', jobs)
+    batch.run()
+    self.assertEqual(batch.status, CLIJob.SUCCEEDED)
+    self.assertEqual([part.status for part in batch.parts], [CLIJob.SUCCEEDED] * 2)
+    self.assertTrue(numpy.allclose(Nrrd.readVolume(batchPaths[0])[0], corrected, rtol=1e-4))
+
+    # a pipeline with one worker queues its babies as one batch
+    def biasCorrect(filePath, threads):
+      return logic.biasCorrectJob(filePath, filePath.replace('input', 'piped'), threads)
+    pipeline = Pipeline(JobPool(maxWorkers=1), [('biasCorrect', biasCorrect)],
+                        batchSizes={'biasCorrect' : 4})
+    pipeline.run(inputPaths)
+    self.assertEqual(len(pipeline.pool.jobs), 1)
+    self.assertEqual(len(pipeline.pool.jobs[0].parts), 2)
+    self.assertEqual(sorted(pipeline.outputs().values()),
+                     [inputPath.replace('input', 'piped') for inputPath in inputPaths])
+
+    if os.path.exists(logic.cliPath('N4ITKBiasFieldCorrection')):
+      cliPath = os.path.join(directoryPath, 'correctedByCLI.nrrd')
+      logic.inProcessBiasCorrection = False
+      job = logic.biasCorrect(inputPaths[0], cliPath)
+      self.assertEqual(job.status, CLIJob.SUCCEEDED)
+      loadedCLI = slicer.util.loadVolume(cliPath, returnNode=True)[1]
+      byCLI = slicer.util.array(loadedCLI.GetName()).astype('float64')
+      # the fields may differ by a constant factor, not in shape
+      self.assertTrue(numpy.corrcoef(byCLI[radius < 1], corrected[radius < 1])[0, 1] > 0.95)
+      self.assertTrue(variation(corrected) < 1.2 * variation(byCLI))
+    self.delayDisplay('Test passed!')
+
+  def test_WorkQueue(self):
+    """Worker processes share a queue, and the task of a worker that
+    stopped heartbeating is run by another"""
+    self.delayDisplay("Starting the work queue test")
+    import sys, time, shutil
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserQueue')
+    if os.path.exists(directoryPath):
+      shutil.rmtree(directoryPath)
+    os.mkdir(directoryPath)
+    toolPath = os.path.join(directoryPath, 'copy')
+    fp = open(toolPath, 'w')
+    fp.write('#!/bin/sh\nsleep 0.2\ncp "$1" "$2"\n')
+    fp.close()
+    os.chmod(toolPath, 0755)
+    workQueue = WorkQueue.WorkQueue(os.path.join(directoryPath, 'queue'), timeoutSeconds=2)
+    for index in range(6):
+      inputPath = os.path.join(directoryPath, 'in%d.txt' % index)
+      outputPath = os.path.join(directoryPath, 'out%d.txt' % index)
+      fp = open(inputPath, 'w')
+      fp.write('baby %d' % index)
+      fp.close()
+      job = CLIJob('copy %d' % index, [toolPath, inputPath, outputPath],
+                   inputs=[inputPath], outputs=[outputPath])
+      workQueue.put('task%d' % index, {'subject' : inputPath, 'jobs' : [WorkQueue.jobSpec(job)]})
+    # a worker that claims a task and dies
+    lost = workQueue.claim('crashed')
+    # a worker that stalls past the timeout loses its task, and cannot finish it
+    slow = workQueue.claim('slow')
+    os.utime(workQueue.runningPath(slow), (time.time() - 10, time.time() - 10))
+    self.assertEqual(workQueue.requeueExpired(), [slow['id']])
+    self.assertFalse(workQueue.finish(slow, 'done', {}))
+    self.assertEqual(workQueue.counts()['done'], 0)
+    os.utime(workQueue.runningPath(lost), (time.time() - 10, time.time() - 10))
+
+    workerArgs = ['--queue', workQueue.directoryPath, '--exit-when-idle',
+                  '--poll', '0.2', '--timeout', '2']
+    if 'python' in os.path.basename(sys.executable).lower():
+      workerScript = os.path.splitext(WorkQueue.__file__)[0] + '.py'
+      workers = [subprocess.Popen([sys.executable, workerScript] + workerArgs) for index in range(3)]
+      for worker in workers:
+        self.assertEqual(worker.wait(), 0)
+    else:
+      # no standalone interpreter to start, so run the workers as threads
+      workers = [WorkQueue.Worker(workQueue, pollSeconds=0.2, exitWhenIdle=True) for index in range(3)]
+      threads = [threading.Thread(target=worker.run) for worker in workers]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+    counts = workQueue.counts()
+    self.assertEqual((counts['done'], counts['failed'], counts['running']), (6, 0, 0))
+    for index in range(6):
+      self.assertEqual(open(os.path.join(directoryPath, 'out%d.txt' % index)).read(), 'baby %d' % index)
+    retried = [task for task in workQueue.results() if task['id'] == lost['id']][0]
+    self.assertEqual(retried['attempts'], 2)
+
+    # a worker whose task is requeued under it stops running it and
+    # leaves the result to the new owner
+    workQueue = WorkQueue.WorkQueue(os.path.join(directoryPath, 'lostqueue'), timeoutSeconds=60)
+    job = CLIJob('sleep', ['sleep', '30'])
+    workQueue.put('sleeper', {'jobs' : [WorkQueue.jobSpec(job)]})
+    worker = WorkQueue.Worker(workQueue, 'stalled', heartbeatSeconds=0.1)
+    task = workQueue.claim(worker.workerId)
+    thread = threading.Thread(target=worker.runTask, args=(task,))
+    startTime = time.time()
+    thread.start()
+    time.sleep(0.5)
+    os.rename(workQueue.runningPath(task), workQueue.path('pending', 'sleeper.json'))
+    thread.join()
+    self.assertTrue(time.time() - startTime < 10)
+    self.assertEqual(worker.completed, [])
+    counts = workQueue.counts()
+    self.assertEqual((counts['pending'], counts['done'], counts['failed']), (1, 0, 0))
+    self.delayDisplay('Test passed!')
+
+  def test_Mosaic(self):
+    """Show one slice of a few babies, one of them smaller and one
+    only decoded through the volume cache, and check the grid"""
+    self.delayDisplay("Starting the mosaic test")
+    directoryPath = os.path.join(slicer.app.temporaryPath, 'BabyBrowserMosaic')
+    filePaths = Benchmark.writeCohort(directoryPath, 4, shape=(20,24,28))
+    filePaths += Benchmark.writeCohort(directoryPath, 1, shape=(20,12,14),
+                                       pattern='mprage-%d-small.nrrd')
+
     logic = BabyBrowserLogic()
-    self.assertTrue( logic.hasImageData(volumeNode) )
+    logic.loadBabies(directoryPath, 'mprage-*.nrrd')
+    self.assertEqual(len(logic.filePaths), 5)
+    logic.showBaby(2, wait=True)
+    self.assertEqual(logic.mosaicRange('axial'), (0, 19))
+    grid = logic.showMosaic(7.)
+    self.assertEqual(grid.shape, (2*24, 3*28))
+    for position, filePath in enumerate(logic.filePaths):
+      expected = Nrrd.readVolume(filePath)[0][7]
+      row, column = divmod(position, 3)
+      top = row * 24 + (24 - expected.shape[0]) // 2
+      left = column * 28 + (28 - expected.shape[1]) // 2
+      tile = grid[top:top+expected.shape[0], left:left+expected.shape[1]]
+      self.assertTrue((tile == expected).all())
+    volumeNode = slicer.util.getNode('baby-mosaic')
+    self.assertEqual(volumeNode.GetImageData().GetDimensions(), (3*28, 2*24, 1))
+    # sagittal tiles read as in Slicer's sagittal view: superior up, anterior left
+    grid = logic.showMosaic(-5., 'sagittal')
+    filePath = logic.filePaths[0]
+    volume = Nrrd.readVolume(filePath)[0]
+    axis, index = Mosaic.sliceIndex(arrayFromMatrix(logic.rasToIJKs[filePath]), volume.shape,
+                                    'sagittal', -5.)
+    expected = volume[::-1, :, index]
+    top, left = (20 - expected.shape[0]) // 2, (24 - expected.shape[1]) // 2
+    self.assertTrue((grid[top:top+expected.shape[0], left:left+expected.shape[1]] == expected).all())
+    # outside every baby the grid is blank
+    self.assertFalse(logic.showMosaic(100.).any())
+    self.assertEqual(logic.mosaicErrors, {})
+    # a baby that cannot be read is reported, not just left blank
+    mosaicSlice = logic.mosaicSlice
+    def failingSlice(filePath, orientation, offset):
+      if filePath == logic.filePaths[1]:
+        raise IOError('corrupt')
+      return mosaicSlice(filePath, orientation, offset)
+    logic.mosaicSlice = failingSlice
+    grid = logic.showMosaic(7.)
+    self.assertEqual(logic.mosaicErrors, {logic.filePaths[1] : 'IOError: corrupt'})
+    self.assertFalse(grid[0:24, 28:56].any())
+    errors = {}
+    self.assertEqual(Discovery.parallelMap(lambda x: 6 / x, [1, 0, 2], 2, errors), [6, None, 3])
+    self.assertEqual(list(errors.keys()), [1])
+    self.assertRaises(ZeroDivisionError, Discovery.parallelMap, lambda x: 6 / x, [1, 0], 2)
     self.delayDisplay('Test passed!')
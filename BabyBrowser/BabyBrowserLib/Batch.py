@@ -0,0 +1,146 @@
+"""
+Run the BabyBrowser processing pipeline without the GUI, e.g.
+
+  Slicer --no-main-window --python-script BabyBrowserLib/Batch.py \
+    --directory /data/babybrains/raw --pattern 'mprage-%d.nrrd' \
+    --stages biasCorrect,register,histogramMatch --report run.json
+
+(on nodes without a display, run Slicer under xvfb-run).  Every
+baby goes through the stages on a job pool sized to the node, the
+progress is resumable (see BabyBrowserLogic.runPipeline) and a JSON
+report of every job is written at the end.  The exit code is the
+number of babies that failed or could not be read, capped at 100.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+
+STAGES = ('biasCorrect', 'register', 'histogramMatch', 'qualityCheck')
+
+def parser():
+  parser = argparse.ArgumentParser(description='Process a cohort of baby volumes')
+  parser.add_argument('--directory', required=True, help='directory holding the volumes')
+  parser.add_argument('--pattern', default='mprage-%d.nrrd',
+                      help='file pattern with %%d or glob wildcards')
+  parser.add_argument('--max-index', type=int, default=None,
+                      help='only the volumes numbered up to this')
+  parser.add_argument('--stages', default=None,
+                      help='comma separated stages from %s (default: all but qualityCheck,'
+                      ' register last with --no-resample)' % ', '.join(STAGES))
+  parser.add_argument('--template', default=None, help='registration target (default: first volume)')
+  parser.add_argument('--reference', default=None, help='histogram reference (default: template)')
+  parser.add_argument('--max-workers', type=int, default=None,
+                      help='concurrent jobs (default: sized to cores and memory)')
+  parser.add_argument('--cli-modules', default=None, help='directory of the CLI executables')
+  parser.add_argument('--no-cache', action='store_true', help='rerun jobs whose outputs are up to date')
+  parser.add_argument('--no-resample', action='store_true',
+                      help='registration writes only the transform, not a resampled volume')
+  parser.add_argument('--in-process-bias', action='store_true',
+                      help='correct bias fields in this process instead of with the N4 CLI')
+  parser.add_argument('--pyramid-levels', type=int, default=0,
+                      help='also build this many preview levels per volume')
+  parser.add_argument('--profile-log', default=None,
+                      help='append timing events to this file as JSON lines')
+  parser.add_argument('--report', default=None,
+                      help='JSON report path (default: BabyBrowserBatch-<time>.json in the directory)')
+  return parser
+
+def configure(logic,options):
+  """Apply the command line options to a BabyBrowserLogic"""
+  logic.display = False
+  logic.maxWorkers = options.max_workers
+  logic.cliModulesDirectory = options.cli_modules
+  logic.useCache = not options.no_cache
+  # every file matching the pattern is processed, not only those indexed before
+  logic.rescanIndex = True
+  logic.resampleRegistered = not options.no_resample
+  logic.inProcessBiasCorrection = options.in_process_bias
+  logic.pyramidLevels = options.pyramid_levels
+  if options.profile_log:
+    logic.setProfileLog(options.profile_log)
+
+def run(logic,options,argv=()):
+  """Load the cohort, run the pipeline and return the report"""
+  startTime = time.time()
+  configure(logic, options)
+  if options.stages is None:
+    stages = list(logic.defaultStages())
+  else:
+    stages = [stage for stage in options.stages.split(',') if stage]
+  unknown = [stage for stage in stages if stage not in STAGES]
+  if unknown:
+    raise ValueError('unknown stages: %s' % ', '.join(unknown))
+  logic.loadBabies(options.directory, options.pattern, options.max_index)
+  # nothing is previewed here, so the levels need not overlap the stages
+  logic.finishPyramids()
+  discovery = logic.discovery
+  report = {
+    'command' : list(argv),
+    'host' : socket.gethostname(),
+    'directory' : os.path.abspath(options.directory),
+    'pattern' : options.pattern,
+    'stages' : stages,
+    'template' : options.template or logic.template,
+    'reference' : options.reference,
+    'babies' : list(logic.filePaths),
+    'missingIndices' : discovery.missingIndices() if discovery else [],
+    'unreadable' : dict((info.filePath, info.error) for info in discovery.errors()) if discovery else {},
+    'startTime' : startTime,
+    }
+  pipeline = None
+  if logic.filePaths and stages:
+    pipeline = logic.runPipeline(options.template, options.reference, stages)
+  report.update({
+    'endTime' : time.time(),
+    'wallTime' : time.time() - startTime,
+    'workers' : pipeline.pool.workers if pipeline else 0,
+    'threadsPerJob' : pipeline.pool.threadsPerJob if pipeline else 0,
+    'jobs' : [job.result() for job in logic.jobs],
+    'failures' : pipeline.failures() if pipeline else {},
+    'outputs' : pipeline.outputs() if pipeline else {},
+    'profile' : logic.profiler.statistics(),
+    })
+  if 'qualityCheck' in stages and logic.filePaths:
+    # worst first
+    scores = logic.orderByQuality(options.template)
+    report['quality'] = [dict(scores[filePath], baby=filePath)
+                         for filePath in logic.filePaths if filePath in scores]
+  print(logic.profileSummary())
+  return report
+
+def writeReport(report,reportPath):
+  temporaryPath = reportPath + '.tmp'
+  with open(temporaryPath, 'w') as fp:
+    json.dump(report, fp, indent=1, sort_keys=True)
+  if os.path.exists(reportPath):
+    os.remove(reportPath)
+  os.rename(temporaryPath, reportPath)
+
+def exitCode(report):
+  """The number of babies that failed or could not be read, capped at 100"""
+  return min(len(report['failures']) + len(report['unreadable']), 100)
+
+def main(argv=None):
+  if argv is None:
+    argv = sys.argv[1:]
+  options = parser().parse_args(argv)
+  from BabyBrowser import BabyBrowserLogic
+  report = run(BabyBrowserLogic(), options, argv)
+  reportPath = options.report
+  if not reportPath:
+    reportPath = os.path.join(options.directory,
+                              'BabyBrowserBatch-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+  writeReport(report, reportPath)
+  print('Report written to %s' % reportPath)
+  return exitCode(report)
+
+if __name__ == '__main__':
+  returnCode = main()
+  try:
+    # run by Slicer --python-script, which keeps running unless told to exit
+    slicer.app.exit(returnCode)
+  except NameError:
+    sys.exit(returnCode)
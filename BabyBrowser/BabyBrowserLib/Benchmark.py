@@ -0,0 +1,301 @@
+"""
+Benchmarks of loading, browsing and batch processing on synthetic
+cohorts, for comparing performance between commits offline.
+
+The numpy engines can be timed with plain python from the module
+directory:
+
+  python -m BabyBrowserLib.Benchmark --count 20 --shape 128,128,128 \
+    --output engines.json --baseline previous.json
+
+and inside Slicer (where BabyBrowserLogic is available) loadBabies,
+showBaby sweeps and the pipeline stages are timed as well, running
+stand-in executables in place of the CLI modules so only the
+BabyBrowser overhead is measured:
+
+  Slicer --no-main-window --python-code \
+    "from BabyBrowserLib import Benchmark; Benchmark.main(['--output', 'all.json'])"
+
+Results are the best of --repeat runs, written with a description of
+the machine so runs are only compared like with like.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import numpy
+from . import Nrrd
+from . import Pyramid
+from .JobPool import CLIJob, JobPool, cpuCount
+from .HistogramMatching import HistogramMatcher
+from .CohortStatistics import CohortStatistics
+
+#
+# synthetic data
+#
+
+def syntheticVolume(shape,dtype='int16',seed=0):
+  """A bright ellipsoid with smooth intensity variation and noise,
+  shaped (k,j,i) and scaled to the range of an MR volume"""
+  random = numpy.random.RandomState(seed)
+  k, j, i = [numpy.linspace(-1, 1, size).astype('float32') for size in shape]
+  radius = 0.7 + 0.1 * random.rand(3)
+  inside = ((k[:, None, None] / radius[0]) ** 2 + (j[None, :, None] / radius[1]) ** 2
+            + (i[None, None, :] / radius[2]) ** 2) < 1
+  bias = 1 + 0.2 * k[:, None, None] + 0.1 * j[None, :, None]
+  volume = inside * bias * 300 + random.normal(0, 20, shape).astype('float32') + 50
+  if numpy.dtype(dtype).kind in 'iu':
+    info = numpy.iinfo(dtype)
+    volume = numpy.clip(numpy.round(volume), info.min, info.max)
+  return volume.astype(dtype)
+
+def writeCohort(directoryPath,count,shape=(64,64,64),dtype='int16',encoding='raw',
+                pattern='mprage-%d.nrrd',spacing=1.,seed=0):
+  """Write count synthetic volumes numbered from 1; returns their paths"""
+  if not os.path.exists(directoryPath):
+    os.makedirs(directoryPath)
+  ijkToRAS = numpy.diag([-spacing, -spacing, spacing, 1.])
+  fields = Pyramid.geometryFields(ijkToRAS)
+  filePaths = []
+  for index in range(1, count + 1):
+    filePath = os.path.join(directoryPath, pattern % index)
+    Nrrd.writeArray(filePath, syntheticVolume(shape, dtype, seed + index), fields, encoding)
+    filePaths.append(filePath)
+  return filePaths
+
+STAND_IN = '''#!%(python)s
+# stand-in for a Slicer CLI module: copies its input to its output
+import os, sys, time, shutil
+tool = os.path.basename(sys.argv[0])
+options = {}
+positional = []
+for arg in sys.argv[1:]:
+  if arg.startswith('--'):
+    parts = arg[2:].split(' ', 1)
+    options[parts[0]] = parts[1] if len(parts) > 1 else ''
+  else:
+    positional.append(arg)
+time.sleep(%(seconds)r)
+if tool == 'N4ITKBiasFieldCorrection':
+  shutil.copy(options['inputimage'], options['outputimage'])
+elif tool == 'BRAINSFitEZ':
+  if options.get('outputVolume'):
+    shutil.copy(options['movingVolume'], options['outputVolume'])
+  fp = open(options['linearTransform'], 'w')
+  fp.write('#Insight Transform File V1.0\\n#Transform 0\\n'
+           'Transform: AffineTransform_double_3_3\\n'
+           'Parameters: 1 0 0 0 1 0 0 0 1 0 0 0\\nFixedParameters: 0 0 0\\n')
+  fp.close()
+elif tool == 'HistogramMatching':
+  shutil.copy(positional[0], positional[2])
+else:
+  sys.exit('unknown tool %%s' %% tool)
+'''
+
+STAND_IN_TOOLS = ('N4ITKBiasFieldCorrection', 'BRAINSFitEZ', 'HistogramMatching')
+
+def pythonExecutable():
+  if 'python' in os.path.basename(sys.executable).lower():
+    return sys.executable
+  return '/usr/bin/env python'
+
+def writeStandIns(directoryPath,seconds=0.):
+  """Executables named as the CLI modules the pipeline runs, which take
+  seconds and copy their input; use as logic.cliModulesDirectory"""
+  if not os.path.exists(directoryPath):
+    os.makedirs(directoryPath)
+  for tool in STAND_IN_TOOLS:
+    toolPath = os.path.join(directoryPath, tool)
+    with open(toolPath, 'w') as fp:
+      fp.write(STAND_IN % {'python' : pythonExecutable(), 'seconds' : float(seconds)})
+    os.chmod(toolPath, 0o755)
+  return directoryPath
+
+#
+# Benchmark
+#
+
+def environment():
+  """What the timings depend on besides the code"""
+  description = {
+    'platform' : platform.platform(),
+    'machine' : platform.machine(),
+    'python' : platform.python_version(),
+    'numpy' : numpy.__version__,
+    'cpus' : cpuCount(),
+    }
+  try:
+    sourceDirectory = os.path.dirname(os.path.abspath(__file__))
+    description['revision'] = subprocess.check_output(
+      ['git', 'rev-parse', 'HEAD'], cwd=sourceDirectory,
+      stderr=open(os.devnull, 'w')).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    pass
+  return description
+
+class Benchmark(object):
+  """Named timings, each the best of repeat runs of a function"""
+
+  def __init__(self,repeat=3,settings=None):
+    self.repeat = repeat
+    self.settings = settings or {}
+    self.results = {}
+    self.profile = {}
+
+  def time(self,name,function,repeat=None,setup=None,**fields):
+    """Time function() (after setup(), untimed, before each run)"""
+    runs = []
+    for run in range(repeat or self.repeat):
+      if setup:
+        setup()
+      startTime = time.time()
+      function()
+      runs.append(time.time() - startTime)
+    self.results[name] = dict(fields, seconds=min(runs), runs=runs)
+    print('%-32s %10.4fs' % (name, min(runs)))
+    return self.results[name]
+
+  def save(self,filePath):
+    with open(filePath, 'w') as fp:
+      json.dump({'environment' : environment(), 'settings' : self.settings,
+                 'results' : self.results, 'profile' : self.profile}, fp, indent=1, sort_keys=True)
+
+  def compare(self,baselinePath):
+    """Table of these results against a saved run"""
+    with open(baselinePath) as fp:
+      baseline = json.load(fp)
+    lines = ['%-32s %10s %10s %8s' % ('benchmark', 'baseline', 'now', 'ratio')]
+    if baseline.get('settings') != self.settings:
+      lines.append('(settings differ from the baseline: %s)' % baseline.get('settings'))
+    for name, result in sorted(self.results.items()):
+      before = baseline['results'].get(name, {}).get('seconds')
+      if before:
+        lines.append('%-32s %10.4f %10.4f %8.2f' % (name, before, result['seconds'],
+                                                   result['seconds'] / before))
+      else:
+        lines.append('%-32s %10s %10.4f %8s' % (name, '-', result['seconds'], '-'))
+    return '\n'.join(lines)
+
+def benchmarkEngines(benchmark,filePaths,workDirectory,cliDirectory):
+  """The numpy engines and job pool, without Slicer"""
+  volumeBytes = sum(Nrrd.readVolume(filePath)[0].nbytes for filePath in filePaths)
+  def readAll():
+    for filePath in filePaths:
+      # touch every voxel, as displaying would
+      Nrrd.readVolume(filePath)[0].sum()
+  benchmark.time('nrrd.read', readAll, bytes=volumeBytes)
+  shape = Nrrd.readHeader(filePaths[0]).shape
+  matcher = HistogramMatcher(Nrrd.readVolume(filePaths[0])[0])
+  def matchAll():
+    for filePath in filePaths:
+      for slab in matcher.slabs(Nrrd.readVolume(filePath)[0]):
+        pass
+  benchmark.time('histogram.match', matchAll)
+  readers = [lambda start, stop, filePath=filePath: Nrrd.readVolume(filePath)[0][start:stop]
+             for filePath in filePaths]
+  benchmark.time('cohort.statistics', lambda: CohortStatistics(readers, shape).compute())
+  def buildPyramids():
+    for filePath in filePaths:
+      array, header = Nrrd.readVolume(filePath)
+      Pyramid.buildPyramid(os.path.join(workDirectory, os.path.basename(filePath)),
+                           array, header.rasToIJK(), 3)
+  benchmark.time('pyramid.build', buildPyramids)
+  def standIns():
+    pool = JobPool()
+    for index, filePath in enumerate(filePaths):
+      outputPath = os.path.join(workDirectory, 'corrected-%d.nrrd' % index)
+      pool.submit(CLIJob('standIn', [os.path.join(cliDirectory, 'N4ITKBiasFieldCorrection'),
+                                     '--inputimage ' + filePath, '--outputimage ' + outputPath],
+                         pool.threadsPerJob))
+    pool.wait()
+    if pool.failures():
+      raise RuntimeError(pool.summary())
+  benchmark.time('jobpool.standIns', standIns)
+
+def benchmarkLogic(benchmark,logic,directoryPath,pattern,cliDirectory):
+  """Loading, browsing and the pipeline through a BabyBrowserLogic"""
+  indexPath = os.path.join(directoryPath, '.BabyBrowserIndex.sqlite')
+  def forgetIndex():
+    if logic.cohortIndex:
+      logic.cohortIndex.close()
+      logic.cohortIndex = None
+    if os.path.exists(indexPath):
+      os.remove(indexPath)
+  benchmark.time('logic.loadBabies.cold', lambda: logic.loadBabies(directoryPath, pattern),
+                 setup=forgetIndex)
+  benchmark.time('logic.loadBabies.indexed', lambda: logic.loadBabies(directoryPath, pattern))
+  logic.rescanIndex = True
+  benchmark.time('logic.loadBabies.rescanned', lambda: logic.loadBabies(directoryPath, pattern))
+  logic.rescanIndex = False
+  count = len(logic.filePaths)
+  def sweep():
+    for index in range(count):
+      logic.showBaby(index, wait=True)
+  benchmark.time('logic.showBaby.cold', sweep, repeat=1,
+                 setup=lambda: logic.loadBabies(directoryPath, pattern), babies=count)
+  benchmark.time('logic.showBaby.cached', sweep, babies=count)
+  logic.cliModulesDirectory = cliDirectory
+  logic.useCache = False
+  stageNames = ('biasCorrect', 'register', 'histogramMatch')
+  for stage in stageNames:
+    def runStage(stage=stage):
+      logic.runPipeline(stages=(stage,))
+      if logic.jobs and [job for job in logic.jobs if job.status == CLIJob.FAILED]:
+        raise RuntimeError('%s failed' % stage)
+    def resetState():
+      statePath = logic.pipelineStatePath()
+      if os.path.exists(statePath):
+        os.remove(statePath)
+    benchmark.time('logic.stage.%s' % stage, runStage, setup=resetState, babies=count)
+  benchmark.profile = logic.profiler.statistics()
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description='Benchmark BabyBrowser on a synthetic cohort')
+  parser.add_argument('--count', type=int, default=10, help='number of volumes')
+  parser.add_argument('--shape', default='64,64,64', help='k,j,i size of each volume')
+  parser.add_argument('--dtype', default='int16')
+  parser.add_argument('--encoding', default='raw', choices=('raw', 'gzip'))
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--cli-seconds', type=float, default=0., help='time taken by each stand-in CLI')
+  parser.add_argument('--directory', default=None, help='work directory (default: a temporary one)')
+  parser.add_argument('--output', default=None, help='write the results to this JSON file')
+  parser.add_argument('--baseline', default=None, help='compare with the results of an earlier run')
+  parser.add_argument('--engines-only', action='store_true', help='skip the BabyBrowserLogic benchmarks')
+  options = parser.parse_args(argv)
+  shape = tuple(int(size) for size in options.shape.split(','))
+  settings = {'count' : options.count, 'shape' : list(shape), 'dtype' : options.dtype,
+              'encoding' : options.encoding, 'cliSeconds' : options.cli_seconds}
+  benchmark = Benchmark(options.repeat, settings)
+  workDirectory = options.directory or tempfile.mkdtemp(prefix='BabyBrowserBenchmark')
+  try:
+    # the pipeline writes its outputs next to the data directory
+    dataDirectory = os.path.join(workDirectory, 'data', 'raw')
+    filePaths = writeCohort(dataDirectory, options.count, shape, options.dtype, options.encoding)
+    cliDirectory = writeStandIns(os.path.join(workDirectory, 'cli'), options.cli_seconds)
+    scratchDirectory = os.path.join(workDirectory, 'scratch')
+    os.mkdir(scratchDirectory)
+    benchmarkEngines(benchmark, filePaths, scratchDirectory, cliDirectory)
+    if not options.engines_only:
+      try:
+        import slicer
+      except ImportError:
+        print('BabyBrowserLogic is only available inside Slicer; timed the engines only')
+      else:
+        from BabyBrowser import BabyBrowserLogic
+        benchmarkLogic(benchmark, BabyBrowserLogic(), dataDirectory, 'mprage-%d.nrrd', cliDirectory)
+  finally:
+    if not options.directory:
+      shutil.rmtree(workDirectory, ignore_errors=True)
+  if options.output:
+    benchmark.save(options.output)
+  if options.baseline:
+    print(benchmark.compare(options.baseline))
+  return benchmark
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,192 @@
+import numpy
+from . import Nrrd
+from .Quality import otsuThreshold
+try:
+  import SimpleITK as sitk
+except ImportError:
+  sitk = None
+
+#
+# BiasCorrector
+#
+# An in process alternative to the N4ITKBiasFieldCorrection CLI.  As
+# the CLI does with --shrinkfactor, the bias field is estimated on a
+# block averaged copy of the volume: with SimpleITK's N4 filter where
+# it is available, else with a smooth polynomial fitted to the log
+# intensities of the inside of the head (the mask eroded, so blocks
+# mixing in background are left out) around their tissue classes.
+# The estimated (log) field is interpolated back to full resolution
+# and divided out a slab of slices at a time, so only the shrunk copy
+# and one slab are ever held as floating point.
+#
+
+def shrink(array,factor):
+  """Mean of factor**3 blocks of a (k,j,i) array (such as a memory
+  map), repeating the last slice of axes that do not divide evenly"""
+  shape = [(size + factor - 1) // factor for size in array.shape]
+  result = numpy.zeros(shape, dtype='float32')
+  for k in range(shape[0]):
+    slab = numpy.asarray(array[k * factor:(k + 1) * factor], dtype='float32')
+    pad = [(0, factor * count - size) for count, size in zip([1] + shape[1:], slab.shape)]
+    if any(after for before, after in pad):
+      slab = numpy.pad(slab, pad, mode='edge')
+    result[k] = slab.reshape(1, factor, shape[1], factor, shape[2], factor).mean(axis=(0, 1, 3, 5))
+  return result
+
+def headMask(small):
+  """Voxels above Otsu's threshold, as the CLI uses when not given a mask"""
+  return small > otsuThreshold(small.reshape(-1))
+
+def erode(mask,iterations=1):
+  """mask without the voxels that have a face neighbour outside it"""
+  for iteration in range(iterations):
+    inner = mask.copy()
+    for axis in range(mask.ndim):
+      before = [slice(None)] * mask.ndim
+      after = [slice(None)] * mask.ndim
+      before[axis], after[axis] = slice(None, -1), slice(1, None)
+      inner[tuple(after)] &= mask[tuple(before)]
+      inner[tuple(before)] &= mask[tuple(after)]
+      edges = [slice(None)] * mask.ndim
+      edges[axis] = [0, -1]
+      inner[tuple(edges)] = False
+    mask = inner
+  return mask
+
+def polynomialBasis(shape,order,mask=None):
+  """Monomials up to order of the (k,j,i) coordinates, scaled to -1..1,
+  as columns, for the voxels in mask (default all)"""
+  axes = [numpy.linspace(-1, 1, size) if size > 1 else numpy.zeros(1) for size in shape]
+  coordinates = numpy.broadcast_arrays(axes[0][:, None, None], axes[1][None, :, None],
+                                       axes[2][None, None, :])
+  if mask is not None:
+    coordinates = [coordinate[mask] for coordinate in coordinates]
+  else:
+    coordinates = [coordinate.reshape(-1) for coordinate in coordinates]
+  columns = []
+  for a in range(order + 1):
+    for b in range(order + 1 - a):
+      for c in range(order + 1 - a - b):
+        columns.append(coordinates[0] ** a * coordinates[1] ** b * coordinates[2] ** c)
+  return numpy.array(columns).T
+
+def interpolationWeights(size,coarseSize,factor):
+  """Linear interpolation from the block centers of a shrunk axis:
+  (low, high, weight of high) for each full resolution index"""
+  position = (numpy.arange(size) - (factor - 1) / 2.) / factor
+  position = numpy.clip(position, 0, coarseSize - 1)
+  low = numpy.floor(position).astype('int64')
+  high = numpy.minimum(low + 1, coarseSize - 1)
+  return low, high, (position - low).astype('float32')
+
+class BiasCorrector(object):
+  """Estimate and remove the bias field of volumes.  One corrector
+  can be used for a batch of volumes, so SimpleITK and its filter are
+  set up once.  iterations and convergenceThreshold are those of the
+  CLI; polynomialOrder and tissueClasses are used without SimpleITK."""
+
+  def __init__(self,shrinkFactor=4,iterations=(500,400,300),convergenceThreshold=0.0001,
+               threads=None,slabSize=16,useSimpleITK=True,polynomialOrder=3,tissueClasses=3):
+    self.shrinkFactor = shrinkFactor
+    self.iterations = list(iterations)
+    self.convergenceThreshold = convergenceThreshold
+    self.threads = threads
+    self.slabSize = slabSize
+    self.useSimpleITK = useSimpleITK and sitk is not None
+    self.polynomialOrder = polynomialOrder
+    self.tissueClasses = tissueClasses
+    self.corrector = None
+    if self.useSimpleITK:
+      self.corrector = sitk.N4BiasFieldCorrectionImageFilter()
+      self.corrector.SetMaximumNumberOfIterations([int(n) for n in self.iterations])
+      self.corrector.SetConvergenceThreshold(convergenceThreshold)
+      self.corrector.SetSplineOrder(3)
+      if threads and hasattr(self.corrector, 'SetNumberOfThreads'):
+        self.corrector.SetNumberOfThreads(threads)
+
+  def estimate(self,array,spacing=(1,1,1)):
+    """The log bias field of a (k,j,i) array on its shrunk grid;
+    spacing is in (i,j,k) order"""
+    small = shrink(array, self.shrinkFactor)
+    mask = headMask(small) & (small > 0)
+    if not mask.any():
+      return numpy.zeros(small.shape, dtype='float32')
+    if self.useSimpleITK:
+      return self.estimateN4(small, mask, spacing)
+    return self.estimatePolynomial(small, mask)
+
+  def estimateN4(self,small,mask,spacing):
+    image = sitk.GetImageFromArray(small)
+    image.SetSpacing([float(s) * self.shrinkFactor for s in spacing])
+    maskImage = sitk.GetImageFromArray(mask.astype('uint8'))
+    maskImage.CopyInformation(image)
+    corrected = sitk.GetArrayFromImage(self.corrector.Execute(image, maskImage))
+    positive = (small > 0) & (corrected > 0)
+    logField = numpy.zeros(small.shape, dtype='float32')
+    logField[positive] = numpy.log(small[positive]) - numpy.log(corrected[positive])
+    # background too dark to take the ratio gets the mean of the head
+    head = positive & mask
+    logField[~positive] = logField[head].mean() if head.any() else 0
+    return logField
+
+  def estimatePolynomial(self,small,mask,maximumIterations=20):
+    """Alternate between grouping the corrected log intensities in
+    tissueClasses (1D k-means) and fitting the polynomial field to what
+    the classes do not explain, until the field stops changing"""
+    # blocks on the edge of the head mix in background, which would be
+    # taken for a darker tissue
+    inner = erode(mask)
+    order = self.polynomialOrder
+    if numpy.count_nonzero(inner) > 4 * (order + 1) * (order + 2) * (order + 3) // 6:
+      mask = inner
+    logValues = numpy.log(small[mask]).astype('float64')
+    basis = polynomialBasis(small.shape, self.polynomialOrder, mask)
+    field = numpy.zeros_like(logValues)
+    coefficients = numpy.zeros(basis.shape[1])
+    for iteration in range(maximumIterations):
+      corrected = logValues - field
+      centers = numpy.percentile(corrected, numpy.linspace(20, 80, self.tissueClasses))
+      for step in range(10):
+        labels = numpy.argmin(abs(corrected[:, numpy.newaxis] - centers), axis=1)
+        centers = numpy.array([corrected[labels == label].mean() if (labels == label).any() else center
+                               for label, center in enumerate(centers)])
+      coefficients = numpy.linalg.lstsq(basis, logValues - centers[labels], rcond=-1)[0]
+      newField = numpy.dot(basis, coefficients)
+      newField -= newField.mean()
+      change = abs(newField - field).max()
+      field = newField
+      if change < self.convergenceThreshold:
+        break
+    logField = numpy.dot(polynomialBasis(small.shape, self.polynomialOrder), coefficients)
+    logField -= numpy.dot(basis, coefficients).mean()
+    return logField.reshape(small.shape).astype('float32')
+
+  def fieldSlab(self,logField,shape,start,stop):
+    """The log field interpolated to slices start to stop of a
+    volume of (k,j,i) shape"""
+    factor = self.shrinkFactor
+    weights = [interpolationWeights(size, coarseSize, factor)
+               for size, coarseSize in zip(shape, logField.shape)]
+    low, high, weight = [w[start:stop] for w in weights[0]]
+    field = (logField[low] * (1 - weight)[:, None, None] + logField[high] * weight[:, None, None])
+    low, high, weight = weights[1]
+    field = field[:, low] * (1 - weight)[None, :, None] + field[:, high] * weight[None, :, None]
+    low, high, weight = weights[2]
+    return field[:, :, low] * (1 - weight) + field[:, :, high] * weight
+
+  def slabs(self,array,logField):
+    """The corrected volume as float32 slabs of slabSize slices"""
+    for start in range(0, array.shape[0], self.slabSize):
+      stop = min(start + self.slabSize, array.shape[0])
+      slab = numpy.asarray(array[start:stop], dtype='float32')
+      yield slab / numpy.exp(self.fieldSlab(logField, array.shape, start, stop))
+
+  def correctFile(self,filePathIn,filePathOut):
+    """Correct a NRRD file into a float NRRD with the same geometry"""
+    array, header = Nrrd.readVolume(filePathIn)
+    columns = numpy.asarray(header.ijkToRAS(), dtype='float64')[:3, :3]
+    spacing = numpy.sqrt((columns ** 2).sum(axis=0))
+    logField = self.estimate(array, spacing)
+    Nrrd.writeNrrd(filePathOut, self.slabs(array, logField), array.shape, 'float32',
+                   Nrrd.geometryFields(header))
+    return logField
@@ -0,0 +1,281 @@
+import os
+import csv
+import json
+import hashlib
+import sqlite3
+import threading
+from . import Discovery
+from . import Nrrd
+from . import WindowLevel
+
+#
+# CohortIndex
+#
+# What is known about the volumes of a cohort, kept in an SQLite file
+# next to the data so it survives restarts: where each volume is, its
+# size and modification time (to notice changes), its geometry and
+# intensity range, the outputs the pipeline stages wrote for it and
+# free form attributes (such as age) used to select and order subjects.
+#
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS volumes (
+  path TEXT PRIMARY KEY,
+  directory TEXT,
+  number INTEGER,
+  mtime REAL,
+  size INTEGER,
+  hash TEXT,
+  shape TEXT,
+  spacing TEXT,
+  dtype TEXT,
+  ijkToRAS TEXT,
+  encoding TEXT,
+  mappable INTEGER,
+  minimum REAL,
+  maximum REAL,
+  low REAL,
+  high REAL,
+  error TEXT
+);
+CREATE INDEX IF NOT EXISTS volumesDirectory ON volumes (directory);
+CREATE TABLE IF NOT EXISTS outputs (
+  path TEXT,
+  stage TEXT,
+  outputPath TEXT,
+  PRIMARY KEY (path, stage)
+);
+CREATE TABLE IF NOT EXISTS attributes (
+  path TEXT,
+  name TEXT,
+  value,
+  PRIMARY KEY (path, name)
+);
+"""
+
+# columns added since the first version, with their types
+ADDED_COLUMNS = (('low', 'REAL'), ('high', 'REAL'))
+
+def contentDigest(filePath):
+  sha1 = hashlib.sha1()
+  with open(filePath, 'rb') as fp:
+    while True:
+      block = fp.read(1024*1024)
+      if not block:
+        break
+      sha1.update(block)
+  return sha1.hexdigest()
+
+def attributeValue(text):
+  """CSV cells become numbers where they look like one, so ranges
+  compare numerically"""
+  for convert in (int, float):
+    try:
+      return convert(text)
+    except ValueError:
+      pass
+  return text
+
+class CohortIndex(object):
+  """An SQLite database of cohort volumes.  update() brings it in line
+  with a directory, rereading only the headers of new or changed files,
+  and query() selects and orders the indexed volumes."""
+
+  def __init__(self,databasePath):
+    self.databasePath = databasePath
+    self.lock = threading.RLock()
+    # jobs record their outputs from worker threads
+    self.connection = sqlite3.connect(databasePath, check_same_thread=False)
+    self.connection.row_factory = sqlite3.Row
+    with self.lock:
+      self.connection.executescript(SCHEMA)
+      columns = [row['name'] for row in self.connection.execute('PRAGMA table_info(volumes)')]
+      for name, columnType in ADDED_COLUMNS:
+        if name not in columns:
+          self.connection.execute('ALTER TABLE volumes ADD COLUMN %s %s' % (name, columnType))
+      self.connection.commit()
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+  def stamps(self,directoryPath):
+    """{path: (mtime, size)} of the volumes indexed in directoryPath"""
+    with self.lock:
+      rows = self.connection.execute('SELECT path, mtime, size FROM volumes WHERE directory = ?',
+                                     (os.path.abspath(directoryPath),)).fetchall()
+    return dict((row['path'], (row['mtime'], row['size'])) for row in rows)
+
+  def update(self,directoryPath,pattern,maxIndex=None,workers=16,hashContents=False,
+             sampleIntensities=False):
+    """Index the files of directoryPath matching pattern.  The
+    directory is listed once and the files are stat'ed; headers are
+    read (in parallel) only for files that are new or whose size or
+    modification time changed.  With sampleIntensities, the display
+    range of those that are raw NRRDs is sampled too (see WindowLevel);
+    compressed ones would have to be decoded whole, so their range is
+    sampled when they are first shown and kept with setIntensities.
+    Returns the VolumeInfos that were read."""
+    directoryPath = os.path.abspath(directoryPath)
+    matches = Discovery.limitMatches(Discovery.matchFiles(directoryPath, pattern), maxIndex)
+    known = self.stamps(directoryPath)
+    stale = []
+    for index, filePath in matches:
+      status = os.stat(filePath)
+      if known.get(filePath) != (status.st_mtime, status.st_size):
+        stale.append((index, filePath, status))
+    def read(entry):
+      index, filePath, status = entry
+      info = Discovery.readInfo(filePath, index)
+      digest = contentDigest(filePath) if hashContents and not info.error else None
+      if sampleIntensities and not info.error and info.mappable:
+        try:
+          header = info.header or Nrrd.readHeader(filePath)
+          # only the sampled voxels of the mapping are read
+          info.intensities = WindowLevel.sampleIntensities(Nrrd.readArray(header))
+        except (Nrrd.NrrdError, IOError, ValueError, KeyError):
+          pass
+      return info, status, digest
+    results = Discovery.parallelMap(read, stale, workers)
+    with self.lock:
+      for info, status, digest in results:
+        self.store(info, status, digest)
+      # forget volumes that have been deleted, and what was known of
+      # them, so a new file at the same path starts afresh
+      for filePath in known:
+        if not os.path.exists(filePath):
+          for table in ('volumes', 'outputs', 'attributes'):
+            self.connection.execute('DELETE FROM %s WHERE path = ?' % table, (filePath,))
+      self.connection.commit()
+    return [info for info, status, digest in results]
+
+  def store(self,info,status,digest=None):
+    geometry = lambda value: json.dumps(value.tolist() if hasattr(value, 'tolist') else value)
+    self.connection.execute(
+      'INSERT OR REPLACE INTO volumes (path, directory, number, mtime, size, hash, shape, spacing,'
+      ' dtype, ijkToRAS, encoding, mappable, minimum, maximum, low, high, error)'
+      ' VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+      (info.filePath, os.path.dirname(info.filePath), info.index,
+       status.st_mtime, status.st_size, digest,
+       geometry(info.shape), geometry(info.spacing), info.dtype, geometry(info.ijkToRAS),
+       info.encoding, int(info.mappable)) +
+      tuple((info.intensities or {}).get(name) for name in ('minimum', 'maximum', 'low', 'high')) +
+      (info.error,))
+
+  def query(self,directoryPath,pattern=None,stages=(),attributes=None,orderBy='number',
+            includeErrors=False):
+    """Rows (sqlite3.Row, indexable by column name) of the indexed
+    volumes in directoryPath, optionally only those matching pattern,
+    having an output for every one of stages and whose attributes
+    match: a dictionary of name to a value or an inclusive (low, high)
+    range (a None bound is open).  Rows are sorted by orderBy, which is
+    number (the index from a %d pattern), path or an attribute name."""
+    where = ['v.directory = ?']
+    parameters = [os.path.abspath(directoryPath)]
+    if not includeErrors:
+      where.append('v.error IS NULL')
+    for stage in stages:
+      where.append('EXISTS (SELECT 1 FROM outputs o WHERE o.path = v.path AND o.stage = ?)')
+      parameters.append(stage)
+    for name, value in sorted((attributes or {}).items()):
+      condition = 'EXISTS (SELECT 1 FROM attributes a WHERE a.path = v.path AND a.name = ?'
+      parameters.append(name)
+      if isinstance(value, (tuple, list)):
+        low, high = value
+        if low is not None:
+          condition += ' AND a.value >= ?'
+          parameters.append(low)
+        if high is not None:
+          condition += ' AND a.value <= ?'
+          parameters.append(high)
+      else:
+        condition += ' AND a.value = ?'
+        parameters.append(value)
+      where.append(condition + ')')
+    if orderBy in ('number', 'path'):
+      join = ''
+      order = 'v.path'
+    else:
+      join = 'LEFT JOIN attributes s ON s.path = v.path AND s.name = ?'
+      parameters.insert(0, orderBy)
+      order = 's.value, v.number, v.path'
+    sql = 'SELECT v.* FROM volumes v %s WHERE %s ORDER BY %s' % (join, ' AND '.join(where), order)
+    with self.lock:
+      rows = self.connection.execute(sql, parameters).fetchall()
+    if pattern:
+      match = Discovery.nameMatcher(pattern)
+      rows = [row for row in rows if match(os.path.basename(row['path']))[0]]
+    if orderBy == 'number':
+      # the same order as discovery (natural name order for globs)
+      rows.sort(key=lambda row: Discovery.matchOrder((row['number'], row['path'])))
+    return rows
+
+  def info(self,row):
+    """VolumeInfo of a row returned by query (without a header)"""
+    info = Discovery.VolumeInfo(row['path'], row['number'])
+    info.error = row['error']
+    if not info.error:
+      info.setIJKToRAS(json.loads(row['ijkToRAS']))
+      info.shape = tuple(json.loads(row['shape']))
+      info.dtype = row['dtype']
+      info.encoding = row['encoding']
+      info.mappable = bool(row['mappable'])
+      if row['low'] is not None:
+        info.intensities = dict((name, row[name]) for name in ('minimum', 'maximum', 'low', 'high'))
+    return info
+
+  def volume(self,filePath):
+    with self.lock:
+      return self.connection.execute('SELECT * FROM volumes WHERE path = ?',
+                                     (os.path.abspath(filePath),)).fetchone()
+
+  def setIntensities(self,filePath,intensities):
+    """Keep the sampled display range of a volume (see WindowLevel)"""
+    with self.lock:
+      self.connection.execute('UPDATE volumes SET minimum = ?, maximum = ?, low = ?, high = ? WHERE path = ?',
+                              tuple(intensities[name] for name in ('minimum', 'maximum', 'low', 'high')) +
+                              (os.path.abspath(filePath),))
+      self.connection.commit()
+
+  def recordOutput(self,filePath,stage,outputPath):
+    """Note that stage wrote outputPath for the volume filePath"""
+    with self.lock:
+      self.connection.execute('INSERT OR REPLACE INTO outputs (path, stage, outputPath) VALUES (?,?,?)',
+                              (os.path.abspath(filePath), stage, os.path.abspath(outputPath)))
+      self.connection.commit()
+
+  def outputs(self,filePath):
+    """{stage: outputPath} of the volume filePath"""
+    with self.lock:
+      rows = self.connection.execute('SELECT stage, outputPath FROM outputs WHERE path = ?',
+                                     (os.path.abspath(filePath),)).fetchall()
+    return dict((row['stage'], row['outputPath']) for row in rows)
+
+  def setAttributes(self,filePath,attributes):
+    with self.lock:
+      for name, value in attributes.items():
+        self.connection.execute('INSERT OR REPLACE INTO attributes (path, name, value) VALUES (?,?,?)',
+                                (os.path.abspath(filePath), name, value))
+      self.connection.commit()
+
+  def attributes(self,filePath):
+    with self.lock:
+      rows = self.connection.execute('SELECT name, value FROM attributes WHERE path = ?',
+                                     (os.path.abspath(filePath),)).fetchall()
+    return dict((row['name'], row['value']) for row in rows)
+
+  def importAttributes(self,csvPath,directoryPath,column='file'):
+    """Attributes from a CSV file with a header row.  column holds the
+    file name (relative to directoryPath) of each subject and every
+    other column becomes an attribute.  Returns the rows imported."""
+    count = 0
+    with open(csvPath) as fp:
+      for record in csv.DictReader(fp):
+        fileName = record.pop(column, None)
+        if not fileName:
+          continue
+        filePath = os.path.join(directoryPath, fileName)
+        self.setAttributes(filePath, dict((name, attributeValue(value))
+                                          for name, value in record.items() if name))
+        count += 1
+    return count
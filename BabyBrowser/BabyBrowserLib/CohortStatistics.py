@@ -0,0 +1,93 @@
+import numpy
+
+#
+# CohortStatistics
+#
+# Voxelwise statistics over a cohort of volumes sharing one grid
+# (e.g. registered to a template).  The volumes are visited one slab
+# of slices at a time, so memory depends on the slab size and not on
+# the number of subjects:
+# - mean and variance use Welford's running update per subject
+# - percentiles are interpolated from a per-voxel histogram over a
+#   fixed intensity range, so they are approximate to one bin width
+#
+
+class CohortStatistics(object):
+  """sources are callables readSlab(start,stop) returning the slices
+  start to stop of a subject as a (k,j,i) array; shape is the (k,j,i)
+  shape they share."""
+
+  def __init__(self,sources,shape,percentiles=(5,50,95),bins=128,
+               valueRange=None,memoryBudgetMB=512):
+    self.sources = list(sources)
+    self.shape = tuple(shape)
+    self.percentiles = list(percentiles)
+    self.bins = bins
+    self.valueRange = valueRange
+    self.countType = numpy.uint16 if len(self.sources) < 2**16 else numpy.uint32
+    sliceVoxels = self.shape[1] * self.shape[2]
+    # per voxel histograms dominate: counts, their cumulative sum and a
+    # mask per bin, plus a few float64 accumulators
+    bytesPerSlice = sliceVoxels * (bins * (numpy.dtype(self.countType).itemsize + 4 + 1) + 4 * 8)
+    self.slabSize = int(max(1, min(self.shape[0], memoryBudgetMB * 1024 * 1024 // bytesPerSlice)))
+
+  def estimateRange(self,step=8):
+    """Intensity range from every step-th slice of every subject"""
+    low, high = None, None
+    for readSlab in self.sources:
+      for k in range(0, self.shape[0], step):
+        values = readSlab(k, k + 1)
+        low = values.min() if low is None else min(low, values.min())
+        high = values.max() if high is None else max(high, values.max())
+    return float(low), float(high)
+
+  def compute(self):
+    """Dictionary of float32 (k,j,i) arrays: mean, variance (sample
+    variance, n-1) and p<percentile> for each requested percentile"""
+    if self.valueRange is None:
+      self.valueRange = self.estimateRange()
+    results = {'mean' : numpy.zeros(self.shape, dtype='float32'),
+               'variance' : numpy.zeros(self.shape, dtype='float32')}
+    for percentile in self.percentiles:
+      results['p%g' % percentile] = numpy.zeros(self.shape, dtype='float32')
+    for start in range(0, self.shape[0], self.slabSize):
+      stop = min(start + self.slabSize, self.shape[0])
+      for name, values in self.reduceSlab(start, stop).items():
+        results[name][start:stop] = values
+    return results
+
+  def reduceSlab(self,start,stop):
+    shape = (stop - start,) + self.shape[1:]
+    voxels = int(numpy.prod(shape))
+    low, high = self.valueRange
+    scale = self.bins / (high - low) if high > low else 0.
+    mean = numpy.zeros(voxels, dtype='float64')
+    m2 = numpy.zeros(voxels, dtype='float64')
+    counts = numpy.zeros(self.bins * voxels, dtype=self.countType)
+    voxelIndices = numpy.arange(voxels)
+    n = 0
+    for readSlab in self.sources:
+      values = numpy.asarray(readSlab(start, stop), dtype='float64').reshape(-1)
+      n += 1
+      delta = values - mean
+      mean += delta / n
+      m2 += delta * (values - mean)
+      binIndices = ((values - low) * scale).astype('int64')
+      numpy.clip(binIndices, 0, self.bins - 1, out=binIndices)
+      # every voxel appears once, so plain fancy indexing cannot collide
+      counts[binIndices * voxels + voxelIndices] += 1
+    results = {
+      'mean' : mean.reshape(shape),
+      'variance' : (m2 / max(n - 1, 1)).reshape(shape),
+      }
+    counts = counts.reshape(self.bins, voxels)
+    cumulative = numpy.cumsum(counts, axis=0, dtype='uint32')
+    width = (high - low) / self.bins
+    for percentile in self.percentiles:
+      target = percentile / 100. * n
+      binIndex = numpy.argmax(cumulative >= target, axis=0)
+      below = numpy.where(binIndex > 0, cumulative[binIndex - 1, voxelIndices], 0).astype('float64')
+      inBin = counts[binIndex, voxelIndices].astype('float64')
+      fraction = numpy.where(inBin > 0, (target - below) / numpy.maximum(inBin, 1), 0.)
+      results['p%g' % percentile] = (low + (binIndex + fraction) * width).reshape(shape)
+    return results
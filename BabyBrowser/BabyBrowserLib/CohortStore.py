@@ -0,0 +1,149 @@
+import json
+import struct
+import threading
+import zlib
+import numpy
+
+#
+# Packed cohort file
+#
+# A cohort of same-sized volumes stored as one 4D (subject, k, j, i)
+# array split into zlib compressed chunks, so reopening costs one
+# open plus reading the index, and a region read only decompresses
+# the chunks it touches.
+#
+# Layout:
+#   MAGIC
+#   uint64 offset of the index
+#   compressed chunks, subject by subject, chunk grid in C order
+#   uint64 length of the JSON description, JSON description
+#   uint64 table (subjects, chunks, 2) of chunk (offset, length)
+#
+
+MAGIC = b'BBCOHORT0001\n'
+
+class CohortStoreError(Exception):
+  pass
+
+def chunkGrid(shape,chunkShape):
+  return tuple((size + chunk - 1) // chunk for size, chunk in zip(shape, chunkShape))
+
+def chunkSlices(shape,chunkShape):
+  """The (k,j,i) slices of each chunk, in C order of the chunk grid"""
+  grid = chunkGrid(shape, chunkShape)
+  for position in numpy.ndindex(*grid):
+    yield tuple(slice(p * c, min((p + 1) * c, s))
+                for p, c, s in zip(position, chunkShape, shape))
+
+def writeCohort(filePath,volumes,rasToIJKs,metadata=None,chunkShape=(32,32,32),level=1):
+  """Pack volumes (an iterable of (k,j,i) arrays of the same shape and
+  type, consumed one at a time) with their 4x4 RAS to IJK matrices and
+  optional per-subject metadata dictionaries into filePath"""
+  rasToIJKs = [numpy.asarray(m, dtype='float64').reshape(4,4).tolist() for m in rasToIJKs]
+  shape = dtype = None
+  table = []
+  with open(filePath, 'wb') as fp:
+    fp.write(MAGIC)
+    fp.write(struct.pack('<Q', 0))
+    for volume in volumes:
+      volume = numpy.asarray(volume)
+      if shape is None:
+        shape, dtype = volume.shape, volume.dtype
+      elif volume.shape != shape or volume.dtype != dtype:
+        raise CohortStoreError('subject %d is %s %s, expected %s %s' % (
+          len(table), volume.shape, volume.dtype, shape, dtype))
+      chunks = []
+      for slices in chunkSlices(shape, chunkShape):
+        data = zlib.compress(numpy.ascontiguousarray(volume[slices]).data, level)
+        chunks.append((fp.tell(), len(data)))
+        fp.write(data)
+      table.append(chunks)
+    if shape is None:
+      raise CohortStoreError('no volumes to write')
+    if len(rasToIJKs) != len(table):
+      raise CohortStoreError('%d matrices for %d volumes' % (len(rasToIJKs), len(table)))
+    description = json.dumps({
+      'shape' : list(shape),
+      'dtype' : dtype.str,
+      'chunkShape' : list(chunkShape),
+      'count' : len(table),
+      'rasToIJKs' : rasToIJKs,
+      'metadata' : metadata or [{} for volume in table],
+      }).encode('utf-8')
+    indexOffset = fp.tell()
+    fp.write(struct.pack('<Q', len(description)))
+    fp.write(description)
+    fp.write(numpy.array(table, dtype='<u8').data)
+    fp.seek(len(MAGIC))
+    fp.write(struct.pack('<Q', indexOffset))
+
+#
+# CohortStore
+#
+
+class CohortStore(object):
+  """Read access to a packed cohort file"""
+
+  def __init__(self,filePath):
+    self.filePath = filePath
+    self.fp = open(filePath, 'rb')
+    self.lock = threading.Lock()
+    if self.fp.read(len(MAGIC)) != MAGIC:
+      raise CohortStoreError('%s is not a packed cohort' % filePath)
+    indexOffset, = struct.unpack('<Q', self.fp.read(8))
+    self.fp.seek(indexOffset)
+    length, = struct.unpack('<Q', self.fp.read(8))
+    description = json.loads(self.fp.read(length).decode('utf-8'))
+    self.shape = tuple(description['shape'])
+    self.dtype = numpy.dtype(description['dtype'])
+    self.chunkShape = tuple(description['chunkShape'])
+    self.count = description['count']
+    self.rasToIJKs = [numpy.array(m) for m in description['rasToIJKs']]
+    self.metadata = description['metadata']
+    self.grid = chunkGrid(self.shape, self.chunkShape)
+    chunkCount = int(numpy.prod(self.grid))
+    self.table = numpy.frombuffer(self.fp.read(self.count * chunkCount * 16),
+                                  dtype='<u8').reshape(self.count, chunkCount, 2)
+
+  def close(self):
+    self.fp.close()
+
+  def __len__(self):
+    return self.count
+
+  def readChunk(self,subject,position):
+    """Decompressed chunk at grid position (k,j,i) of subject"""
+    offset, length = self.table[subject, numpy.ravel_multi_index(position, self.grid)]
+    with self.lock:
+      self.fp.seek(int(offset))
+      data = self.fp.read(int(length))
+    chunkShape = tuple(min(c, s - p * c) for p, c, s in zip(position, self.chunkShape, self.shape))
+    return numpy.frombuffer(zlib.decompress(data), dtype=self.dtype).reshape(chunkShape)
+
+  def readRegion(self,subject,slices):
+    """The (k,j,i) region given by three slices (steps of 1) of subject"""
+    bounds = [s.indices(size)[:2] for s, size in zip(slices, self.shape)]
+    region = numpy.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+    ranges = [range(start // c, (stop - 1) // c + 1) if stop > start else []
+              for (start, stop), c in zip(bounds, self.chunkShape)]
+    for k in ranges[0]:
+      for j in ranges[1]:
+        for i in ranges[2]:
+          position = (k, j, i)
+          chunk = self.readChunk(subject, position)
+          source, target = [], []
+          for p, c, (start, stop) in zip(position, self.chunkShape, bounds):
+            low, high = max(start, p * c), min(stop, (p + 1) * c)
+            source.append(slice(low - p * c, high - p * c))
+            target.append(slice(low - start, high - start))
+          region[tuple(target)] = chunk[tuple(source)]
+    return region
+
+  def readVolume(self,subject):
+    return self.readRegion(subject, (slice(None),) * 3)
+
+  def readSlice(self,subject,axis,index):
+    """One slice of subject; axis is 0 (k), 1 (j) or 2 (i)"""
+    slices = [slice(None)] * 3
+    slices[axis] = slice(index, index + 1)
+    return self.readRegion(subject, slices).squeeze(axis)
@@ -0,0 +1,270 @@
+import os
+import re
+import gzip
+import struct
+import fnmatch
+import threading
+import numpy
+from . import Nrrd
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+#
+# Cohort discovery
+#
+# List the data directory once, match the file pattern (printf style
+# %d or glob) and read only the headers of the matches, in parallel,
+# so the geometry of every subject is known (and inconsistencies are
+# reported) before any voxels are decoded.
+#
+
+class VolumeInfo(object):
+  """Geometry and type of one volume, from its header.
+  shape and spacing are in (i,j,k) order, directions are the unit
+  column vectors of the IJK to RAS matrix."""
+
+  def __init__(self,filePath,index=None):
+    self.filePath = filePath
+    self.index = index
+    self.shape = None
+    self.spacing = None
+    self.dtype = None
+    self.directions = None
+    self.origin = None
+    self.ijkToRAS = None
+    self.encoding = None
+    self.mappable = False
+    self.header = None
+    # sampled display range, when known (see WindowLevel)
+    self.intensities = None
+    self.error = None
+
+  def setIJKToRAS(self,ijkToRAS):
+    self.ijkToRAS = numpy.asarray(ijkToRAS, dtype='float64')
+    columns = self.ijkToRAS[:3, :3]
+    self.spacing = tuple(float(s) for s in numpy.sqrt((columns ** 2).sum(axis=0)))
+    self.directions = columns / numpy.where(self.spacing, self.spacing, 1.)
+    self.origin = tuple(float(o) for o in self.ijkToRAS[:3, 3])
+
+  def rasToIJK(self):
+    return numpy.linalg.inv(self.ijkToRAS)
+
+  def geometry(self):
+    """Values compared between subjects, rounded to ignore noise"""
+    return {
+      'shape' : self.shape,
+      'spacing' : tuple(round(s, 3) for s in self.spacing),
+      'dtype' : self.dtype,
+      'orientation' : tuple(tuple(round(v, 2) for v in row) for row in self.directions),
+      }
+
+def readInfo(filePath,index=None):
+  """VolumeInfo for a NRRD or NIfTI file; errors are recorded, not raised"""
+  info = VolumeInfo(filePath, index)
+  try:
+    lower = filePath.lower()
+    if Nrrd.isNrrd(filePath):
+      readNrrdInfo(info)
+    elif lower.endswith('.nii') or lower.endswith('.nii.gz') or lower.endswith('.hdr'):
+      readNiftiInfo(info)
+    else:
+      info.error = 'unsupported file type'
+  except Exception as e:
+    info.error = '%s: %s' % (e.__class__.__name__, e)
+  return info
+
+def readNrrdInfo(info):
+  header = Nrrd.readHeader(info.filePath)
+  info.header = header
+  info.shape = tuple(reversed(header.shape))
+  info.dtype = header.dtype.newbyteorder('=').str
+  info.encoding = header.encoding
+  info.mappable = header.isMappable()
+  info.setIJKToRAS(header.ijkToRAS())
+
+NIFTI_TYPES = {
+  2 : 'u1', 4 : 'i2', 8 : 'i4', 16 : 'f4', 64 : 'f8',
+  256 : 'i1', 512 : 'u2', 768 : 'u4', 1024 : 'i8', 1280 : 'u8',
+  }
+
+def readNiftiInfo(info):
+  opener = gzip.open if info.filePath.lower().endswith('.gz') else open
+  with opener(info.filePath, 'rb') as fp:
+    data = fp.read(348)
+  if len(data) < 348:
+    raise ValueError('truncated NIfTI header')
+  endian = '<'
+  if struct.unpack('<i', data[:4])[0] != 348:
+    endian = '>'
+    if struct.unpack('>i', data[:4])[0] != 348:
+      raise ValueError('not a NIfTI-1 header')
+  unpack = lambda format, offset: struct.unpack_from(endian + format, data, offset)
+  dim = unpack('8h', 40)
+  datatype = unpack('h', 70)[0]
+  pixdim = unpack('8f', 76)
+  qformCode, sformCode = unpack('2h', 252)
+  info.shape = tuple(max(1, d) for d in dim[1:4])
+  info.dtype = numpy.dtype(NIFTI_TYPES.get(datatype, 'V%d' % (unpack('h', 72)[0] // 8))).str
+  info.encoding = 'gzip' if info.filePath.lower().endswith('.gz') else 'raw'
+  ijkToRAS = numpy.eye(4)
+  if sformCode > 0:
+    ijkToRAS[0] = unpack('4f', 280)
+    ijkToRAS[1] = unpack('4f', 296)
+    ijkToRAS[2] = unpack('4f', 312)
+  elif qformCode > 0:
+    b, c, d = unpack('3f', 256)
+    a = numpy.sqrt(max(0., 1. - (b*b + c*c + d*d)))
+    rotation = numpy.array([
+      [a*a + b*b - c*c - d*d, 2*(b*c - a*d), 2*(b*d + a*c)],
+      [2*(b*c + a*d), a*a + c*c - b*b - d*d, 2*(c*d - a*b)],
+      [2*(b*d - a*c), 2*(c*d + a*b), a*a + d*d - c*c - b*b]])
+    qfac = -1. if pixdim[0] < 0 else 1.
+    ijkToRAS[:3, :3] = rotation * [pixdim[1], pixdim[2], qfac * pixdim[3]]
+    ijkToRAS[:3, 3] = unpack('3f', 268)
+  else:
+    ijkToRAS[:3, :3] = numpy.diag(pixdim[1:4])
+  info.setIJKToRAS(ijkToRAS)
+
+def patternExpression(pattern):
+  """Regular expression for a printf style pattern with one %d
+  (optionally zero padded, e.g. %03d), or None if there is none"""
+  match = re.search(r'%0?\d*d', pattern)
+  if not match:
+    return None
+  before, after = pattern[:match.start()], pattern[match.end():]
+  return re.compile('^%s(\\d+)%s$' % (re.escape(before), re.escape(after)))
+
+def naturalKey(fileName):
+  return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', fileName)]
+
+def nameMatcher(pattern):
+  """Function of a file name giving (True, index) if it matches
+  pattern (index is None for globs), else (False, None)"""
+  expression = patternExpression(pattern)
+  def match(fileName):
+    if expression:
+      found = expression.match(fileName)
+      return (True, int(found.group(1))) if found else (False, None)
+    return fnmatch.fnmatch(fileName, pattern), None
+  return match
+
+def matchOrder(match):
+  """Sort key of an (index, filePath) match"""
+  index, filePath = match
+  return (index if index is not None else -1, naturalKey(os.path.basename(filePath)))
+
+def matchFiles(directoryPath,pattern):
+  """(index, filePath) of the files of directoryPath matching pattern,
+  in index order (natural file name order for globs, index None)"""
+  match = nameMatcher(pattern)
+  matches = []
+  for fileName in os.listdir(directoryPath):
+    matched, index = match(fileName)
+    if matched:
+      matches.append((index, os.path.join(directoryPath, fileName)))
+  return sorted(matches, key=matchOrder)
+
+def limitMatches(matches,maxIndex):
+  """Matches up to index maxIndex (or the first maxIndex for globs)"""
+  if not maxIndex:
+    return matches
+  if matches and matches[0][0] is not None:
+    return [(index, filePath) for index, filePath in matches if index <= maxIndex]
+  return matches[:maxIndex]
+
+def parallelMap(function,items,workers,errors=None):
+  """[function(item) for item in items] using worker threads, which
+  suits functions that mostly wait on the file system.  An exception
+  raised for an item is raised here once every item is done, or, if
+  errors (a dictionary) is given, put in it by position and the
+  item's result left None."""
+  results = [None] * len(items)
+  raised = {}
+  work = queue.Queue()
+  for position, item in enumerate(items):
+    work.put((position, item))
+  def run():
+    while True:
+      try:
+        position, item = work.get_nowait()
+      except queue.Empty:
+        return
+      try:
+        results[position] = function(item)
+      except Exception as e:
+        raised[position] = e
+  threads = [threading.Thread(target=run) for worker in range(min(workers, len(items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors is not None:
+    errors.update(raised)
+  elif raised:
+    raise raised[min(raised)]
+  return results
+
+#
+# CohortDiscovery
+#
+
+class CohortDiscovery(object):
+  """The volumes of a cohort found on disk and their headers"""
+
+  def __init__(self,directoryPath,pattern,maxIndex=None,workers=16,volumes=None):
+    """volumes are VolumeInfos already known (e.g. from a CohortIndex),
+    otherwise the directory is scanned"""
+    self.directoryPath = directoryPath
+    self.pattern = pattern
+    if volumes is None:
+      matches = limitMatches(matchFiles(directoryPath, pattern), maxIndex)
+      volumes = parallelMap(lambda match: readInfo(match[1], match[0]), matches, workers)
+    self.volumes = volumes
+
+  def readable(self):
+    return [info for info in self.volumes if not info.error]
+
+  def errors(self):
+    return [info for info in self.volumes if info.error]
+
+  def missingIndices(self):
+    """Gaps in the numbering of a %d pattern"""
+    indices = [info.index for info in self.volumes if info.index is not None]
+    if not indices:
+      return []
+    present = set(indices)
+    return [index for index in range(min(min(indices), 1), max(indices) + 1) if index not in present]
+
+  def reference(self):
+    """The most common value of each geometry field"""
+    counts = {}
+    for info in self.readable():
+      for field, value in info.geometry().items():
+        counts.setdefault(field, {})
+        counts[field][value] = counts[field].get(value, 0) + 1
+    return dict((field, max(values, key=values.get)) for field, values in counts.items())
+
+  def mismatches(self):
+    """(filePath, field, value, expected) for every volume differing
+    from the most common geometry"""
+    reference = self.reference()
+    mismatches = []
+    for info in self.readable():
+      for field, value in sorted(info.geometry().items()):
+        if value != reference[field]:
+          mismatches.append((info.filePath, field, value, reference[field]))
+    return mismatches
+
+  def report(self):
+    """Human readable summary of anything unexpected"""
+    lines = ['%d volumes matching %s in %s' % (len(self.volumes), self.pattern, self.directoryPath)]
+    missing = self.missingIndices()
+    if missing:
+      lines.append('missing indices: %s' % ', '.join(str(index) for index in missing))
+    for info in self.errors():
+      lines.append('unreadable %s: %s' % (info.filePath, info.error))
+    for filePath, field, value, expected in self.mismatches():
+      lines.append('%s: %s is %s, most are %s' % (filePath, field, value, expected))
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+import numpy
+
+#
+# HistogramMatcher
+#
+# A numpy version of itk::HistogramMatchingImageFilter, as used by the
+# HistogramMatching CLI module: quantiles of the source and reference
+# histograms are matched and intensities mapped piecewise linearly
+# between them.
+#
+
+def histogramQuantile(counts,lower,upper,p):
+  """Quantile p of a histogram of equal width bins spanning lower to
+  upper, interpolated within a bin as itk::Statistics::Histogram does"""
+  size = len(counts)
+  total = float(counts.sum())
+  width = (upper - lower) / float(size)
+  cumulated = 0.
+  if p < 0.5:
+    n = 0
+    p_n = 0.
+    while True:
+      f_n = counts[n]
+      cumulated += f_n
+      p_n_prev = p_n
+      p_n = cumulated / total
+      n += 1
+      if not (n < size and p_n < p):
+        break
+    binProportion = f_n / total
+    binMin = lower + (n - 1) * width
+    return binMin + ((p - p_n_prev) / binProportion) * width
+  else:
+    n = size - 1
+    m = 0
+    p_n = 1.
+    while True:
+      f_n = counts[n]
+      cumulated += f_n
+      p_n_prev = p_n
+      p_n = 1. - cumulated / total
+      n -= 1
+      m += 1
+      if not (m < size and p_n > p):
+        break
+    binProportion = f_n / total
+    binMax = lower + (n + 2) * width
+    return binMax - ((p_n_prev - p) / binProportion) * width
+
+class IntensityTable(object):
+  """Minimum, maximum, threshold and match point quantiles of a volume"""
+
+  def __init__(self,array,numberOfHistogramLevels,numberOfMatchPoints,thresholdAtMeanIntensity):
+    self.minValue = float(array.min())
+    self.maxValue = float(array.max())
+    if thresholdAtMeanIntensity:
+      self.threshold = float(array.mean(dtype='float64'))
+    else:
+      self.threshold = self.minValue
+    counts = histogramCounts(array, numberOfHistogramLevels, self.threshold, self.maxValue)
+    delta = 1. / (numberOfMatchPoints + 1)
+    self.quantiles = [self.threshold]
+    for j in range(1, numberOfMatchPoints + 1):
+      self.quantiles.append(histogramQuantile(counts, self.threshold, self.maxValue, j * delta))
+    self.quantiles.append(self.maxValue)
+
+def histogramCounts(array,bins,lower,upper,slabSize=16):
+  """Histogram of the voxels from lower to upper, accumulated a slab
+  at a time so a memory mapped volume is never converted in one go"""
+  counts = numpy.zeros(bins, dtype='float64')
+  if upper <= lower:
+    counts[0] = array.size
+    return counts
+  for start in range(0, array.shape[0], slabSize):
+    slab = array[start:start + slabSize]
+    slab = slab[slab >= lower]
+    counts += numpy.histogram(slab, bins, (lower, upper))[0]
+  return counts
+
+class HistogramMatcher(object):
+  """Match volumes to the intensity distribution of a reference.
+  The reference quantiles are computed once and reused for every
+  volume passed to match()."""
+
+  def __init__(self,reference,numberOfHistogramLevels=128,numberOfMatchPoints=10,
+               thresholdAtMeanIntensity=False):
+    self.numberOfHistogramLevels = numberOfHistogramLevels
+    self.numberOfMatchPoints = numberOfMatchPoints
+    self.thresholdAtMeanIntensity = thresholdAtMeanIntensity
+    self.reference = self.table(reference)
+
+  def table(self,array):
+    return IntensityTable(array, self.numberOfHistogramLevels,
+                          self.numberOfMatchPoints, self.thresholdAtMeanIntensity)
+
+  def mapping(self,array):
+    """Segment start points and slopes mapping array to the reference.
+    Segment j (as found by searchsorted on the source quantiles) maps
+    value v to base[j] + (v - start[j]) * gradient[j]."""
+    source = self.table(array)
+    reference = self.reference
+    gradients = []
+    for j in range(self.numberOfMatchPoints + 1):
+      denominator = source.quantiles[j + 1] - source.quantiles[j]
+      if denominator != 0:
+        gradients.append((reference.quantiles[j + 1] - reference.quantiles[j]) / denominator)
+      else:
+        gradients.append(0.)
+    denominator = source.quantiles[0] - source.minValue
+    lowerGradient = 0.
+    if denominator != 0:
+      lowerGradient = (reference.quantiles[0] - reference.minValue) / denominator
+    denominator = source.quantiles[-1] - source.maxValue
+    upperGradient = 0.
+    if denominator != 0:
+      upperGradient = (reference.quantiles[-1] - reference.maxValue) / denominator
+    starts = numpy.array([source.minValue] + source.quantiles[:-1] + [source.maxValue])
+    bases = numpy.array([reference.minValue] + reference.quantiles[:-1] + [reference.maxValue])
+    slopes = numpy.array([lowerGradient] + gradients + [upperGradient])
+    return numpy.array(source.quantiles), starts, bases, slopes
+
+  def slabs(self,array,slabSize=16):
+    """The matched volume, a slab of slices along k at a time, in the
+    type of array (fractions truncated as the CLI does)"""
+    quantiles, starts, bases, slopes = self.mapping(array)
+    dtype = array.dtype
+    if dtype.kind in 'iu':
+      info = numpy.iinfo(dtype)
+    for start in range(0, array.shape[0], slabSize):
+      values = numpy.asarray(array[start:start + slabSize], dtype='float64')
+      segments = numpy.searchsorted(quantiles, values, side='right')
+      mapped = bases[segments] + (values - starts[segments]) * slopes[segments]
+      if dtype.kind in 'iu':
+        numpy.clip(mapped, info.min, info.max, out=mapped)
+      yield mapped.astype(dtype)
+
+  def match(self,array):
+    """The whole matched volume"""
+    return numpy.concatenate(list(self.slabs(array)))
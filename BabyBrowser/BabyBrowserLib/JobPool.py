@@ -0,0 +1,344 @@
+import os
+import sys
+import errno
+import time
+import threading
+import subprocess
+import multiprocessing
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+#
+# CLIJob
+#
+
+class CLIJob(object):
+  """One command line invocation (typically a Slicer CLI module)
+  run by a JobPool.  After the job finishes, returnCode, wallTime
+  and error describe what happened, and where the platform reports
+  them cpuTime (user plus system seconds) and peakRSSMB the resources
+  the process used.  inputs and outputs list the files the job reads
+  and writes (used to decide if it is up to date).  Functions in
+  onFinished are called with the job when it is done (or cancelled).
+  """
+
+  QUEUED = 'queued'
+  RUNNING = 'running'
+  SUCCEEDED = 'succeeded'
+  FAILED = 'failed'
+  SKIPPED = 'skipped'
+  CANCELLED = 'cancelled'
+
+  def __init__(self,name,args,threads=None,env=None,inputs=(),outputs=()):
+    self.name = name
+    self.args = list(args)
+    self.threads = threads
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.onFinished = []
+    self.env = env
+    self.status = self.QUEUED
+    self.returnCode = None
+    self.error = None
+    self.startTime = None
+    self.endTime = None
+    self.cpuTime = None
+    self.peakRSSMB = None
+    self.cancelled = False
+    self.process = None
+
+  def environment(self):
+    """ITK filters size their own thread pools from this variable,
+    so it is how a job is kept to its share of the cores"""
+    env = dict(self.env if self.env is not None else os.environ)
+    if self.threads:
+      env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(self.threads)
+    return env
+
+  def run(self):
+    if self.cancelled:
+      self.status = self.CANCELLED
+      return self
+    self.status = self.RUNNING
+    self.startTime = time.time()
+    try:
+      self.returnCode = self.execute()
+    except OSError as e:
+      self.error = str(e)
+    self.endTime = time.time()
+    if self.cancelled:
+      self.status = self.CANCELLED
+    elif self.returnCode == 0:
+      self.status = self.SUCCEEDED
+    else:
+      self.status = self.FAILED
+      if not self.error:
+        self.error = 'exit code %s' % self.returnCode
+    return self
+
+  def cancel(self):
+    """Stop the job: it will not start if it is queued, and its
+    process is terminated if it is running"""
+    if self.status not in (self.QUEUED, self.RUNNING):
+      return
+    self.cancelled = True
+    process = self.process
+    if process and process.returncode is None:
+      try:
+        process.terminate()
+      except OSError:
+        # already exited
+        pass
+
+  def execute(self):
+    process = self.process = subprocess.Popen(self.args, env=self.environment())
+    if self.cancelled:
+      process.terminate()
+    if not hasattr(os, 'wait4'):
+      return process.wait()
+    # wait4 also gives the resource usage of the process
+    while True:
+      try:
+        pid, status, usage = os.wait4(process.pid, 0)
+        break
+      except OSError as e:
+        if e.errno != errno.EINTR:
+          raise
+    if os.WIFSIGNALED(status):
+      process.returncode = -os.WTERMSIG(status)
+    else:
+      process.returncode = os.WEXITSTATUS(status)
+    self.cpuTime = usage.ru_utime + usage.ru_stime
+    # kilobytes on linux, bytes on mac
+    scale = 1024. * 1024. if sys.platform == 'darwin' else 1024.
+    self.peakRSSMB = usage.ru_maxrss / scale
+    return process.returncode
+
+  def wallTime(self):
+    if self.startTime is None:
+      return None
+    endTime = self.endTime if self.endTime is not None else time.time()
+    return endTime - self.startTime
+
+  def result(self):
+    """A plain dictionary describing the job, suitable for reports"""
+    return {
+      'name' : self.name,
+      'status' : self.status,
+      'returnCode' : self.returnCode,
+      'error' : self.error,
+      'wallTime' : self.wallTime(),
+      'cpuTime' : self.cpuTime,
+      'peakRSSMB' : self.peakRSSMB,
+      'threads' : self.threads,
+      'args' : self.args,
+      }
+
+#
+# PythonJob
+#
+
+class PythonJob(CLIJob):
+  """A job computed in this process by calling function().
+  args identify the computation for reports and caching: by convention
+  the source file implementing it followed by its parameters.  sources
+  are the other source files (such as the modules it imports) whose
+  content the result depends on.
+  """
+
+  def __init__(self,name,function,args,threads=None,inputs=(),outputs=(),sources=()):
+    CLIJob.__init__(self,name,args,threads,inputs=inputs,outputs=outputs)
+    self.function = function
+    self.sources = list(sources)
+
+  def execute(self):
+    # a python function cannot be interrupted, so cancelling only
+    # keeps the job from starting (or marks its result as cancelled)
+    try:
+      self.function()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      self.error = '%s: %s' % (e.__class__.__name__, e)
+      return 1
+    return 0
+
+#
+# JobBatch
+#
+
+class JobBatch(CLIJob):
+  """Several jobs run one after another by one worker, so what they
+  set up per thread (such as a bias corrector) is set up once for the
+  batch.  Each job's onFinished is called as soon as it is done; the
+  batch fails if any of its jobs did.
+  """
+
+  def __init__(self,name,parts,threads=None):
+    parts = list(parts)
+    CLIJob.__init__(self,name,[],threads,
+                    inputs=[path for part in parts for path in part.inputs],
+                    outputs=[path for part in parts for path in part.outputs])
+    self.parts = parts
+
+  def execute(self):
+    for part in self.parts:
+      if self.cancelled:
+        part.cancel()
+      part.run()
+      notifyFinished(part)
+    failed = [part.name for part in self.parts if part.status == self.FAILED]
+    if failed:
+      self.error = 'failed: %s' % ', '.join(failed)
+      return 1
+    return 0
+
+  def cancel(self):
+    CLIJob.cancel(self)
+    for part in self.parts:
+      part.cancel()
+
+def notifyFinished(job):
+  """Call the job's callbacks, reporting rather than raising errors"""
+  for callback in job.onFinished:
+    try:
+      callback(job)
+    except Exception:
+      import traceback
+      traceback.print_exc()
+
+#
+# JobPool
+#
+
+class JobPool(object):
+  """Run CLIJobs through a bounded set of worker threads.
+  The number of concurrent jobs is limited by both the core count
+  and the physical memory (given an estimate of memory per job),
+  and the cores are divided between the concurrent jobs.
+  """
+
+  def __init__(self,maxWorkers=None,memoryPerJobMB=None,totalThreads=None):
+    if totalThreads is None:
+      totalThreads = cpuCount()
+    workers = maxWorkers if maxWorkers else totalThreads
+    memoryMB = physicalMemoryMB()
+    if memoryPerJobMB and memoryMB:
+      workers = min(workers, int(memoryMB // memoryPerJobMB))
+    self.workers = max(1, min(workers, totalThreads))
+    self.threadsPerJob = max(1, totalThreads // self.workers)
+    self.jobs = []
+    self.queue = queue.Queue()
+    self.threads = []
+    self.lock = threading.Lock()
+
+  def submit(self,job):
+    """Add a job to the queue, starting workers as needed"""
+    with self.lock:
+      self.jobs.append(job)
+      self.queue.put(job)
+      if len(self.threads) < self.workers:
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
+    return job
+
+  def _work(self):
+    """Run queued jobs until there are none, then exit, so pools
+    that are done with do not keep idle threads for the session"""
+    while True:
+      with self.lock:
+        try:
+          job = self.queue.get_nowait()
+        except queue.Empty:
+          # submit starts another worker when there is more to do
+          self.threads.remove(threading.current_thread())
+          return
+      try:
+        job.run()
+        self.finished(job)
+      finally:
+        self.queue.task_done()
+
+  def finished(self,job):
+    """Call the job's callbacks; they may submit more jobs, which
+    wait() will also wait for"""
+    notifyFinished(job)
+
+  def skip(self,job,reason='up to date'):
+    """Account for a job that does not need to run"""
+    job.status = CLIJob.SKIPPED
+    job.error = reason
+    with self.lock:
+      self.jobs.append(job)
+    self.finished(job)
+    return job
+
+  def wait(self):
+    """Block until every submitted job has finished"""
+    self.queue.join()
+    return self.jobs
+
+  def isIdle(self):
+    """True when no submitted job is queued or running"""
+    return self.queue.unfinished_tasks == 0
+
+  def cancel(self):
+    """Cancel every job that has not finished"""
+    with self.lock:
+      jobs = list(self.jobs)
+    for job in jobs:
+      job.cancel()
+
+  def failures(self):
+    return [job for job in self.jobs if job.status == CLIJob.FAILED]
+
+  def report(self):
+    return [job.result() for job in self.jobs]
+
+  def summary(self):
+    """Human readable one line per job plus totals"""
+    lines = []
+    for job in self.jobs:
+      wallTime = job.wallTime()
+      lines.append('%-10s %8s %8s %8s %-40s %s' % (
+        job.status,
+        '%.1fs' % wallTime if wallTime is not None else '-',
+        '%.1fs' % job.cpuTime if job.cpuTime is not None else '-',
+        '%.0fMB' % job.peakRSSMB if job.peakRSSMB is not None else '-',
+        job.name,
+        job.error or ''))
+    skipped = [job for job in self.jobs if job.status == CLIJob.SKIPPED]
+    cancelled = [job for job in self.jobs if job.status == CLIJob.CANCELLED]
+    lines.append('%d jobs, %d skipped, %d cancelled, %d failed, %d workers x %d threads' % (
+      len(self.jobs), len(skipped), len(cancelled), len(self.failures()),
+      self.workers, self.threadsPerJob))
+    return '\n'.join(lines)
+
+#
+# resources of this node
+#
+
+def cpuCount():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+def physicalMemoryMB():
+  """Available memory if the platform reports it, else total physical
+  memory, else None"""
+  try:
+    with open('/proc/meminfo') as fp:
+      for line in fp:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) // 1024
+  except (IOError, OSError, ValueError):
+    pass
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024*1024)
+  except (AttributeError, ValueError, OSError):
+    return None
@@ -0,0 +1,105 @@
+import math
+import numpy
+
+#
+# Mosaic of one slice of many babies
+#
+# The slice of each baby nearest a position (mm along the normal of an
+# axial, coronal or sagittal view) is cut out of its (k,j,i) array as
+# a view, turned to read like that view, and the slices are laid out
+# in a grid in one 2D array, so any number of babies is one image.
+#
+
+# RAS axis normal to each view
+NORMALS = {
+  'axial' : 2,
+  'coronal' : 1,
+  'sagittal' : 0,
+  }
+
+# RAS axis and sense that run down and across the screen in each view
+SCREEN_AXES = {
+  'axial' : ((1, -1), (0, -1)),
+  'coronal' : ((2, -1), (0, -1)),
+  'sagittal' : ((2, -1), (1, -1)),
+  }
+
+def ijkAxis(rasToIJK,rasAxis):
+  """The voxel axis (0 for i) that moves most along rasAxis"""
+  return int(numpy.argmax(abs(numpy.asarray(rasToIJK, dtype='float64')[:3, rasAxis])))
+
+def offsetRange(rasToIJK,shape,orientation):
+  """(low, high) mm along the normal of orientation covered by a
+  volume of (k,j,i) shape"""
+  ijkToRAS = numpy.linalg.inv(numpy.asarray(rasToIJK, dtype='float64'))
+  rasAxis = NORMALS[orientation]
+  corners = [numpy.dot(ijkToRAS, (i, j, k, 1.))[rasAxis]
+             for i in (0, shape[2] - 1) for j in (0, shape[1] - 1) for k in (0, shape[0] - 1)]
+  return min(corners), max(corners)
+
+def sliceIndex(rasToIJK,shape,orientation,offset):
+  """(axis, index) of the slice of a (k,j,i) array nearest offset mm
+  along the normal of orientation through the volume's center; index
+  is None when offset is outside the volume"""
+  rasToIJK = numpy.asarray(rasToIJK, dtype='float64')
+  rasAxis = NORMALS[orientation]
+  voxelAxis = ijkAxis(rasToIJK, rasAxis)
+  center = numpy.dot(numpy.linalg.inv(rasToIJK),
+                     ((shape[2] - 1) / 2., (shape[1] - 1) / 2., (shape[0] - 1) / 2., 1.))
+  center[rasAxis] = offset
+  index = int(round(numpy.dot(rasToIJK, center)[voxelAxis]))
+  axis = 2 - voxelAxis
+  if not 0 <= index < shape[axis]:
+    return axis, None
+  return axis, index
+
+def takeSlice(array,axis,index):
+  """array[index] along axis, as a view"""
+  return array[(slice(None),) * axis + (index,)]
+
+def orientSlice(sliceArray,rasToIJK,axis,orientation):
+  """Transpose and flip (as views) a slice cut across axis of a baby
+  so it reads like the view of orientation"""
+  ijkToRAS = numpy.linalg.inv(numpy.asarray(rasToIJK, dtype='float64'))
+  directions = [ijkToRAS[:3, 2 - inPlane] for inPlane in (0, 1, 2) if inPlane != axis]
+  (downAxis, downSense), (acrossAxis, acrossSense) = SCREEN_AXES[orientation]
+  if abs(directions[0][downAxis]) < abs(directions[1][downAxis]):
+    sliceArray = sliceArray.T
+    directions.reverse()
+  if directions[0][downAxis] * downSense < 0:
+    sliceArray = sliceArray[::-1]
+  if directions[1][acrossAxis] * acrossSense < 0:
+    sliceArray = sliceArray[:, ::-1]
+  return sliceArray
+
+def tile(slices,columns=None,maxPixels=None,fill=0):
+  """Lay out 2D slices (None for a blank) row by row, each centered in
+  a cell the size of the largest.  Slices are subsampled by a common
+  step so the grid has at most maxPixels.  Returns (grid, step)."""
+  present = [sliceArray for sliceArray in slices if sliceArray is not None]
+  if not present:
+    return numpy.zeros((1, 1), dtype='float32'), 1
+  columns = columns or int(math.ceil(math.sqrt(len(slices))))
+  rows = int(math.ceil(len(slices) / float(columns)))
+  cellShape = [max(sliceArray.shape[axis] for sliceArray in present) for axis in (0, 1)]
+  step = 1
+  if maxPixels:
+    step = max(1, int(math.ceil(math.sqrt(rows * cellShape[0] * columns * cellShape[1] / float(maxPixels)))))
+  cellShape = [(size + step - 1) // step for size in cellShape]
+  dtype = numpy.result_type(*[sliceArray.dtype for sliceArray in present])
+  grid = numpy.empty((rows * cellShape[0], columns * cellShape[1]), dtype=dtype)
+  grid[:] = fill
+  for position, sliceArray in enumerate(slices):
+    if sliceArray is None:
+      continue
+    sliceArray = sliceArray[::step, ::step]
+    row, column = divmod(position, columns)
+    top = row * cellShape[0] + (cellShape[0] - sliceArray.shape[0]) // 2
+    left = column * cellShape[1] + (cellShape[1] - sliceArray.shape[1]) // 2
+    grid[top:top + sliceArray.shape[0], left:left + sliceArray.shape[1]] = sliceArray
+  return grid, step
+
+def gridRASToIJK(step=1):
+  """Geometry of a grid shown as a one slice volume in an axial view:
+  columns run to the right and rows down the screen"""
+  return numpy.diag([-1. / step, -1. / step, 1., 1.])
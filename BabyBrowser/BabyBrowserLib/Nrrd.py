@@ -0,0 +1,285 @@
+import os
+import gzip
+import zlib
+import numpy
+
+#
+# Minimal NRRD support for 3D scalar volumes
+# http://teem.sourceforge.net/nrrd/format.html
+#
+
+TYPES = {
+  'i1' : ('signed char', 'int8', 'int8_t'),
+  'u1' : ('uchar', 'unsigned char', 'uint8', 'uint8_t'),
+  'i2' : ('short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'),
+  'u2' : ('ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'),
+  'i4' : ('int', 'signed int', 'int32', 'int32_t'),
+  'u4' : ('uint', 'unsigned int', 'uint32', 'uint32_t'),
+  'i8' : ('longlong', 'long long', 'long long int', 'signed long long',
+          'signed long long int', 'int64', 'int64_t'),
+  'u8' : ('ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'),
+  'f4' : ('float',),
+  'f8' : ('double',),
+  }
+NRRD_TYPES = dict((name, code) for code, names in TYPES.items() for name in names)
+
+# sign of each world axis relative to RAS
+SPACES = {
+  'right-anterior-superior' : (1, 1, 1),
+  'ras' : (1, 1, 1),
+  'left-posterior-superior' : (-1, -1, 1),
+  'lps' : (-1, -1, 1),
+  'left-anterior-superior' : (-1, 1, 1),
+  'las' : (-1, 1, 1),
+  }
+
+class NrrdError(Exception):
+  pass
+
+#
+# NrrdHeader
+#
+
+class NrrdHeader(object):
+  """The fields of a NRRD header plus where its voxels live.
+  Field names are lower case, values are the unparsed strings."""
+
+  def __init__(self,filePath):
+    self.filePath = filePath
+    self.fields = {}
+    self.keyValues = {}
+    self.dataFile = None
+    self.dataOffset = 0
+    self.read()
+
+  def read(self):
+    with open(self.filePath, 'rb') as fp:
+      magic = fp.readline()
+      if not magic.startswith(b'NRRD'):
+        raise NrrdError('%s is not a NRRD file' % self.filePath)
+      while True:
+        line = fp.readline()
+        if not line or line in (b'\n', b'\r\n'):
+          break
+        line = line.decode('latin-1').rstrip('\r\n')
+        if line.startswith('#'):
+          continue
+        if ':=' in line:
+          key, value = line.split(':=', 1)
+          self.keyValues[key] = value
+        elif ': ' in line:
+          field, value = line.split(': ', 1)
+          self.fields[field.strip().lower()] = value.strip()
+      self.dataOffset = fp.tell()
+    dataFile = self.fields.get('data file', self.fields.get('datafile'))
+    if dataFile:
+      if dataFile.startswith('LIST') or len(dataFile.split()) > 1:
+        raise NrrdError('%s: multiple data files are not supported' % self.filePath)
+      if not os.path.isabs(dataFile):
+        dataFile = os.path.join(os.path.dirname(self.filePath), dataFile)
+      self.dataFile = dataFile
+      self.dataOffset = 0
+    else:
+      self.dataFile = self.filePath
+
+  @property
+  def encoding(self):
+    return self.fields.get('encoding', 'raw').lower()
+
+  @property
+  def shape(self):
+    """Array shape, slowest axis first (k, j, i)"""
+    sizes = [int(size) for size in self.fields['sizes'].split()]
+    return tuple(reversed(sizes))
+
+  @property
+  def dtype(self):
+    try:
+      code = NRRD_TYPES[self.fields['type'].lower()]
+    except KeyError:
+      raise NrrdError('%s: unsupported type %s' % (self.filePath, self.fields.get('type')))
+    endian = '>' if self.fields.get('endian', 'little').lower() == 'big' else '<'
+    if code[1] == '1':
+      endian = '|'
+    return numpy.dtype(endian + code)
+
+  def ijkToRAS(self):
+    """4x4 matrix from voxel index (i, j, k) to RAS"""
+    space = self.fields.get('space', 'right-anterior-superior').lower()
+    if space not in SPACES:
+      raise NrrdError('%s: unsupported space %s' % (self.filePath, space))
+    signs = numpy.array(SPACES[space], dtype='float64')
+    matrix = numpy.eye(4)
+    directions = self.fields.get('space directions')
+    if directions:
+      vectors = [v for v in directions.split() if v != 'none']
+      for axis, vector in enumerate(vectors[:3]):
+        matrix[:3, axis] = signs * parseVector(vector)
+    else:
+      spacings = self.fields.get('spacings', '1 1 1').split()
+      for axis, spacing in enumerate(spacings[:3]):
+        matrix[axis, axis] = float(spacing) if spacing != 'nan' else 1.
+    origin = self.fields.get('space origin')
+    if origin:
+      matrix[:3, 3] = signs * parseVector(origin)
+    return matrix
+
+  def rasToIJK(self):
+    return numpy.linalg.inv(self.ijkToRAS())
+
+  def isReadable(self):
+    """True if readArray supports this volume"""
+    return (self.encoding in ('raw', 'gzip', 'gz')
+            and int(self.fields.get('dimension', 0)) == 3
+            and int(self.fields.get('line skip', 0)) == 0)
+
+  def isMappable(self):
+    """True if the voxels can be memory mapped directly from disk"""
+    return self.encoding == 'raw' and self.isReadable()
+
+class HeaderTable(dict):
+  """Headers by file path.  Paths given to expect() (e.g. known to be
+  mappable from an index) count as present and are read on first use."""
+
+  def __init__(self):
+    dict.__init__(self)
+    self.expected = set()
+
+  def expect(self,filePath):
+    self.expected.add(filePath)
+
+  def __contains__(self,filePath):
+    return dict.__contains__(self, filePath) or filePath in self.expected
+
+  def __missing__(self,filePath):
+    if filePath not in self.expected:
+      raise KeyError(filePath)
+    header = self[filePath] = readHeader(filePath)
+    return header
+
+  def get(self,filePath,default=None):
+    try:
+      return self[filePath]
+    except KeyError:
+      return default
+
+def parseVector(text):
+  return numpy.array([float(v) for v in text.strip('()').split(',')])
+
+def readHeader(filePath):
+  return NrrdHeader(filePath)
+
+def isNrrd(filePath):
+  return os.path.splitext(filePath)[1].lower() in ('.nrrd', '.nhdr')
+
+def readArray(header):
+  """The voxels of a 3D NRRD shaped (k, j, i).  Raw volumes are a copy
+  on write memory map, so only the pages that are touched are ever
+  read; gzip volumes are decompressed into memory.
+  Non-native byte order costs a (swapped) copy."""
+  dtype = header.dtype
+  shape = header.shape
+  byteSkip = int(header.fields.get('byte skip', 0))
+  if header.isMappable():
+    offset = header.dataOffset + byteSkip
+    if byteSkip == -1:
+      count = int(numpy.prod(shape))
+      offset = os.path.getsize(header.dataFile) - count * dtype.itemsize
+    array = numpy.memmap(header.dataFile, dtype=dtype, mode='c', offset=offset, shape=shape)
+  elif header.isReadable():
+    with open(header.dataFile, 'rb') as fp:
+      fp.seek(header.dataOffset)
+      data = zlib.decompress(fp.read(), 16 + zlib.MAX_WBITS)
+    count = int(numpy.prod(shape))
+    if byteSkip == -1:
+      byteSkip = len(data) - count * dtype.itemsize
+    array = numpy.frombuffer(data, dtype=dtype, count=count, offset=byteSkip).reshape(shape)
+  else:
+    raise NrrdError('%s: unsupported NRRD encoding or dimension' % header.filePath)
+  if not dtype.isnative and dtype.itemsize > 1:
+    array = array.astype(dtype.newbyteorder('='))
+  return array
+
+def slabReader(header):
+  """A function readSlab(start,stop) giving slices start to stop of a
+  3D NRRD.  Raw volumes are cut from the memory map.  gzip volumes are
+  decompressed as a stream, so reading slabs in order decompresses the
+  volume once (a slab before the last one read restarts the stream)."""
+  byteSkip = int(header.fields.get('byte skip', 0))
+  if header.isMappable() or not header.isReadable() or byteSkip < 0:
+    return lambda start, stop: readArray(header)[start:stop]
+  dtype = header.dtype
+  shape = header.shape
+  sliceBytes = shape[1] * shape[2] * dtype.itemsize
+  state = {'stream' : None, 'position' : 0}
+  def skip(count):
+    while count > 0:
+      count -= len(state['stream'].read(min(count, 1024*1024)))
+  def readSlab(start,stop):
+    stop = min(stop, shape[0])
+    if state['stream'] is None or start < state['position']:
+      fp = open(header.dataFile, 'rb')
+      fp.seek(header.dataOffset)
+      state['stream'] = gzip.GzipFile(fileobj=fp, mode='rb')
+      state['position'] = 0
+      skip(byteSkip)
+    skip((start - state['position']) * sliceBytes)
+    data = state['stream'].read((stop - start) * sliceBytes)
+    state['position'] = stop
+    if len(data) != (stop - start) * sliceBytes:
+      raise NrrdError('%s: truncated data' % header.filePath)
+    array = numpy.frombuffer(data, dtype=dtype).reshape((stop - start,) + shape[1:])
+    if not dtype.isnative and dtype.itemsize > 1:
+      array = array.astype(dtype.newbyteorder('='))
+    return array
+  return readSlab
+
+def readVolume(filePath):
+  """The (k, j, i) voxels and header of filePath"""
+  header = readHeader(filePath)
+  return readArray(header), header
+
+GEOMETRY_FIELDS = ('space', 'space directions', 'space origin', 'space units',
+                   'kinds', 'measurement frame')
+
+def geometryFields(header):
+  """The fields of header needed to give another volume the same geometry"""
+  return dict((field, header.fields[field])
+              for field in GEOMETRY_FIELDS if field in header.fields)
+
+def writeNrrd(filePath,slabs,shape,dtype,fields=None,encoding='raw'):
+  """Write a (k, j, i) volume given as an iterable of slabs along k,
+  so the whole volume never has to be in memory.  fields (such as those
+  from geometryFields) are added to the header.  encoding is raw or gzip."""
+  dtype = numpy.dtype(dtype)
+  names = [name for name, code in NRRD_TYPES.items() if code == dtype.str[1:] and ' ' not in name]
+  lines = [
+    'NRRD0004',
+    'type: %s' % sorted(names, key=len)[-1],
+    'dimension: 3',
+    'sizes: %d %d %d' % tuple(reversed(shape)),
+    'endian: %s' % ('big' if dtype.byteorder == '>' else 'little'),
+    'encoding: %s' % encoding,
+    ]
+  for field, value in sorted((fields or {}).items()):
+    lines.append('%s: %s' % (field, value))
+  with open(filePath, 'wb') as fp:
+    fp.write(('\n'.join(lines) + '\n\n').encode('latin-1'))
+    if encoding == 'gzip':
+      out = gzip.GzipFile(fileobj=fp, mode='wb', compresslevel=1)
+    elif encoding == 'raw':
+      out = fp
+    else:
+      raise NrrdError('cannot write %s encoding' % encoding)
+    written = 0
+    for slab in slabs:
+      slab = numpy.ascontiguousarray(slab, dtype=dtype)
+      out.write(slab.data)
+      written += slab.shape[0]
+    if out is not fp:
+      out.close()
+  if written != shape[0]:
+    raise NrrdError('%s: wrote %d of %d slices' % (filePath, written, shape[0]))
+
+def writeArray(filePath,array,fields=None,encoding='raw'):
+  writeNrrd(filePath, [array], array.shape, array.dtype, fields, encoding)
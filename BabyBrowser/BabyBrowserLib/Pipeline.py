@@ -0,0 +1,213 @@
+import os
+import json
+import threading
+from .JobPool import CLIJob, JobBatch
+
+#
+# Pipeline
+#
+
+class Pipeline(object):
+  """Chain processing stages per subject through a JobPool.
+  Each stage is a (name, makeJob) pair where makeJob(inputPath,threads)
+  returns a CLIJob whose first output is the input of the next stage.
+  A subject starts its next stage as soon as its previous one finishes,
+  so stages of different subjects overlap.
+
+  Progress is saved to statePath after every job, and a new Pipeline
+  on the same statePath resumes each subject after the last stage it
+  completed (as long as that stage's output still exists and the
+  pipeline was created with the same key, which should identify the
+  stage parameters).
+  isUpToDate(job), if given, lets jobs whose outputs are current be
+  skipped instead of run; onJobFinished(job) is called for every job.
+  batchSizes maps stage names to the most subjects whose jobs for that
+  stage, when queued by start(), are run by one worker as a JobBatch
+  (to share what the stage sets up once per worker).
+  While it runs, progress() reports where every subject is; cancel()
+  stops it and retry() restarts the subjects that failed.
+  """
+
+  def __init__(self,pool,stages,statePath=None,key='',isUpToDate=None,onJobFinished=None,
+               batchSizes=None):
+    self.pool = pool
+    self.stages = list(stages)
+    self.batchSizes = dict(batchSizes or {})
+    self.statePath = statePath
+    self.key = key
+    self.isUpToDate = isUpToDate
+    self.onJobFinished = onJobFinished
+    self.lock = threading.RLock()
+    self.state = {}
+    self.current = {}
+    self.cancelled = False
+    if statePath and os.path.exists(statePath):
+      try:
+        with open(statePath) as fp:
+          saved = json.load(fp)
+        if saved.get('key') == key:
+          self.state = saved['subjects']
+      except (ValueError, KeyError):
+        print('Ignoring unreadable pipeline state %s' % statePath)
+
+  def stageNames(self):
+    return [name for name, makeJob in self.stages]
+
+  def start(self,subjects):
+    """Queue the first pending stage of each subject (a path to its
+    input volume) and return without waiting"""
+    self.cancelled = False
+    batches = {}
+    for subject in subjects:
+      with self.lock:
+        entry = self.state.setdefault(subject, {'completed' : [], 'output' : subject})
+        entry['failed'] = None
+        entry.pop('cancelled', None)
+        # completed stages are trusted only while their outputs exist
+        completed = entry['completed']
+        if completed and not os.path.exists(entry['output']):
+          completed[:] = []
+          entry['output'] = subject
+        names = self.stageNames()
+        stageIndex = len(completed) if completed == names[:len(completed)] else 0
+        if stageIndex == 0:
+          completed[:] = []
+          entry['output'] = subject
+      self.submit(subject, stageIndex, batches)
+    for name, jobs in sorted(batches.items()):
+      # smaller batches rather than idle workers
+      size = max(1, min(self.batchSizes[name], -(-len(jobs) // self.pool.workers)))
+      for first in range(0, len(jobs), size):
+        batch = jobs[first:first + size]
+        self.pool.submit(JobBatch('%s %d subjects' % (name, len(batch)), batch,
+                                  self.pool.threadsPerJob))
+    self.save()
+
+  def run(self,subjects):
+    """Run every stage for every subject and wait for them"""
+    self.start(subjects)
+    self.pool.wait()
+    return self.state
+
+  def submit(self,subject,stageIndex,batches=None):
+    """Queue a subject's stage, or add its job to batches (stage name
+    to jobs) if the stage is run in batches"""
+    if stageIndex >= len(self.stages):
+      return
+    name, makeJob = self.stages[stageIndex]
+    job = makeJob(self.state[subject]['output'], self.pool.threadsPerJob)
+    job.subject = subject
+    job.stage = name
+    job.onFinished.append(lambda job: self.finished(job, stageIndex))
+    with self.lock:
+      self.current[subject] = job
+    if self.isUpToDate and self.isUpToDate(job):
+      self.pool.skip(job)
+    elif batches is not None and name in self.batchSizes:
+      batches.setdefault(name, []).append(job)
+    else:
+      self.pool.submit(job)
+
+  def finished(self,job,stageIndex):
+    with self.lock:
+      entry = self.state[job.subject]
+      if job.status in (CLIJob.SUCCEEDED, CLIJob.SKIPPED):
+        entry['completed'].append(job.stage)
+        entry['output'] = job.outputs[0]
+      elif job.status == CLIJob.CANCELLED:
+        # neither done nor failed: the next start() resumes here
+        entry['cancelled'] = job.stage
+      else:
+        entry['failed'] = job.stage
+      proceed = not (entry['failed'] or entry.get('cancelled') or self.cancelled)
+    self.save()
+    if self.onJobFinished:
+      self.onJobFinished(job)
+    if proceed:
+      self.submit(job.subject, stageIndex + 1)
+
+  def cancel(self):
+    """Stop every subject after (or, for running processes, in) its
+    current stage; completed stages are kept, so start() resumes"""
+    self.cancelled = True
+    with self.lock:
+      jobs = list(self.current.values())
+    for job in jobs:
+      job.cancel()
+
+  def retry(self,subjects=None):
+    """Start again the failed (and cancelled) subjects, or only those
+    of subjects, from the stage that did not complete"""
+    with self.lock:
+      if subjects is None:
+        subjects = [subject for subject, entry in self.state.items()
+                    if entry.get('failed') or entry.get('cancelled')]
+    self.start(subjects)
+    return subjects
+
+  def progress(self):
+    """(rows, done, total, eta): a row per subject of (subject, stage,
+    status, seconds) for its current or last stage, the number of stages
+    done out of all of them, and an estimate of the seconds left (None
+    until a job has finished) from the mean time of the jobs that ran"""
+    names = self.stageNames()
+    rows = []
+    done = 0
+    with self.lock:
+      for subject in sorted(self.state):
+        entry = self.state[subject]
+        done += len(entry['completed'])
+        job = self.current.get(subject)
+        if entry.get('failed'):
+          stage, status = entry['failed'], CLIJob.FAILED
+        elif entry.get('cancelled'):
+          stage, status = entry['cancelled'], CLIJob.CANCELLED
+        elif entry['completed'] == names:
+          stage, status = names[-1], 'done'
+        elif job:
+          stage, status = job.stage, job.status
+        else:
+          stage, status = names[len(entry['completed'])], CLIJob.QUEUED
+        seconds = job.wallTime() if job and job.stage == stage else None
+        rows.append((subject, stage, status, seconds))
+      # a batch is timed by the jobs it ran
+      jobs = [part for job in self.pool.jobs for part in getattr(job, 'parts', None) or [job]
+              if part.status == CLIJob.SUCCEEDED and part.wallTime()]
+    total = len(rows) * len(names)
+    eta = None
+    if jobs:
+      meanSeconds = sum(job.wallTime() for job in jobs) / len(jobs)
+      remaining = sum(len(names) - len(self.state[row[0]]['completed'])
+                      for row in rows if row[2] not in (CLIJob.FAILED, CLIJob.CANCELLED))
+      eta = meanSeconds * remaining / self.pool.workers
+    return rows, done, total, eta
+
+  def isRunning(self):
+    return not self.pool.isIdle()
+
+  def failures(self):
+    """Subjects and the stage at which they failed"""
+    with self.lock:
+      return dict((subject, entry['failed'])
+                  for subject, entry in self.state.items() if entry.get('failed'))
+
+  def outputs(self):
+    """Final output of each subject that finished every stage"""
+    names = self.stageNames()
+    with self.lock:
+      return dict((subject, entry['output'])
+                  for subject, entry in self.state.items() if entry['completed'] == names)
+
+  def save(self):
+    if not self.statePath:
+      return
+    with self.lock:
+      temporaryPath = self.statePath + '.tmp'
+      with open(temporaryPath, 'w') as fp:
+        json.dump({'key' : self.key, 'subjects' : self.state}, fp, indent=1)
+      try:
+        os.rename(temporaryPath, self.statePath)
+      except OSError:
+        # windows will not rename over an existing file
+        os.remove(self.statePath)
+        os.rename(temporaryPath, self.statePath)
@@ -0,0 +1,112 @@
+import os
+import json
+import hashlib
+import threading
+
+#
+# PipelineCache
+#
+
+class PipelineCache(object):
+  """Manifest of the outputs written by CLIJobs and what they were
+  built from: the content of the tool executable (and, for a
+  PythonJob, of its other sources) and of every input file, and the
+  full argument list.  A job whose outputs exist,
+  are unchanged since they were recorded and whose key still matches
+  can be skipped.
+
+  File digests are cached against size and modification time so
+  unchanged files are only hashed once.
+  """
+
+  def __init__(self,manifestPath):
+    self.manifestPath = manifestPath
+    self.entries = {}
+    self.digests = {}
+    self.lock = threading.RLock()
+    if os.path.exists(manifestPath):
+      try:
+        with open(manifestPath) as fp:
+          manifest = json.load(fp)
+        self.entries = manifest.get('entries', {})
+        self.digests = manifest.get('digests', {})
+      except ValueError:
+        print('Ignoring unreadable manifest %s' % manifestPath)
+
+  def stamp(self,filePath):
+    status = os.stat(filePath)
+    return [status.st_size, status.st_mtime]
+
+  def fileDigest(self,filePath):
+    """sha1 of the content of filePath"""
+    filePath = os.path.abspath(filePath)
+    stamp = self.stamp(filePath)
+    with self.lock:
+      cached = self.digests.get(filePath)
+      if cached and cached[0] == stamp:
+        return cached[1]
+    sha1 = hashlib.sha1()
+    with open(filePath, 'rb') as fp:
+      while True:
+        block = fp.read(1024*1024)
+        if not block:
+          break
+        sha1.update(block)
+    digest = sha1.hexdigest()
+    with self.lock:
+      self.digests[filePath] = [stamp, digest]
+    return digest
+
+  def jobKey(self,job):
+    sha1 = hashlib.sha1()
+    sha1.update(self.fileDigest(job.args[0]).encode('utf-8'))
+    for arg in job.args[1:]:
+      sha1.update(arg.encode('utf-8') + b'\0')
+    for inputPath in job.inputs:
+      sha1.update(self.fileDigest(inputPath).encode('utf-8'))
+    for sourcePath in getattr(job, 'sources', ()):
+      sha1.update(self.fileDigest(sourcePath).encode('utf-8'))
+    return sha1.hexdigest()
+
+  def isUpToDate(self,job):
+    """True if the job's outputs were recorded with the same key and
+    have not been touched since"""
+    if not job.outputs:
+      return False
+    try:
+      with self.lock:
+        entries = [self.entries.get(os.path.abspath(outputPath)) for outputPath in job.outputs]
+      for outputPath, entry in zip(job.outputs, entries):
+        if not entry:
+          return False
+        if not os.path.exists(outputPath) or self.stamp(outputPath) != entry['stamp']:
+          return False
+      # only now hash the tool and inputs, which for a first run (no
+      # entries) would be reading the whole cohort to find nothing
+      key = self.jobKey(job)
+    except (OSError, IOError):
+      return False
+    return all(entry['key'] == key for entry in entries)
+
+  def record(self,job):
+    """Remember the outputs of a job that succeeded"""
+    key = self.jobKey(job)
+    with self.lock:
+      for outputPath in job.outputs:
+        if os.path.exists(outputPath):
+          self.entries[os.path.abspath(outputPath)] = {
+            'key' : key,
+            'stamp' : self.stamp(outputPath),
+            }
+
+  def save(self):
+    with self.lock:
+      temporaryPath = self.manifestPath + '.tmp'
+      with open(temporaryPath, 'w') as fp:
+        json.dump({'entries' : self.entries, 'digests' : self.digests}, fp, indent=1)
+      try:
+        os.rename(temporaryPath, self.manifestPath)
+      except OSError:
+        # windows will not rename over an existing file
+        os.remove(self.manifestPath)
+        os.rename(temporaryPath, self.manifestPath)
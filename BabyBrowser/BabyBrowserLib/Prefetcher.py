@@ -0,0 +1,85 @@
+import time
+import threading
+
+#
+# Prefetcher
+#
+
+class Prefetcher(object):
+  """Decode volumes into a VolumeCache on a background thread.
+  The key being displayed is requested first, then the keys the
+  slider is predicted to reach next given its direction and speed.
+  Volumes are only ever loaded by this thread so the caller never
+  waits on disk.
+  """
+
+  def __init__(self,cache,depth=4,lookaheadSeconds=0.5):
+    self.cache = cache
+    self.depth = depth
+    self.lookaheadSeconds = lookaheadSeconds
+    self.keys = []
+    self.pending = []
+    self.loading = None
+    self.lastIndex = None
+    self.lastTime = None
+    self.velocity = 0.
+    self.condition = threading.Condition()
+    self.thread = None
+
+  def setKeys(self,keys):
+    """The ordered keys the slider indexes into"""
+    with self.condition:
+      self.keys = list(keys)
+      self.pending = []
+      self.lastIndex = None
+      self.velocity = 0.
+
+  def start(self):
+    if not self.thread:
+      self.thread = threading.Thread(target=self._work)
+      self.thread.daemon = True
+      self.thread.start()
+
+  def predict(self,index):
+    """Indices likely to be shown after index, nearest first.
+    Faster scrubbing reads further ahead (up to depth) in the
+    direction of motion; one volume behind is also kept warm."""
+    step = 1 if self.velocity >= 0 else -1
+    ahead = int(min(self.depth, max(1, abs(self.velocity) * self.lookaheadSeconds)))
+    indices = [index + step * offset for offset in range(1, ahead + 1)]
+    indices.append(index - step)
+    return [i for i in indices if 0 <= i < len(self.keys)]
+
+  def hint(self,index,now=None):
+    """Record that index is being shown and reprioritize reads"""
+    if now is None:
+      now = time.time()
+    with self.condition:
+      if self.lastIndex is not None and now > self.lastTime:
+        velocity = (index - self.lastIndex) / (now - self.lastTime)
+        # smooth to avoid jitter from uneven slider events
+        self.velocity = 0.5 * self.velocity + 0.5 * velocity
+      self.lastIndex = index
+      self.lastTime = now
+      indices = [index] + self.predict(index)
+      self.pending = [self.keys[i] for i in indices if self.keys[i] not in self.cache]
+      self.condition.notify()
+    self.start()
+
+  def isLoading(self,key):
+    with self.condition:
+      return key == self.loading or key in self.pending
+
+  def _work(self):
+    while True:
+      with self.condition:
+        while not self.pending:
+          self.condition.wait()
+        self.loading = self.pending.pop(0)
+      try:
+        if self.loading not in self.cache:
+          self.cache.get(self.loading)
+      except Exception as e:
+        print('Prefetch of %s failed: %s' % (self.loading, e))
+      with self.condition:
+        self.loading = None
@@ -0,0 +1,104 @@
+import json
+import time
+import threading
+import contextlib
+
+#
+# Profiler
+#
+# Timed events from the browsing and processing paths (reads, copies,
+# display latency, jobs) kept in memory for a summary table and,
+# if logPath is set, appended to it as JSON lines.
+#
+
+def percentile(values,p):
+  """p-th percentile of values, interpolated between the closest ranks"""
+  values = sorted(values)
+  if not values:
+    return None
+  rank = (len(values) - 1) * p / 100.
+  low = int(rank)
+  high = min(low + 1, len(values) - 1)
+  return values[low] + (values[high] - values[low]) * (rank - low)
+
+class Profiler(object):
+  """Collects events: dictionaries with a category (e.g. read, show,
+  job), a name (e.g. the file path), the seconds taken, the time they
+  ended and any other fields (bytes, cpuTime, peakRSSMB...)."""
+
+  def __init__(self,logPath=None,enabled=True):
+    self.logPath = logPath
+    self.enabled = enabled
+    self.events = []
+    self.lock = threading.Lock()
+
+  def record(self,category,name,seconds,**fields):
+    if not self.enabled:
+      return None
+    event = dict(fields, category=category, name=name, seconds=seconds, time=time.time())
+    with self.lock:
+      self.events.append(event)
+      if self.logPath:
+        with open(self.logPath, 'a') as fp:
+          fp.write(json.dumps(event, sort_keys=True) + '\n')
+    return event
+
+  @contextlib.contextmanager
+  def timer(self,category,name,**fields):
+    """Record the time taken by the body of a with statement.  The
+    dictionary it yields can be given more fields meanwhile."""
+    startTime = time.time()
+    yield fields
+    self.record(category, name, time.time() - startTime, **fields)
+
+  def clear(self):
+    with self.lock:
+      self.events = []
+
+  def select(self,category):
+    with self.lock:
+      return [event for event in self.events if event['category'] == category]
+
+  def statistics(self):
+    """Per category: count, total and percentiles of seconds, and the
+    totals of the bytes, cpuTime and peakRSSMB fields where present"""
+    with self.lock:
+      categories = sorted(set(event['category'] for event in self.events))
+    statistics = {}
+    for category in categories:
+      events = self.select(category)
+      seconds = [event['seconds'] for event in events]
+      entry = {
+        'count' : len(events),
+        'seconds' : sum(seconds),
+        'mean' : sum(seconds) / len(seconds),
+        'p50' : percentile(seconds, 50),
+        'p90' : percentile(seconds, 90),
+        'p99' : percentile(seconds, 99),
+        'max' : max(seconds),
+        }
+      for field in ('bytes', 'cpuTime'):
+        values = [event[field] for event in events if event.get(field) is not None]
+        if values:
+          entry[field] = sum(values)
+      peaks = [event['peakRSSMB'] for event in events if event.get('peakRSSMB') is not None]
+      if peaks:
+        entry['peakRSSMB'] = max(peaks)
+      statistics[category] = entry
+    return statistics
+
+  def summary(self):
+    """Human readable table of statistics(), times in milliseconds"""
+    lines = ['%-10s %6s %10s %8s %8s %8s %8s %10s %8s %8s' % (
+      'category', 'count', 'total s', 'mean', 'p50', 'p90', 'p99', 'MB/s', 'cpu s', 'peak MB')]
+    for category, entry in sorted(self.statistics().items()):
+      rate = '-'
+      if entry.get('bytes') and entry['seconds'] > 0:
+        rate = '%.1f' % (entry['bytes'] / entry['seconds'] / (1024*1024))
+      lines.append('%-10s %6d %10.2f %8.1f %8.1f %8.1f %8.1f %10s %8s %8s' % (
+        category, entry['count'], entry['seconds'],
+        1000 * entry['mean'], 1000 * entry['p50'], 1000 * entry['p90'], 1000 * entry['p99'],
+        rate,
+        '%.1f' % entry['cpuTime'] if 'cpuTime' in entry else '-',
+        '%.0f' % entry['peakRSSMB'] if 'peakRSSMB' in entry else '-'))
+    return '\n'.join(lines)
@@ -0,0 +1,67 @@
+import os
+import numpy
+from . import Nrrd
+
+#
+# Multi-resolution pyramid of a volume
+#
+# Level n is the volume averaged over blocks of 2**n voxels per axis,
+# stored as raw NRRD files next to the data so they can be memory
+# mapped and shown instantly while scrubbing.
+#
+
+PYRAMID_DIRECTORY = '.pyramid'
+
+def halve(array):
+  """Average 2x2x2 blocks, repeating the last slice of odd sized axes"""
+  pad = [(0, size % 2) for size in array.shape]
+  if any(after for before, after in pad):
+    array = numpy.pad(array, pad, mode='edge')
+  k, j, i = [size // 2 for size in array.shape]
+  blocks = numpy.asarray(array, dtype='float32').reshape(k, 2, j, 2, i, 2)
+  return blocks.mean(axis=(1, 3, 5))
+
+def levelMatrix(level):
+  """Matrix from the voxel indices of level 0 to those of level"""
+  factor = 2. ** level
+  matrix = numpy.eye(4) / factor
+  matrix[3, 3] = 1.
+  matrix[:3, 3] = -(factor - 1) / (2 * factor)
+  return matrix
+
+def levelRASToIJK(rasToIJK,level):
+  return numpy.dot(levelMatrix(level), numpy.asarray(rasToIJK))
+
+def levelPath(filePath,level):
+  fileRoot = os.path.splitext(os.path.basename(filePath))[0]
+  return os.path.join(os.path.dirname(filePath), PYRAMID_DIRECTORY,
+                      '%s-%d.nrrd' % (fileRoot, level))
+
+def levelPaths(filePath,levels):
+  return [levelPath(filePath, level) for level in range(1, levels + 1)]
+
+def geometryFields(ijkToRAS):
+  """NRRD fields giving a volume the ijkToRAS matrix"""
+  vector = lambda v: '(%r,%r,%r)' % tuple(float(x) for x in v)
+  return {
+    'space' : 'right-anterior-superior',
+    'space directions' : ' '.join(vector(ijkToRAS[:3, axis]) for axis in range(3)),
+    'space origin' : vector(ijkToRAS[:3, 3]),
+    'kinds' : 'domain domain domain',
+    }
+
+def buildPyramid(filePath,array,rasToIJK,levels):
+  """Write levels 1 to levels of the (k,j,i) array of filePath
+  (whose geometry is rasToIJK), each in the type of array"""
+  directory = os.path.join(os.path.dirname(filePath), PYRAMID_DIRECTORY)
+  if not os.path.exists(directory):
+    os.mkdir(directory)
+  level = numpy.asarray(array)
+  for index in range(1, levels + 1):
+    level = halve(level)
+    ijkToRAS = numpy.linalg.inv(levelRASToIJK(rasToIJK, index))
+    if array.dtype.kind in 'iu':
+      stored = numpy.round(level).astype(array.dtype)
+    else:
+      stored = level.astype(array.dtype)
+    Nrrd.writeArray(levelPath(filePath, index), stored, geometryFields(ijkToRAS))
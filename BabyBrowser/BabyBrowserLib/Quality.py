@@ -0,0 +1,114 @@
+import math
+import numpy
+
+#
+# Registration quality
+#
+# Similarity of a registered volume to its template, to rank subjects
+# and look at the worst registrations first:
+# - ncc, the normalized cross correlation of the intensities
+# - mi, their mutual information (nats) from a joint histogram, and
+#   nmi, the same normalized to 0..1 by the marginal entropies
+# - dice, the overlap of the head masks of both (each thresholded
+#   with Otsu's method on a strided sample of its voxels)
+# The subject is visited a slab of slices at a time, so only a slab
+# (and the template) is ever held as floating point.
+#
+
+def sample(array,step=4):
+  """Every step-th voxel along each axis"""
+  return numpy.asarray(array[::step, ::step, ::step]).reshape(-1)
+
+def otsuThreshold(values,bins=256):
+  """The threshold maximizing the between class variance of values"""
+  counts, edges = numpy.histogram(values, bins)
+  centers = (edges[:-1] + edges[1:]) / 2.
+  weights = numpy.cumsum(counts).astype('float64')
+  sums = numpy.cumsum(counts * centers)
+  total, totalSum = weights[-1], sums[-1]
+  below = weights[:-1]
+  above = total - below
+  valid = (below > 0) & (above > 0)
+  if not valid.any():
+    return float(centers[0])
+  meanBelow = sums[:-1][valid] / below[valid]
+  meanAbove = (totalSum - sums[:-1][valid]) / above[valid]
+  between = below[valid] * above[valid] * (meanBelow - meanAbove) ** 2
+  return float(edges[1:-1][valid][numpy.argmax(between)])
+
+class Intensities(object):
+  """What the metrics need to know of a volume before streaming it:
+  its approximate mean (to keep the sums well conditioned), the range
+  of the joint histogram bins and the mask threshold"""
+
+  def __init__(self,array,step=4):
+    values = sample(array, step).astype('float64')
+    self.mean = float(values.mean())
+    self.low, self.high = [float(v) for v in numpy.percentile(values, (0.5, 99.5))]
+    self.threshold = otsuThreshold(values)
+
+  def binIndices(self,values,bins):
+    scale = bins / (self.high - self.low) if self.high > self.low else 0.
+    indices = ((values - self.low) * scale).astype('int64')
+    numpy.clip(indices, 0, bins - 1, out=indices)
+    return indices
+
+def entropy(probabilities):
+  probabilities = probabilities[probabilities > 0]
+  return -float((probabilities * numpy.log(probabilities)).sum())
+
+class Reference(object):
+  """A template, kept in memory, against which subjects on its grid
+  are scored"""
+
+  def __init__(self,array,bins=32,step=4):
+    self.array = array
+    self.bins = bins
+    self.step = step
+    self.intensities = Intensities(array, step)
+
+  def score(self,array,slabSize=16):
+    """Dictionary of ncc, mi, nmi, dice and score (the mean of ncc,
+    nmi and dice, so lower is worse) of a (k,j,i) array, such as a
+    memory mapped NRRD, on the template's grid"""
+    if tuple(array.shape) != tuple(self.array.shape):
+      raise ValueError('shape %s is not the template shape %s' % (tuple(array.shape), self.array.shape))
+    template = self.intensities
+    subject = Intensities(array, self.step)
+    n = 0
+    sums = numpy.zeros(5)
+    joint = numpy.zeros(self.bins * self.bins, dtype='int64')
+    overlap, templateVoxels, subjectVoxels = 0, 0, 0
+    for start in range(0, array.shape[0], slabSize):
+      stop = min(start + slabSize, array.shape[0])
+      x = numpy.asarray(self.array[start:stop], dtype='float64').reshape(-1)
+      y = numpy.asarray(array[start:stop], dtype='float64').reshape(-1)
+      templateMask = x > template.threshold
+      subjectMask = y > subject.threshold
+      overlap += int(numpy.count_nonzero(templateMask & subjectMask))
+      templateVoxels += int(numpy.count_nonzero(templateMask))
+      subjectVoxels += int(numpy.count_nonzero(subjectMask))
+      joint += numpy.bincount(template.binIndices(x, self.bins) * self.bins +
+                              subject.binIndices(y, self.bins), minlength=self.bins * self.bins)
+      x -= template.mean
+      y -= subject.mean
+      n += x.size
+      sums += (x.sum(), y.sum(), numpy.dot(x, x), numpy.dot(y, y), numpy.dot(x, y))
+    sx, sy, sxx, syy, sxy = sums
+    varianceProduct = (n * sxx - sx * sx) * (n * syy - sy * sy)
+    ncc = (n * sxy - sx * sy) / math.sqrt(varianceProduct) if varianceProduct > 0 else 0.
+    probabilities = joint.reshape(self.bins, self.bins) / float(n)
+    templateEntropy = entropy(probabilities.sum(axis=1))
+    subjectEntropy = entropy(probabilities.sum(axis=0))
+    mi = templateEntropy + subjectEntropy - entropy(probabilities.reshape(-1))
+    entropies = templateEntropy + subjectEntropy
+    nmi = 2 * mi / entropies if entropies > 0 else 0.
+    masked = templateVoxels + subjectVoxels
+    dice = 2. * overlap / masked if masked else 0.
+    return {
+      'ncc' : float(ncc),
+      'mi' : float(mi),
+      'nmi' : float(nmi),
+      'dice' : float(dice),
+      'score' : float((ncc + nmi + dice) / 3.),
+      }
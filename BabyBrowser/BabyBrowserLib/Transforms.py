@@ -0,0 +1,100 @@
+import math
+import numpy
+
+#
+# Linear transforms in ITK .tfm files
+#
+# Registration (BRAINSFit) writes the transform that resamples the
+# moving volume into the fixed one: it maps fixed space points to
+# moving space points, in LPS.  Slicer's transform nodes take the
+# opposite (modeling) sense in RAS, so a moving volume placed under
+# the node is shown where the fixed volume is.  readTransform returns
+# that matrix, as the transform storage node would compute it.
+#
+
+# RAS <-> LPS (its own inverse)
+LPS_TO_RAS = numpy.diag([-1., -1., 1., 1.])
+
+class TransformError(Exception):
+  pass
+
+def versorMatrix(versor):
+  """Rotation matrix of the unit quaternion with vector part versor"""
+  x, y, z = versor
+  w = math.sqrt(max(0., 1. - (x*x + y*y + z*z)))
+  return numpy.array([
+    [1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w)],
+    [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w)],
+    [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y)]])
+
+def eulerMatrix(angles):
+  """Rotation matrix of ITK's Euler3DTransform (Z X Y order)"""
+  ax, ay, az = angles
+  cx, sx = math.cos(ax), math.sin(ax)
+  cy, sy = math.cos(ay), math.sin(ay)
+  cz, sz = math.cos(az), math.sin(az)
+  rotateX = numpy.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+  rotateY = numpy.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+  rotateZ = numpy.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+  return numpy.dot(rotateZ, numpy.dot(rotateX, rotateY))
+
+def matrixAndTranslation(kind,parameters):
+  if kind in ('AffineTransform', 'MatrixOffsetTransformBase'):
+    if len(parameters) != 12:
+      raise TransformError('%s needs 12 parameters, not %d' % (kind, len(parameters)))
+    return numpy.reshape(parameters[:9], (3, 3)), parameters[9:]
+  if kind == 'VersorRigid3DTransform':
+    return versorMatrix(parameters[:3]), parameters[3:6]
+  if kind == 'Euler3DTransform':
+    return eulerMatrix(parameters[:3]), parameters[3:6]
+  if kind == 'TranslationTransform':
+    return numpy.eye(3), parameters[:3]
+  raise TransformError('unsupported transform %s' % kind)
+
+def parseTransforms(text):
+  """(kind, parameters, fixedParameters) of each transform in text"""
+  transforms = []
+  for line in text.splitlines():
+    if ':' not in line or line.startswith('#'):
+      continue
+    key, value = [part.strip() for part in line.split(':', 1)]
+    if key == 'Transform':
+      transforms.append([value.split('_')[0], [], []])
+    elif key == 'Parameters' and transforms:
+      transforms[-1][1] = [float(v) for v in value.split()]
+    elif key == 'FixedParameters' and transforms:
+      transforms[-1][2] = [float(v) for v in value.split()]
+  return transforms
+
+def itkMatrix(kind,parameters,fixedParameters):
+  """4x4 matrix of the transform in its own (LPS, resampling) sense:
+  y = M (x - center) + center + translation"""
+  matrix, translation = matrixAndTranslation(kind, numpy.asarray(parameters, dtype='float64'))
+  center = numpy.zeros(3)
+  if kind != 'TranslationTransform' and len(fixedParameters) >= 3:
+    center = numpy.asarray(fixedParameters[:3], dtype='float64')
+  result = numpy.eye(4)
+  result[:3, :3] = matrix
+  result[:3, 3] = numpy.asarray(translation) + center - numpy.dot(matrix, center)
+  return result
+
+def readTransform(filePath):
+  """The 4x4 RAS matrix to put a moving volume registered with the
+  linear transform in filePath into the space of the fixed volume
+  (a Slicer transform node's MatrixTransformToParent)"""
+  with open(filePath) as fp:
+    text = fp.read()
+  if not text.startswith('#Insight Transform File'):
+    raise TransformError('%s is not an ITK transform file' % filePath)
+  transforms = parseTransforms(text)
+  if not transforms:
+    raise TransformError('%s has no transform' % filePath)
+  # a file of several transforms applies the last one first
+  resampling = numpy.eye(4)
+  for kind, parameters, fixedParameters in transforms:
+    if kind == 'CompositeTransform':
+      # heads the list of the transforms it is made of
+      continue
+    resampling = numpy.dot(resampling, itkMatrix(kind, parameters, fixedParameters))
+  resamplingRAS = numpy.dot(LPS_TO_RAS, numpy.dot(resampling, LPS_TO_RAS))
+  return numpy.linalg.inv(resamplingRAS)
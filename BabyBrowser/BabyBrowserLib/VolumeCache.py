@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+#
+# VolumeCache
+#
+
+class VolumeCache(object):
+  """Least recently used cache of decoded volumes with a memory budget.
+  Volumes are decoded on first access by calling load(key) and the
+  least recently used ones are dropped when the total size (as reported
+  by sizeOf(volume)) exceeds budgetBytes.  The most recently used volume
+  is always kept, even if it alone is over budget.
+  """
+
+  def __init__(self,load,sizeOf,budgetBytes):
+    self.load = load
+    self.sizeOf = sizeOf
+    self.budgetBytes = budgetBytes
+    self.volumes = OrderedDict()
+    self.sizes = {}
+    self.totalBytes = 0
+    self.lock = threading.RLock()
+
+  def __contains__(self,key):
+    with self.lock:
+      return key in self.volumes
+
+  def __len__(self):
+    with self.lock:
+      return len(self.volumes)
+
+  def get(self,key):
+    """Return the volume for key, decoding it if needed"""
+    with self.lock:
+      if key in self.volumes:
+        volume = self.volumes.pop(key)
+        self.volumes[key] = volume
+        return volume
+    volume = self.load(key)
+    self.put(key,volume)
+    return volume
+
+  def peek(self,key):
+    """Return the volume if it is cached, else None, without
+    changing the eviction order"""
+    with self.lock:
+      return self.volumes.get(key)
+
+  def put(self,key,volume):
+    with self.lock:
+      self.discard(key)
+      self.volumes[key] = volume
+      self.sizes[key] = self.sizeOf(volume)
+      self.totalBytes += self.sizes[key]
+      self.evict()
+
+  def discard(self,key):
+    with self.lock:
+      if key in self.volumes:
+        del self.volumes[key]
+        self.totalBytes -= self.sizes.pop(key)
+
+  def setBudgetBytes(self,budgetBytes):
+    with self.lock:
+      self.budgetBytes = budgetBytes
+      self.evict()
+
+  def evict(self):
+    with self.lock:
+      while self.totalBytes > self.budgetBytes and len(self.volumes) > 1:
+        key = next(iter(self.volumes))
+        self.discard(key)
+
+  def clear(self):
+    with self.lock:
+      self.volumes.clear()
+      self.sizes.clear()
+      self.totalBytes = 0
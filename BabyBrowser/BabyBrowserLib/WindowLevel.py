@@ -0,0 +1,40 @@
+import numpy
+
+#
+# Window and level from sampled intensities
+#
+# The display range of a volume is taken between two percentiles of a
+# strided sample of its voxels, which needs a small fraction of the
+# reads of a full scan.  It is computed once per volume (and kept in
+# the cohort index) so swapping volumes never rescans them.
+#
+
+# percentiles of the sample at the bottom and top of the window
+PERCENTILES = (1, 99)
+
+def sampleIntensities(array,step=4):
+  """minimum, maximum, low and high (the PERCENTILES) of every
+  step-th voxel along each axis of a (k,j,i) array"""
+  values = numpy.asarray(array[::step, ::step, ::step]).reshape(-1)
+  if not values.size:
+    return None
+  low, high = numpy.percentile(values, PERCENTILES)
+  return {
+    'minimum' : float(values.min()),
+    'maximum' : float(values.max()),
+    'low' : float(low),
+    'high' : float(high),
+    }
+
+def windowLevel(low,high):
+  """(window, level) showing low to high"""
+  return max(high - low, 1e-6), (high + low) / 2.
+
+def sharedRange(ranges):
+  """One (low, high) for a cohort: the medians of the low and high of
+  each volume, so outliers do not flatten everyone's contrast"""
+  ranges = list(ranges)
+  if not ranges:
+    return None
+  return (float(numpy.median([low for low, high in ranges])),
+          float(numpy.median([high for low, high in ranges])))
@@ -0,0 +1,379 @@
+"""
+A work queue on shared storage for spreading cohort processing over
+several machines.
+
+A coordinator (BabyBrowserLogic.distributePipeline) puts one task per
+baby in the queue directory: the command lines of its stages, run in
+order.  Workers on any machine that sees the directory claim tasks,
+run them and move them to done or failed, e.g.
+
+  python BabyBrowserLib/WorkQueue.py --queue /shared/queue --workers 4
+
+Every state change is a rename within the queue directory, which is
+atomic, so no lock server is needed:
+
+  pending/<task>.json                 waiting for a worker
+  running/<task>.<worker>.claiming    being claimed
+  running/<task>.<worker>.json        claimed; its mtime is the heartbeat
+  running/<task>.<worker>.finishing   its result is being written
+  done/<task>.json                    finished, with the job results
+  failed/<task>.json                  a stage failed, or too many attempts
+
+A claimed task whose heartbeat is older than timeoutSeconds (its
+worker crashed or lost the storage) is moved back to pending by
+whoever notices first.  A worker writes the files of a task only
+while holding it under a name of its own (claiming, finishing) that
+it renamed the task to, so the rename that succeeds decides who owns
+the task.  Heartbeats are stamped and compared by the clock of the
+storage, not of the nodes.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import itertools
+import threading
+try:
+  from .JobPool import CLIJob
+except (ValueError, ImportError):
+  # run as a script
+  from JobPool import CLIJob
+
+STATES = ('pending', 'running', 'done', 'failed')
+# file name endings of a task being claimed, running and finishing
+TASK_SUFFIXES = ('.claiming', '.json', '.finishing')
+
+def jobSpec(job):
+  """What a worker needs to rerun a CLIJob"""
+  return {
+    'name' : job.name,
+    'args' : job.args,
+    'inputs' : job.inputs,
+    'outputs' : job.outputs,
+    'stage' : getattr(job, 'stage', None),
+    }
+
+def jobFromSpec(spec,threads=None):
+  job = CLIJob(spec['name'], spec['args'], threads,
+               inputs=spec['inputs'], outputs=spec['outputs'])
+  job.stage = spec.get('stage')
+  return job
+
+def writeJSON(filePath,value):
+  temporaryPath = '%s.%s-%d-%d.tmp' % (filePath, socket.gethostname(), os.getpid(),
+                                       id(threading.current_thread()))
+  with open(temporaryPath, 'w') as fp:
+    json.dump(value, fp, indent=1)
+  try:
+    os.rename(temporaryPath, filePath)
+  except OSError:
+    # windows will not rename over an existing file
+    os.remove(filePath)
+    os.rename(temporaryPath, filePath)
+
+def readJSON(filePath):
+  with open(filePath) as fp:
+    return json.load(fp)
+
+#
+# WorkQueue
+#
+
+class WorkQueue(object):
+  """The queue directory and the moves between its states.
+  Tasks are dictionaries; 'id' (a file name safe string) is added."""
+
+  def __init__(self,directoryPath,timeoutSeconds=300,maxAttempts=3):
+    self.directoryPath = directoryPath
+    self.timeoutSeconds = timeoutSeconds
+    self.maxAttempts = maxAttempts
+    for state in STATES:
+      statePath = os.path.join(directoryPath, state)
+      if not os.path.exists(statePath):
+        try:
+          os.makedirs(statePath)
+        except OSError:
+          # made by another process meanwhile
+          pass
+
+  def path(self,state,fileName):
+    return os.path.join(self.directoryPath, state, fileName)
+
+  def taskFiles(self,state):
+    return sorted(fileName for fileName in os.listdir(os.path.join(self.directoryPath, state))
+                  if fileName.endswith(TASK_SUFFIXES))
+
+  def now(self):
+    """The time by the clock of the queue's storage, which stamps the
+    heartbeats: the mtime of a file touched for the purpose"""
+    clockPath = os.path.join(self.directoryPath, '.clock-%s-%d' % (socket.gethostname(), os.getpid()))
+    with open(clockPath, 'a'):
+      pass
+    os.utime(clockPath, None)
+    return os.path.getmtime(clockPath)
+
+  def put(self,taskId,task):
+    """Queue a task, replacing any earlier result for the same id"""
+    task = dict(task, id=taskId, attempts=0)
+    for state in ('done', 'failed'):
+      if os.path.exists(self.path(state, taskId + '.json')):
+        os.remove(self.path(state, taskId + '.json'))
+    writeJSON(self.path('pending', taskId + '.json'), task)
+
+  def claim(self,workerId):
+    """The oldest pending task, now owned by workerId, or None"""
+    for fileName in self.taskFiles('pending'):
+      taskId = fileName[:-len('.json')]
+      claimingPath = self.path('running', '%s.%s.claiming' % (taskId, workerId))
+      try:
+        os.rename(self.path('pending', fileName), claimingPath)
+      except OSError:
+        # another worker got there first
+        continue
+      try:
+        # a rename keeps the mtime it had while pending
+        os.utime(claimingPath, None)
+        task = readJSON(claimingPath)
+      except (IOError, OSError, ValueError):
+        continue
+      task['attempts'] = task.get('attempts', 0) + 1
+      task['worker'] = workerId
+      task['claimTime'] = time.time()
+      if task['attempts'] > self.maxAttempts:
+        task = dict(task, result={'error' : 'gave up after %d attempts' % self.maxAttempts},
+                    finishTime=time.time())
+        self.release(claimingPath, 'failed', task)
+        continue
+      if self.release(claimingPath, 'running', task):
+        return task
+    return None
+
+  def runningPath(self,task):
+    return self.path('running', '%s.%s.json' % (task['id'], task['worker']))
+
+  def release(self,ownedPath,state,task):
+    """Write task to state from ownedPath, a file of it renamed where
+    only its owner looks, then remove ownedPath.  If the task was
+    requeued meanwhile (its owner stalled past the timeout) what was
+    written is taken back and False returned."""
+    if state == 'running':
+      targetPath = self.runningPath(task)
+    else:
+      targetPath = self.path(state, task['id'] + '.json')
+    writeJSON(targetPath, task)
+    try:
+      os.remove(ownedPath)
+    except OSError:
+      try:
+        os.remove(targetPath)
+      except OSError:
+        pass
+      return False
+    return True
+
+  def heartbeat(self,task):
+    """Mark the task as alive; False if it is no longer ours
+    (it timed out and was requeued)"""
+    try:
+      os.utime(self.runningPath(task), None)
+      return True
+    except OSError:
+      return False
+
+  def finish(self,task,state,result):
+    """Move a claimed task to done or failed with its result; False if
+    it was no longer ours"""
+    task = dict(task, result=result, finishTime=time.time())
+    runningPath = self.runningPath(task)
+    finishingPath = runningPath[:-len('.json')] + '.finishing'
+    try:
+      # fails if the task was requeued; after it, the task is requeued
+      # only if this worker stalls past the timeout
+      os.rename(runningPath, finishingPath)
+    except OSError:
+      return False
+    return self.release(finishingPath, state, task)
+
+  def requeueExpired(self,now=None):
+    """Return tasks whose worker stopped heartbeating (or stalled while
+    claiming or finishing them) to pending.  Returns the ids requeued."""
+    now = self.now() if now is None else now
+    requeued = []
+    for fileName in self.taskFiles('running'):
+      runningPath = self.path('running', fileName)
+      try:
+        if now - os.path.getmtime(runningPath) < self.timeoutSeconds:
+          continue
+        taskId = fileName.split('.')[0]
+        os.rename(runningPath, self.path('pending', taskId + '.json'))
+        requeued.append(taskId)
+      except OSError:
+        # finished or requeued by someone else meanwhile
+        pass
+    return requeued
+
+  def counts(self):
+    return dict((state, len(self.taskFiles(state))) for state in STATES)
+
+  def isIdle(self):
+    counts = self.counts()
+    return counts['pending'] == 0 and counts['running'] == 0
+
+  def results(self,state='done'):
+    """The finished tasks in state"""
+    tasks = []
+    for fileName in self.taskFiles(state):
+      try:
+        tasks.append(readJSON(self.path(state, fileName)))
+      except (IOError, OSError, ValueError):
+        pass
+    return tasks
+
+  def wait(self,pollSeconds=5,onPoll=None):
+    """Block until no task is pending or running, requeueing expired
+    ones meanwhile.  onPoll(counts) is called on every poll."""
+    while True:
+      self.requeueExpired()
+      counts = self.counts()
+      if onPoll:
+        onPoll(counts)
+      if counts['pending'] == 0 and counts['running'] == 0:
+        return counts
+      time.sleep(pollSeconds)
+
+#
+# Worker
+#
+
+def runJob(job,cancelled=None):
+  """Run job, stopping it if cancelled (a threading.Event) is set
+  while it runs"""
+  if cancelled is None:
+    return job.run()
+  finished = threading.Event()
+  def watch():
+    while not finished.wait(0.2):
+      if cancelled.is_set():
+        job.cancel()
+        return
+  watcher = threading.Thread(target=watch)
+  watcher.daemon = True
+  watcher.start()
+  try:
+    return job.run()
+  finally:
+    finished.set()
+    watcher.join()
+
+def runTask(task,threads=None,cancelled=None):
+  """Run the jobs of a task in order, stopping at the first failure
+  or when cancelled (a threading.Event) is set.
+  Returns (succeeded, result)."""
+  results = []
+  for spec in task.get('jobs', []):
+    job = jobFromSpec(spec, threads)
+    if cancelled is not None and cancelled.is_set():
+      job.cancel()
+    runJob(job, cancelled)
+    results.append(job.result())
+    if job.status != CLIJob.SUCCEEDED:
+      return False, {'jobs' : results, 'error' : job.error or job.status}
+  return True, {'jobs' : results}
+
+workerNumbers = itertools.count()
+
+class Worker(object):
+  """Claim and run tasks until told to stop (or, with exitWhenIdle,
+  until the queue is empty), heartbeating while each one runs.
+  execute(task,threads,cancelled) runs a task; cancelled is set if
+  the task is lost (requeued for another worker) meanwhile, and the
+  task should then stop writing its outputs."""
+
+  def __init__(self,workQueue,workerId=None,threads=None,execute=runTask,
+               heartbeatSeconds=None,pollSeconds=5,exitWhenIdle=False):
+    self.queue = workQueue
+    if workerId is None:
+      workerId = '%s-%d-%d' % (socket.gethostname(), os.getpid(), next(workerNumbers))
+    self.workerId = workerId.replace('.', '_')
+    self.threads = threads
+    self.execute = execute
+    self.heartbeatSeconds = heartbeatSeconds or max(1., workQueue.timeoutSeconds / 5.)
+    self.pollSeconds = pollSeconds
+    self.exitWhenIdle = exitWhenIdle
+    self.stopping = threading.Event()
+    self.completed = []
+
+  def stop(self):
+    self.stopping.set()
+
+  def run(self):
+    while not self.stopping.is_set():
+      self.queue.requeueExpired()
+      task = self.queue.claim(self.workerId)
+      if not task:
+        if self.exitWhenIdle and self.queue.isIdle():
+          return self.completed
+        self.stopping.wait(self.pollSeconds)
+        continue
+      self.runTask(task)
+    return self.completed
+
+  def runTask(self,task):
+    finished = threading.Event()
+    lost = threading.Event()
+    def beat():
+      while not finished.wait(self.heartbeatSeconds):
+        if not self.queue.heartbeat(task):
+          # another worker may be running it now: stop, so the two
+          # do not write the same outputs
+          print('%s lost task %s' % (self.workerId, task['id']))
+          lost.set()
+          return
+    heart = threading.Thread(target=beat)
+    heart.daemon = True
+    heart.start()
+    try:
+      succeeded, result = self.execute(task, self.threads, lost)
+    except Exception as e:
+      succeeded, result = False, {'error' : '%s: %s' % (e.__class__.__name__, e)}
+    finished.set()
+    heart.join()
+    if lost.is_set():
+      # its result is for whoever owns the task now to report
+      print('%s abandoned %s' % (self.workerId, task['id']))
+      return
+    state = 'done' if succeeded else 'failed'
+    if self.queue.finish(task, state, result):
+      self.completed.append((task['id'], state))
+    print('%s %s %s' % (self.workerId, state, task['id']))
+
+def main(argv=None):
+  import argparse
+  parser = argparse.ArgumentParser(description='Run BabyBrowser tasks from a shared queue')
+  parser.add_argument('--queue', required=True, help='queue directory on shared storage')
+  parser.add_argument('--workers', type=int, default=1, help='tasks run at once by this process')
+  parser.add_argument('--threads', type=int, default=None, help='ITK threads per task')
+  parser.add_argument('--timeout', type=float, default=300,
+                      help='seconds without a heartbeat before a task is requeued')
+  parser.add_argument('--poll', type=float, default=5, help='seconds between looks at an empty queue')
+  parser.add_argument('--exit-when-idle', action='store_true',
+                      help='stop once nothing is pending or running')
+  options = parser.parse_args(argv)
+  workQueue = WorkQueue(options.queue, timeoutSeconds=options.timeout)
+  workers = [Worker(workQueue, threads=options.threads, pollSeconds=options.poll,
+                    exitWhenIdle=options.exit_when_idle) for index in range(options.workers)]
+  threads = [threading.Thread(target=worker.run) for worker in workers]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  try:
+    while any(thread.is_alive() for thread in threads):
+      time.sleep(0.5)
+  except KeyboardInterrupt:
+    for worker in workers:
+      worker.stop()
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,20 @@
+from .JobPool import CLIJob, PythonJob, JobBatch, JobPool, cpuCount, physicalMemoryMB
+from .PipelineCache import PipelineCache
+from .VolumeCache import VolumeCache
+from .Prefetcher import Prefetcher
+from . import Nrrd
+from . import CohortStore
+from .Pipeline import Pipeline
+from .HistogramMatching import HistogramMatcher
+from .CohortStatistics import CohortStatistics
+from . import Pyramid
+from . import Discovery
+from .CohortIndex import CohortIndex
+from . import WorkQueue
+from . import Profiler
+from . import Benchmark
+from . import Transforms
+from . import Mosaic
+from . import Quality
+from . import WindowLevel
+from . import BiasCorrection